@@ -15,6 +15,7 @@ import coherence.extern.louie as louie
 from coherence.upnp.core.utils import getPage
 from coherence.extern.et import parse_xml
 from coherence.upnp.core import DIDLLite
+from coherence.upnp.core.search_criteria import SearchIndex
 from twisted.internet import defer, reactor
 
 
@@ -111,6 +112,13 @@ class BackendStore(Backend):
         if not self.urlbase.endswith('/'):
             self.urlbase += '/'
 
+        """ a backend that wants to answer UPnP Search requests
+            with real SearchCriteria evaluation sets this
+            to a search_criteria.SearchIndex and keeps
+            it up-to-date with its items
+        """
+        self.search_index = None
+
         # create a mapping for hex-numbers 0x04 to 0x17
         m = self.wmc_mapping = {
             '4': '4', '5': '5', '6': '6', '7': '7', '8': '8', '9': '9',
@@ -568,6 +576,7 @@ class AbstractBackendStore (BackendStore):
         BackendStore.__init__(self, server, **kwargs)
         self.next_id = SEED_ITEM_ID
         self.store = {}
+        self.search_index = SearchIndex()
 
     def len(self):
         return len(self.store)
@@ -587,10 +596,12 @@ class AbstractBackendStore (BackendStore):
         self.store[storage_id] = item
         item.storage_id = storage_id
         item.store = self
+        self.search_index.add(storage_id, item)
         return storage_id
 
     def remove_item(self, item):
         del self.store[item.storage_id]
+        self.search_index.remove(item.storage_id)
         item.storage_id = -1
         item.store = None
 
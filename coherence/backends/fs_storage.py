@@ -12,9 +12,12 @@ import tempfile
 import shutil
 import time
 import re
+import traceback
 from datetime import datetime
 import urllib
 from functools import partial
+from collections import namedtuple
+from sqlite3 import dbapi2
 
 from sets import Set
 
@@ -33,18 +36,21 @@ from urlparse import urlsplit
 
 from twisted.python.filepath import FilePath
 from twisted.python import failure
+from twisted.internet import reactor, defer, task
+from twisted.python.util import OrderedDict
 
 from coherence.upnp.core.DIDLLite import classChooser, Container, Resource
 from coherence.upnp.core.DIDLLite import DIDLElement
 from coherence.upnp.core.DIDLLite import simple_dlna_tags
 from coherence.upnp.core.soap_service import errorCode
+from coherence.upnp.core.search_criteria import SearchIndex
 
 from coherence.upnp.core import utils
 
 try:
     from coherence.extern.inotify import (
         INotify, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO,
-        IN_ISDIR, IN_CHANGED)
+        IN_ISDIR, IN_CHANGED, flag_to_human)
 except Exception, msg:
     INotify = None
     no_inotify_reason = msg
@@ -53,6 +59,7 @@ from coherence.extern.xdg import xdg_content
 
 import coherence.extern.louie as louie
 
+from coherence import log
 from coherence.backend import BackendItem, BackendStore
 
 DEFAULT_NAME = 'my media'
@@ -81,21 +88,148 @@ def _find_thumbnail(filename, thumbnail_folder='.thumbs'):
     name, ext = os.path.splitext(os.path.basename(filename))
     pattern = os.path.join(os.path.dirname(filename), thumbnail_folder, name + '.*')
     for f in glob.glob(pattern):
-        mimetype, _ = mimetypes.guess_type(f, strict=False)
-        if mimetype in ('image/jpeg', 'image/png'):
-            if mimetype == 'image/jpeg':
-                dlna_pn = 'DLNA.ORG_PN=JPEG_TN'
-            else:
-                dlna_pn = 'DLNA.ORG_PN=PNG_TN'
+        profile = _thumbnail_profile(f)
+        if profile is not None:
+            mimetype, dlna_pn = profile
             return os.path.abspath(f), mimetype, dlna_pn
     else:
         raise NoThumbnailFound()
 
 
+def _thumbnail_profile(filename):
+    """ returns the mimetype and the DLNA PN string of a thumbnail,
+        or None if it isn't a JPEG or PNG image
+    """
+    mimetype, _ = mimetypes.guess_type(filename, strict=False)
+    if mimetype == 'image/jpeg':
+        return mimetype, 'DLNA.ORG_PN=JPEG_TN'
+    elif mimetype == 'image/png':
+        return mimetype, 'DLNA.ORG_PN=PNG_TN'
+    return None
+
+
+def _id_number(id):
+    try:
+        return int(id.split('.', 1)[0])
+    except ValueError:
+        return None
+
+
+SCAN_INDEX_FIELDS = ('path', 'parent', 'id', 'mimetype', 'mtime', 'size',
+                     'thumbnail', 'thumbnail_size', 'caption', 'caption_size')
+
+
+class ScanEntry(namedtuple('ScanEntry', SCAN_INDEX_FIELDS)):
+    """ what the scan index knows about a file or directory """
+
+    def scan_info(self):
+        return {'mtime': self.mtime, 'size': self.size,
+                'thumbnail': self.thumbnail,
+                'thumbnail_size': self.thumbnail_size,
+                'caption': self.caption,
+                'caption_size': self.caption_size}
+
+
+class FSScanIndex(log.Loggable):
+    """ a persistent index of the files and directories
+        an FSStore has scanned, kept in a sqlite database
+
+        it lets the FSStore skip the directories that didn't change
+        since the last run, and hand out the same ids again
+    """
+    logCategory = 'fs_scan_index'
+
+    def __init__(self, filename):
+        log.Loggable.__init__(self)
+        self.filename = filename
+        self._db = dbapi2.connect(filename)
+        # paths are byte strings, whatever the encoding of the file-system
+        self._db.text_factory = str
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'path TEXT PRIMARY KEY, parent TEXT, id TEXT, '
+                         'mimetype TEXT, mtime REAL, size INTEGER, '
+                         'thumbnail TEXT, thumbnail_size INTEGER, '
+                         'caption TEXT, caption_size INTEGER)')
+        self.entries = {}
+        self.children = {}
+        self.numbers = set()
+        self._pending = {}
+        for row in self._db.execute('SELECT %s FROM files' %
+                                    ', '.join(SCAN_INDEX_FIELDS)):
+            self._add(ScanEntry(*row))
+        self.info("%d entries loaded from %r", len(self.entries), filename)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _add(self, entry):
+        self.entries[entry.path] = entry
+        self.children.setdefault(entry.parent, set()).add(entry.path)
+        self.numbers.add(_id_number(entry.id))
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def get_children(self, path):
+        return list(self.children.get(path, ()))
+
+    def is_used(self, number):
+        """ is that number part of an id handed out before """
+        return number in self.numbers
+
+    def update(self, path, parent, id, mimetype, scan_info):
+        entry = ScanEntry(path, parent, id, mimetype,
+                          *[scan_info.get(f, None) for f in SCAN_INDEX_FIELDS[4:]])
+        old = self.entries.get(path)
+        if old == entry:
+            return
+        if old is not None and old.parent != parent:
+            self.children[old.parent].discard(path)
+        self._add(entry)
+        self._pending[path] = entry
+
+    def remove(self, path):
+        """ forget about path and everything below it """
+        paths = [path]
+        while len(paths) > 0:
+            path = paths.pop()
+            paths.extend(self.children.pop(path, ()))
+            entry = self.entries.pop(path, None)
+            if entry is None:
+                continue
+            self.children.get(entry.parent, set()).discard(path)
+            self._pending[path] = None
+
+    def retain_children(self, path, paths):
+        """ forget about the children of path which are not in paths """
+        for child in self.get_children(path):
+            if child not in paths:
+                self.remove(child)
+
+    def commit(self):
+        if len(self._pending) == 0:
+            return
+        removed = [(p, ) for p, e in self._pending.iteritems() if e is None]
+        updated = [e for e in self._pending.itervalues() if e is not None]
+        self._pending = {}
+        try:
+            self._db.executemany('DELETE FROM files WHERE path = ?', removed)
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (%s)' %
+                                 ', '.join('?' * len(SCAN_INDEX_FIELDS)),
+                                 updated)
+            self._db.commit()
+        except dbapi2.Error, msg:
+            self.warning("can't update scan index %r: %s", self.filename, msg)
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+
 class FSItem(BackendItem):
     logCategory = 'fs_item'
 
-    def __init__(self, object_id, parent, path, mimetype, urlbase, UPnPClass, update=False, store=None):
+    def __init__(self, object_id, parent, path, mimetype, urlbase, UPnPClass, update=False, store=None, scan_info=None):
         BackendItem.__init__(self)
         self.id = object_id
         self.parent = parent
@@ -125,9 +259,16 @@ class FSItem(BackendItem):
             self.item.childCount = 0
         self.child_count = 0
         self.children = []
+        self.child_positions = {}  # the index of a child id in self.children
         self.sorted = False
         self.caption = None
 
+        # the scan info is taken from the scan index
+        # when we haven't changed since the last scan
+        self.indexed = scan_info is not None
+        if scan_info is None:
+            scan_info = self.scan()
+        self.scan_info = scan_info
 
         if mimetype in ['directory', 'root']:
             self.update_id = 0
@@ -135,9 +276,8 @@ class FSItem(BackendItem):
             self.get_path = lambda: None
             #self.item.searchable = True
             #self.item.searchClass = 'object'
-            if(isinstance(self.location, FilePath) and
-               self.location.isdir() == True):
-                self.check_for_cover_art()
+            if mimetype == 'directory':
+                self.cover = scan_info['thumbnail']
                 if getattr(self, 'cover', None):
                     _, ext = os.path.splitext(self.cover)
                     """ add the cover image extension to help clients not reacting on
@@ -159,10 +299,7 @@ class FSItem(BackendItem):
             else:
                 host = host_port
 
-            try:
-                size = self.location.getsize()
-            except:
-                size = 0
+            size = scan_info['size']
 
             if (self.store.server and
                 self.store.server.coherence.config.get('transcoding', 'no') == 'yes'):
@@ -248,48 +385,88 @@ class FSItem(BackendItem):
                 self.item.attachments[key] = utils.StaticFile(filename_of_thumbnail)
             """
 
-            if(self.mimetype in ('image/jpeg', 'image/png') or
-               self.mimetype.startswith('video/')):
-                try:
-                    filename, mimetype, dlna_pn = _find_thumbnail(self.get_path())
-                except NoThumbnailFound:
-                    pass
-                except:
-                    self.warning(traceback.format_exc())
-                else:
-                    dlna_tags = simple_dlna_tags[:]
-                    dlna_tags[3] = 'DLNA.ORG_FLAGS=00f00000000000000000000000000000'
-
-                    hash_from_path = str(id(filename))
-                    new_res = Resource(self.url + '?attachment=' + hash_from_path,
-                        'http-get:*:%s:%s' % (mimetype, ';'.join([dlna_pn] + dlna_tags)))
-                    new_res.size = os.path.getsize(filename)
-                    self.item.res.append(new_res)
-                    if not hasattr(self.item, 'attachments'):
-                        self.item.attachments = {}
-                    self.item.attachments[hash_from_path] = utils.StaticFile(filename)
-
-            if self.mimetype.startswith('video/'):
-                # check for a subtitles file
-                caption, _ = os.path.splitext(self.get_path())
-                caption = caption + '.srt'
-                if os.path.exists(caption):
-                    hash_from_path = str(id(caption))
-                    mimetype = 'smi/caption'
-                    new_res = Resource(self.url + '?attachment=' + hash_from_path,
-                        'http-get:*:%s:%s' % (mimetype, '*'))
-                    new_res.size = os.path.getsize(caption)
-                    self.caption = new_res.data
-                    self.item.res.append(new_res)
-                    if not hasattr(self.item, 'attachments'):
-                        self.item.attachments = {}
-                    self.item.attachments[hash_from_path] = utils.StaticFile(caption)
+            filename = scan_info['thumbnail']
+            profile = None
+            if filename is not None:
+                profile = _thumbnail_profile(filename)
+            if profile is not None:
+                mimetype, dlna_pn = profile
+                dlna_tags = simple_dlna_tags[:]
+                dlna_tags[3] = 'DLNA.ORG_FLAGS=00f00000000000000000000000000000'
+
+                hash_from_path = str(id(filename))
+                new_res = Resource(self.url + '?attachment=' + hash_from_path,
+                    'http-get:*:%s:%s' % (mimetype, ';'.join([dlna_pn] + dlna_tags)))
+                new_res.size = scan_info['thumbnail_size']
+                self.item.res.append(new_res)
+                if not hasattr(self.item, 'attachments'):
+                    self.item.attachments = {}
+                self.item.attachments[hash_from_path] = utils.StaticFile(filename)
+
+            caption = scan_info['caption']
+            if caption is not None:
+                hash_from_path = str(id(caption))
+                mimetype = 'smi/caption'
+                new_res = Resource(self.url + '?attachment=' + hash_from_path,
+                    'http-get:*:%s:%s' % (mimetype, '*'))
+                new_res.size = scan_info['caption_size']
+                self.caption = new_res.data
+                self.item.res.append(new_res)
+                if not hasattr(self.item, 'attachments'):
+                    self.item.attachments = {}
+                self.item.attachments[hash_from_path] = utils.StaticFile(caption)
+
+            if scan_info['mtime'] is not None:
+                self.item.date = datetime.fromtimestamp(scan_info['mtime'])
+            else:
+                self.item.date = None
+
+    def scan(self):
+        """ collects what we need to know about our file or directory
+            from the file-system, the result is kept in the scan index
+            of the FSStore - if there is one
+
+            returns a dict with mtime and size, the filename and size
+            of a thumbnail (the cover for directories) and a subtitles file
+        """
+        info = {'mtime': None, 'size': 0,
+                'thumbnail': None, 'thumbnail_size': None,
+                'caption': None, 'caption_size': None}
+        if not isinstance(self.location, FilePath):
+            return info
+        path = self.location.path
+        try:
+            st = os.stat(path)
+        except OSError:
+            return info
+        info['mtime'] = st.st_mtime
+
+        if self.mimetype == 'directory':
+            if stat.S_ISDIR(st.st_mode):
+                self.check_for_cover_art()
+                info['thumbnail'] = self.cover
+            return info
 
+        info['size'] = st.st_size
+        if(self.mimetype in ('image/jpeg', 'image/png') or
+           self.mimetype.startswith('video/')):
             try:
-                # FIXME: getmtime is deprecated in Twisted 2.6
-                self.item.date = datetime.fromtimestamp(self.location.getmtime())
+                filename, _, _ = _find_thumbnail(path)
+                info['thumbnail_size'] = os.path.getsize(filename)
+                info['thumbnail'] = filename
+            except NoThumbnailFound:
+                pass
             except:
-                self.item.date = None
+                self.warning(traceback.format_exc())
+
+        if self.mimetype.startswith('video/'):
+            # check for a subtitles file
+            caption, _ = os.path.splitext(path)
+            caption = caption + '.srt'
+            if os.path.exists(caption):
+                info['caption'] = caption
+                info['caption_size'] = os.path.getsize(caption)
+        return info
 
     def rebuild(self, urlbase):
         #print "rebuild", self.mimetype
@@ -362,6 +539,7 @@ class FSItem(BackendItem):
         del self.item
 
     def add_child(self, child, update=False):
+        self.child_positions[child.id] = len(self.children)
         self.children.append(child)
         self.child_count += 1
         if isinstance(self.item, Container):
@@ -372,17 +550,25 @@ class FSItem(BackendItem):
 
     def remove_child(self, child):
         #print "remove_from %d (%s) child %d (%s)" % (self.id, self.get_name(), child.id, child.get_name())
-        if child in self.children:
+        position = self.child_positions.get(child.id)
+        if position is not None and self.children[position] is child:
             self.child_count -= 1
             if isinstance(self.item, Container):
                 self.item.childCount -= 1
-            self.children.remove(child)
+            # fill the gap with the last child, we sort anyway
+            # before handing out the children again
+            del self.child_positions[child.id]
+            last = self.children.pop()
+            if last is not child:
+                self.children[position] = last
+                self.child_positions[last.id] = position
             self.update_id += 1
         self.sorted = False
 
     def get_children(self, start=0, request_count=0):
         if self.sorted == False:
             self.children.sort(key=_natural_key)
+            self.child_positions = dict((c.id, i) for i, c in enumerate(self.children))
             self.sorted = True
         if request_count == 0:
             return self.children[start:]
@@ -414,6 +600,7 @@ class FSItem(BackendItem):
             self.location
 
     def set_path(self, path=None, extension=None):
+        old_path = self.get_realpath()
         if path is None:
             path = self.get_path()
         if extension is not None:
@@ -423,6 +610,8 @@ class FSItem(BackendItem):
             self.location = FilePath(path)
         else:
             self.location = path
+        if self.store is not None:
+            self.store.move_path(self, old_path)
 
     def get_name(self):
         if isinstance(self.location, FilePath):
@@ -465,8 +654,10 @@ class FSStore(BackendStore):
                {'option': 'content', 'type': 'string', 'default': xdg_content(), 'help': 'the path(s) this MediaServer shall export'},
                {'option': 'ignore_patterns', 'type': 'string', 'help': 'list of regex patterns, matching filenames will be ignored'},
                {'option': 'enable_inotify', 'type': 'string', 'default': 'yes', 'help': 'enable real-time monitoring of the content folders'},
+               {'option': 'inotify_delay', 'type': 'int', 'default': 500, 'help': 'the time in milliseconds file-system events are gathered before they are applied together', 'level': 'advance'},
                {'option': 'enable_destroy', 'type': 'string', 'default': 'no', 'help': 'enable deleting a file via an UPnP method'},
-               {'option': 'import_folder', 'type': 'string', 'help': 'The path to store files imported via an UPnP method, if empty the Import method is disabled'}
+               {'option': 'import_folder', 'type': 'string', 'help': 'The path to store files imported via an UPnP method, if empty the Import method is disabled'},
+               {'option': 'scan_index', 'type': 'string', 'help': 'the file of a database to keep the scan results and ids in, only changed directories are scanned again on startup', 'level': 'advance'}
               ]
 
     def __init__(self, server, **kwargs):
@@ -491,8 +682,25 @@ class FSStore(BackendStore):
         self.content = Set([os.path.abspath(x) for x in self.content])
         ignore_patterns = kwargs.get('ignore_patterns', [])
         self.store = {}
+        self.ids_by_path = {}
+        self.search_index = SearchIndex()
+        self.scan_progress = {'scans': 0, 'pending': 0,
+                              'directories': 0, 'entries': 0}
+
+        self.scan_index = None
+        if kwargs.get('scan_index', None):
+            try:
+                self.scan_index = FSScanIndex(kwargs['scan_index'])
+            except dbapi2.Error, msg:
+                self.warning("can't open scan index %r: %s",
+                             kwargs['scan_index'], msg)
 
         self.inotify = None
+        self.inotify_delay = int(kwargs.get('inotify_delay', 500)) / 1000.0
+        self._pending_events = OrderedDict()
+        self._apply_events_call = None
+        self._changed_containers = None
+        self._changes_depth = 0
 
         if kwargs.get('enable_inotify', 'yes') == 'yes':
             if INotify:
@@ -530,6 +738,7 @@ class FSStore(BackendStore):
             self.store[id] = FSItem(id, parent, self.import_folder, 'directory', self.urlbase, UPnPClass, update=True, store=self)
             self.import_folder_id = id
 
+        scans = []
         for path in self.content:
             if isinstance(path, (list, tuple)):
                 path = path[0]
@@ -537,12 +746,20 @@ class FSStore(BackendStore):
                 continue
             try:
                 path = path.encode('utf-8')  # patch for #267
-                self.walk(path, parent, self.ignore_file_pattern)
+                scans.append(self.walk(path, parent, self.ignore_file_pattern))
             except Exception, msg:
                 self.warning('on walk of %r: %r', path, msg)
-                import traceback
                 self.debug(traceback.format_exc())
 
+        def scan_done(result):
+            self.info("initial scan done, %d items", len(self.store))
+            return result
+
+        # fired when all content folders are scanned,
+        # we don't wait for it and serve what we have so far
+        self.initial_scan = defer.DeferredList(scans)
+        self.initial_scan.addCallback(scan_done)
+
         self.wmc_mapping.update({'14': '0',
                                  '15': '0',
                                  '16': '0',
@@ -557,6 +774,12 @@ class FSStore(BackendStore):
     def release(self):
         if self.inotify != None:
             self.inotify.release()
+        if self._apply_events_call is not None:
+            self._apply_events_call.cancel()
+            self._apply_events_call = None
+        if self.scan_index != None:
+            self.scan_index.close()
+            self.scan_index = None
 
     def len(self):
         return len(self.store)
@@ -586,22 +809,24 @@ class FSStore(BackendStore):
 
     def get_id_by_name(self, parent='0', name=''):
         self.info('get_id_by_name %r (%r) %r', parent, type(parent), name)
-        try:
-            parent = self.store[parent]
-            self.debug("%r %d", parent, len(parent.children))
-            for child in parent.children:
-                #if not isinstance(name, unicode):
-                #    name = name.decode("utf8")
-                self.debug("%r %r %r", child.get_name(), child.get_realpath(), name == child.get_realpath())
-                if name == child.get_realpath():
-                    return child.id
-        except:
-            import traceback
-            self.info(traceback.format_exc())
+        id = self.ids_by_path.get(name)
+        if id is not None:
+            item = self.store.get(id)
+            if(item is not None and item.parent is not None and
+               item.parent is self.store.get(parent)):
+                return id
         self.debug('get_id_by_name not found')
 
         return None
 
+    def move_path(self, item, old_path):
+        """ called by an item when its path has changed """
+        if self.ids_by_path.get(old_path) == item.id:
+            del self.ids_by_path[old_path]
+        path = item.get_realpath()
+        if path is not None:
+            self.ids_by_path[path] = item.id
+
     def get_url_by_name(self, parent='0', name=''):
         self.info('get_url_by_name %r %r', parent, name)
         id = self.get_id_by_name(parent, name)
@@ -632,7 +857,7 @@ class FSStore(BackendStore):
         path = os.path.abspath(path)
         if path not in self.content:
             self.content.add(path)
-            self.walk(path, self.store['1000'], self.ignore_file_pattern)
+            return self.walk(path, self.store['1000'], self.ignore_file_pattern)
 
     def remove_content_folder(self, path):
         path = os.path.abspath(path)
@@ -640,76 +865,224 @@ class FSStore(BackendStore):
             id = self.get_id_by_name('1000', path)
             self.remove(id)
             self.content.remove(path)
+            if self.scan_index is not None:
+                self.scan_index.commit()
 
     def walk(self, path, parent=None, ignore_file_pattern=''):
+        """ scans path and everything below it
+
+            the scan runs as a cooperative task, so we keep on
+            serving requests meanwhile, and the containers are
+            browsable as soon as they are scanned
+
+            returns a Deferred, fired when the scan is done
+        """
         self.debug("walk %r", path)
+        self.scan_progress['scans'] += 1
+
+        def done(result):
+            self.scan_progress['scans'] -= 1
+            if self.scan_index is not None:
+                self.scan_index.commit()
+            return result
+
+        def failed(f):
+            self.warning('on walk of %r: %r', path, f.getErrorMessage())
+            self.debug(f.getTraceback())
+
+        d = task.cooperate(self._walk(path, parent, ignore_file_pattern)).whenDone()
+        d.addBoth(done)
+        d.addErrback(failed)
+        return d
+
+    def _walk(self, path, parent, ignore_file_pattern):
         containers = []
         parent = self.append(path, parent)
         if parent != None:
             containers.append(parent)
-        while len(containers) > 0:
-            container = containers.pop()
-            try:
-                self.debug('adding %r', container.location)
-                for child in container.location.children():
-                    if ignore_file_pattern.match(child.basename()) != None:
-                        continue
-                    new_container = self.append(child.path, container)
-                    if new_container != None:
-                        containers.append(new_container)
-            except UnicodeDecodeError:
-                self.warning("UnicodeDecodeError - there is something wrong with a file located in %r", container.get_path())
-
-    def create(self, mimetype, path, parent):
+            self.scan_progress['pending'] += 1
+        try:
+            while len(containers) > 0:
+                container = containers.pop()
+                self.scan_progress['pending'] -= 1
+                if self.store.get(container.id) is not container:
+                    # removed while we were busy
+                    continue
+                try:
+                    self.debug('adding %r', container.location)
+                    for child in self.list_directory(container):
+                        if ignore_file_pattern.match(os.path.basename(child)) != None:
+                            continue
+                        new_container = self.append(child, container)
+                        self.scan_progress['entries'] += 1
+                        if new_container != None:
+                            containers.append(new_container)
+                            self.scan_progress['pending'] += 1
+                        yield None
+                except UnicodeDecodeError:
+                    self.warning("UnicodeDecodeError - there is something wrong with a file located in %r", container.get_path())
+                self.scan_progress['directories'] += 1
+        finally:
+            self.scan_progress['pending'] -= len(containers)
+
+    def get_scan_progress(self):
+        """ returns the number of running scans, the number of
+            directories still to scan and of those already scanned,
+            and the number of files and directories looked at
+        """
+        return dict(self.scan_progress)
+
+    def list_directory(self, container):
+        """ returns the paths within the directory of a container,
+            they are taken from the scan index if the directory
+            didn't change since the last scan
+        """
+        path = container.get_realpath()
+        if container.indexed:
+            return self.scan_index.get_children(path)
+        paths = [child.path for child in container.location.children()]
+        if self.scan_index is not None:
+            self.scan_index.retain_children(path, set(paths))
+        return paths
+
+    def get_scan_entry(self, path, parent):
+        """ returns the entry of the scan index for path,
+            if it is still valid
+
+            files within a directory that didn't change are taken
+            as they are, everything else is checked for a changed
+            mtime and size
+        """
+        if self.scan_index is None:
+            return None
+        entry = self.scan_index.get(path)
+        if entry is None:
+            return None
+        if(entry.mimetype != 'directory' and
+           parent is not None and parent.indexed):
+            return entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_mtime != entry.mtime:
+            return None
+        if entry.mimetype != 'directory' and st.st_size != entry.size:
+            return None
+        return entry
+
+    def create(self, mimetype, path, parent, scan_entry=None):
         self.debug("create  %s %s %s %s", mimetype, path, type(path), parent)
         UPnPClass = classChooser(mimetype)
         if UPnPClass == None:
             return None
 
-        id = self.getnextID()
-        if mimetype in ('root', 'directory'):
-            id = str(id)
-        else:
-            _, ext = os.path.splitext(path)
-            id = str(id) + ext.lower()
+        id = None
+        if self.scan_index is not None and parent is not None:
+            # keep the id we had for that path on our last run
+            entry = self.scan_index.get(path)
+            if entry is not None and entry.id not in self.store:
+                id = entry.id
+        if id is None:
+            id = self.getnextID()
+            if mimetype in ('root', 'directory'):
+                id = str(id)
+            else:
+                _, ext = os.path.splitext(path)
+                id = str(id) + ext.lower()
         update = False
         if hasattr(self, 'update_id'):
             update = True
 
-        self.store[id] = FSItem(id, parent, path, mimetype, self.urlbase, UPnPClass, update=True, store=self)
-        if hasattr(self, 'update_id'):
-            self.update_id += 1
-            #print self.update_id
-            if self.server:
-                if hasattr(self.server, 'content_directory_server'):
-                    self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-            if parent is not None:
-                value = (parent.get_id(), parent.get_update_id())
-                if self.server:
-                    if hasattr(self.server, 'content_directory_server'):
-                        self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+        scan_info = None
+        if scan_entry is not None:
+            scan_info = scan_entry.scan_info()
+        self.store[id] = FSItem(id, parent, path, mimetype, self.urlbase, UPnPClass, update=True, store=self, scan_info=scan_info)
+        self.search_index.add(id, self.store[id])
+        if self.store[id].get_realpath() is not None:
+            self.ids_by_path[self.store[id].get_realpath()] = id
+        if self.scan_index is not None and parent is not None:
+            self.scan_index.update(path, parent.get_realpath(), id, mimetype,
+                                   self.store[id].scan_info)
+        self.content_changed(parent)
 
         return id
 
+    def content_changed(self, container=None):
+        """ tell the CDS about a change to our content,
+            within a container if it is given
+
+            between begin_changes and end_changes the changed containers
+            are just collected, and announced together at the end
+        """
+        if not hasattr(self, 'update_id'):
+            return
+        self.update_id += 1
+        if self._changed_containers is not None:
+            if container is not None:
+                self._changed_containers[container.get_id()] = container
+            return
+        cds = None
+        if self.server:
+            cds = getattr(self.server, 'content_directory_server', None)
+        if cds is None:
+            return
+        cds.set_variable(0, 'SystemUpdateID', self.update_id)
+        if container is not None:
+            value = (container.get_id(), container.get_update_id())
+            cds.set_variable(0, 'ContainerUpdateIDs', value)
+
+    def begin_changes(self):
+        if self._changed_containers is None:
+            self._changed_containers = OrderedDict()
+            self._changes_update_id = getattr(self, 'update_id', 0)
+        self._changes_depth += 1
+
+    def end_changes(self):
+        self._changes_depth -= 1
+        if self._changes_depth > 0:
+            return
+        containers = self._changed_containers
+        self._changed_containers = None
+        if getattr(self, 'update_id', 0) == self._changes_update_id:
+            return
+        cds = None
+        if self.server:
+            cds = getattr(self.server, 'content_directory_server', None)
+        if cds is None:
+            return
+        cds.set_variable(0, 'SystemUpdateID', self.update_id)
+        value = []
+        for id, container in containers.items():
+            if self.store.get(id) is container:
+                value.append('%s,%s' % (id, container.get_update_id()))
+        if len(value) > 0:
+            cds.set_variable(0, 'ContainerUpdateIDs', ','.join(value))
+
     def append(self, path, parent):
         self.debug("append  %s %s %s", path, type(path), parent)
-        if os.path.exists(path) == False:
-            self.warning("path %r not available - ignored", path)
-            return None
+        entry = self.get_scan_entry(path, parent)
+        if entry is None:
+            if os.path.exists(path) == False:
+                self.warning("path %r not available - ignored", path)
+                return None
 
-        if stat.S_ISFIFO(os.stat(path).st_mode):
-            self.warning("path %r is a FIFO - ignored", path)
-            return None
+            if stat.S_ISFIFO(os.stat(path).st_mode):
+                self.warning("path %r is a FIFO - ignored", path)
+                return None
 
         try:
-            mimetype, _ = mimetypes.guess_type(path, strict=False)
-            if mimetype == None:
-                if os.path.isdir(path):
-                    mimetype = 'directory'
+            if entry is not None:
+                mimetype = entry.mimetype
+            else:
+                mimetype, _ = mimetypes.guess_type(path, strict=False)
+                if mimetype == None:
+                    if os.path.isdir(path):
+                        mimetype = 'directory'
             if mimetype == None:
                 return None
 
-            id = self.create(mimetype, path, parent)
+            id = self.create(mimetype, path, parent, scan_entry=entry)
 
             if mimetype == 'directory':
                 if self.inotify is not None:
@@ -729,49 +1102,111 @@ class FSStore(BackendStore):
         try:
             item = self.store[id]
             parent = item.get_parent()
+            items = [item]
+            while len(items) > 0:
+                i = items.pop()
+                self.search_index.remove(i.id)
+                if self.ids_by_path.get(i.get_realpath()) == i.id:
+                    del self.ids_by_path[i.get_realpath()]
+                if i is not item:
+                    self.store.pop(i.id, None)
+                items.extend(i.children)
+            if self.scan_index is not None:
+                # committed by the caller, once per batch
+                self.scan_index.remove(item.get_realpath())
             item.remove()
             del self.store[id]
-            if hasattr(self, 'update_id'):
-                self.update_id += 1
-                if self.server:
-                    self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-                #value = '%d,%d' % (parent.get_id(),parent_get_update_id())
-                value = (parent.get_id(), parent.get_update_id())
-                if self.server:
-                    self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+            self.content_changed(parent)
 
         except:
             pass
 
     def notify(self, ignore, path, mask, parameter=None):
+        """ called by inotify for the directory with id parameter
+
+            the events are gathered per directory for inotify_delay,
+            and then applied together by apply_events
+        """
         self.info("Event %s on %s - parameter %r",
-            ', '.join(self.inotify.flag_to_human(mask)), path.path, parameter)
+            ', '.join(flag_to_human(mask)), path.path, parameter)
 
         if mask & IN_CHANGED:
             # FIXME react maybe on access right changes, loss of read rights?
             #print '%s was changed, parent %d (%s)' % (path, parameter, iwp.path)
             pass
 
+        if not mask & (IN_DELETE | IN_MOVED_FROM | IN_CREATE | IN_MOVED_TO):
+            return
+
+        events = self._pending_events.setdefault(parameter, OrderedDict())
+        # a deleted and created again path has to be refreshed
+        replaced = events.get(path.path, (path, False))[1]
         if(mask & IN_DELETE or mask & IN_MOVED_FROM):
-            self.info('%s was deleted, parent %r (%s)', path.path, parameter, path.parent.path)
-            id = self.get_id_by_name(parameter, path.path)
-            if id != None:
-                self.remove(id)
+            self.info('%s was deleted, parent %r (%s)', path.path, parameter, path.parent().path)
+            replaced = True
         if(mask & IN_CREATE or mask & IN_MOVED_TO):
             if mask & IN_ISDIR:
-                self.info('directory %s was created, parent %r (%s)', path.path, parameter, path.parent.path)
+                self.info('directory %s was created, parent %r (%s)', path.path, parameter, path.parent().path)
             else:
-                self.info('file %s was created, parent %r (%s)', path.path, parameter, path.parent.path)
-            if self.get_id_by_name(parameter, path.path) is None:
+                self.info('file %s was created, parent %r (%s)', path.path, parameter, path.parent().path)
+        events[path.path] = (path, replaced)
+
+        if self._apply_events_call is None:
+            self._apply_events_call = reactor.callLater(self.inotify_delay,
+                                                        self.apply_events)
+
+    def apply_events(self):
+        """ applies the gathered file-system events as one batch
+
+            we don't replay the events one by one, but compare each
+            path they were about with what we know about it,
+            so a file created and deleted again never shows up
+
+            returns a Deferred, fired when new directories are scanned
+            and the CDS got told about the changed containers
+        """
+        self._apply_events_call = None
+        pending = self._pending_events
+        self._pending_events = OrderedDict()
+        self.begin_changes()
+        scans = []
+        for parameter, events in pending.items():
+            parent = self.store.get(parameter)
+            if parent is None:
+                # removed meanwhile
+                continue
+            for path, replaced in events.values():
+                id = self.get_id_by_name(parameter, path.path)
+                exists = path.exists()
+                if id is not None and (replaced or not exists):
+                    self.remove(id)
+                    id = None
+                if id is not None or not exists:
+                    continue
+                if self.ignore_file_pattern.match(path.basename()) != None:
+                    continue
                 if path.isdir():
-                    self.walk(path.path, self.get_by_id(parameter), self.ignore_file_pattern)
+                    scans.append(self.walk(path.path, parent, self.ignore_file_pattern))
                 else:
-                    if self.ignore_file_pattern.match(filename) == None:
-                        self.append(path.path, self.get_by_id(parameter))
+                    self.append(path.path, parent)
+        if self.scan_index is not None:
+            self.scan_index.commit()
+
+        def done(result):
+            self.end_changes()
+            return result
+        d = defer.DeferredList(scans)
+        d.addBoth(done)
+        return d
 
     def getnextID(self):
         ret = self.next_id
         self.next_id += 1
+        if self.scan_index is not None:
+            # don't hand out an id again that the scan index knows
+            while self.scan_index.is_used(ret):
+                ret = self.next_id
+                self.next_id += 1
         return ret
 
     def backend_import(self, item, data):
@@ -850,16 +1285,7 @@ class FSStore(BackendStore):
                 item.set_path(None, extension)
             shutil.move(tmp_path, item.get_path())
             item.rebuild(self.urlbase)
-            if hasattr(self, 'update_id'):
-                self.update_id += 1
-                if self.server:
-                    if hasattr(self.server, 'content_directory_server'):
-                        self.server.content_directory_server.set_variable(0, 'SystemUpdateID', self.update_id)
-                if item.parent is not None:
-                    value = (item.parent.get_id(), item.parent.get_update_id())
-                    if self.server:
-                        if hasattr(self.server, 'content_directory_server'):
-                            self.server.content_directory_server.set_variable(0, 'ContainerUpdateIDs', value)
+            self.content_changed(item.parent)
 
         def gotError(error, url):
             self.warning("error requesting %s", url)
@@ -61,6 +61,7 @@ from coherence.upnp.core import DIDLLite
 from coherence.extern.covers_by_amazon import CoverGetter
 
 from coherence.backend import BackendItem, BackendStore
+from coherence.upnp.core.search_criteria import SearchIndex
 
 DEFAULT_NAME = 'MediaStore'
 DEFAULT_MEDIA_DB = 'tests/media.db'
@@ -468,6 +469,8 @@ class MediaStore(BackendStore):
         self.containers[ROOT_CONTAINER_ID] = \
                 Container(ROOT_CONTAINER_ID, -1, self.name)
 
+        self.search_index = SearchIndex(get_parent=self.get_search_parent)
+
         self.wmc_mapping.update({'4': lambda: self.get_by_id(AUDIO_ALL_CONTAINER_ID),  # all tracks
                                  '7': lambda: self.get_by_id(AUDIO_ALBUM_CONTAINER_ID),  # all albums
                                  '6': lambda: self.get_by_id(AUDIO_ARTIST_CONTAINER_ID),  # all artists
@@ -547,6 +550,8 @@ class MediaStore(BackendStore):
                                             track_nr=int(track),
                                             album=album_ds,
                                             location=unicode(file, 'utf8'))
+            for item in (artist_ds, album_ds, track_ds):
+                self.search_index.add(item.get_id(), item)
 
         for file in self.filelist:
             d = defer.maybeDeferred(get_tags, file)
@@ -616,6 +621,18 @@ class MediaStore(BackendStore):
                                 artist=album.artist.name,
                                 title=album.title)
 
+    def get_search_parent(self, item):
+        """ tracks and albums show up in their own
+            'All tracks' and 'Albums' containers too
+        """
+        if isinstance(item, Track):
+            return (item.album, self.containers[AUDIO_ALL_CONTAINER_ID])
+        if isinstance(item, Album):
+            return (item.artist, self.containers[AUDIO_ALBUM_CONTAINER_ID])
+        if isinstance(item, Artist):
+            return self.containers[AUDIO_ARTIST_CONTAINER_ID]
+        return self.containers.get(getattr(item, 'parent_id', None))
+
     def get_by_id(self, id):
         self.info("get_by_id %s", id)
         if isinstance(id, basestring):
@@ -665,6 +682,12 @@ class MediaStore(BackendStore):
         self.db.urlbase = self.urlbase
         self.db.containers = self.containers
 
+        for id in (AUDIO_ALL_CONTAINER_ID, AUDIO_ALBUM_CONTAINER_ID,
+                   AUDIO_ARTIST_CONTAINER_ID):
+            self.search_index.add(id, self.containers[id])
+        for kind in (Artist, Album, Track):
+            for item in self.db.query(kind):
+                self.search_index.add(item.get_id(), item)
 
 
         if db_is_new is True:
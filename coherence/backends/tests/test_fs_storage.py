@@ -9,8 +9,11 @@
 Test cases for L{upnp.backends.fs_storage}
 """
 
+import os
+
 from twisted.trial import unittest
 from twisted.python.filepath import FilePath
+from twisted.internet import inotify, task
 
 from coherence.backends import fs_storage
 
@@ -26,6 +29,7 @@ class TestFSStorageAssumptions(unittest.TestCase):
                                           content=self.tmp_content.path,
                                           urlbase='http://fsstore-host/xyz',
                                           enable_inotify=False)
+        return self.storage.initial_scan
 
     def tearDown(self):
         self.tmp_content.remove()
@@ -56,6 +60,7 @@ class TestFSStorageWithMultiContentAssumptions(unittest.TestCase):
                                           content=[audio.path, video.path],
                                           urlbase='http://fsstore-host/xyz',
                                           enable_inotify=False)
+        return self.storage.initial_scan
 
     def tearDown(self):
         self.tmp_content.remove()
@@ -100,6 +105,7 @@ class TestFSStorage(unittest.TestCase):
                                           content=self.tmp_content.path,
                                           urlbase='http://fsstore-host/xyz',
                                           enable_inotify=False)
+        return self.storage.initial_scan
 
     def tearDown(self):
         self.tmp_content.remove()
@@ -120,3 +126,242 @@ class TestFSStorage(unittest.TestCase):
                          'audio')
         self.assertEqual(self.storage.get_by_id('1005').get_name(),
                          'album-1')
+
+    def test_get_id_by_name(self):
+        album = self.tmp_content.child('my content').child('audio').child('album-1')
+        album_id = self.storage.get_id_by_name(
+            self.storage.get_id_by_name('1001', album.parent().path),
+            album.path)
+        self.assertEqual(self.storage.get_by_id(album_id).get_name(), 'album-1')
+        track_id = self.storage.get_id_by_name(album_id,
+                                               album.child('track-2.mp3').path)
+        self.assertEqual(self.storage.get_by_id(track_id).get_name(),
+                         'track-2.mp3')
+        # the path has to be a child of the given parent
+        self.assertIs(self.storage.get_id_by_name('1001', album.path), None)
+        self.assertIs(self.storage.get_id_by_name('1001', '/does/not/exist'), None)
+
+    def test_remove(self):
+        album = self.tmp_content.child('my content').child('audio').child('album-2')
+        album_id = self.storage.get_id_by_name(
+            self.storage.get_id_by_name('1001', album.parent().path),
+            album.path)
+        album_item = self.storage.get_by_id(album_id)
+        tracks = album_item.get_children()
+        self.storage.remove(tracks[0].id)
+        self.assertEqual(album_item.get_child_count(), 1)
+        self.assertEqual(album_item.get_children(), tracks[1:])
+        self.assertIs(self.storage.get_id_by_name(album_id, tracks[0].get_realpath()),
+                      None)
+        self.storage.remove(album_id)
+        self.assertIs(self.storage.get_id_by_name(album_id, tracks[1].get_realpath()),
+                      None)
+        self.assertEqual(album_item.parent.get_child_count(), 1)
+
+
+class TestFSStorageScanIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_content = FilePath(self.mktemp())
+        f = self.tmp_content.child('content')
+        album = f.child('audio').child('album-1')
+        album.makedirs()
+        album.child('track-1.mp3').touch()
+        album.child('track-2.mp3').touch()
+        video = f.child('video')
+        video.makedirs()
+        video.child('movie.avi').setContent('x' * 10)
+        video.child('movie.srt').touch()
+        self.content = f
+        self.index = self.tmp_content.child('index.db').path
+        return self.create_store()
+
+    def tearDown(self):
+        if self.storage.scan_index is not None:
+            self.storage.release()
+        self.tmp_content.remove()
+
+    def create_store(self):
+        """ returns a Deferred, fired when the content is scanned """
+        self.storage = fs_storage.FSStore(None, name='my media',
+                                          content=self.content.path,
+                                          urlbase='http://fsstore-host/xyz',
+                                          enable_inotify=False,
+                                          scan_index=self.index)
+        return self.storage.initial_scan
+
+    def ids_by_path(self, storage):
+        return dict((item.get_realpath(), id)
+                    for id, item in storage.store.items())
+
+    def test_ids_are_stable(self):
+        ids = self.ids_by_path(self.storage)
+        self.assertEqual(len(self.storage.scan_index), len(ids) - 1)
+        self.storage.release()
+
+        def check(result):
+            self.assertEqual(self.ids_by_path(self.storage), ids)
+        return self.create_store().addCallback(check)
+
+    def test_removals_are_committed_by_batch(self):
+        """ removed items are written to the index by whoever
+            owns the batch, not one transaction per item
+        """
+        album = self.content.child('audio').child('album-1')
+        ids = self.ids_by_path(self.storage)
+        commits = []
+        self.storage.scan_index.commit = lambda: commits.append(None)
+        for name in ('track-1.mp3', 'track-2.mp3'):
+            self.storage.remove(ids[album.child(name).path])
+        self.assertEqual(commits, [])
+        self.assertNotIn(album.child('track-1.mp3').path,
+                         self.storage.scan_index.entries)
+        del self.storage.scan_index.commit
+        self.storage.release()
+
+        def check(result):
+            # album-1 didn't change on disk, it is taken from the index
+            new_ids = self.ids_by_path(self.storage)
+            self.assertNotIn(album.child('track-1.mp3').path, new_ids)
+            self.assertNotIn(album.child('track-2.mp3').path, new_ids)
+            self.assertEqual(new_ids[album.path], ids[album.path])
+        return self.create_store().addCallback(check)
+
+    def test_unchanged_directories_are_not_scanned(self):
+        self.storage.release()
+        return self.create_store().addCallback(self.check_indexed)
+
+    def check_indexed(self, result):
+        album = self.content.child('audio').child('album-1')
+        track = self.storage.get_by_id(
+            self.ids_by_path(self.storage)[album.child('track-1.mp3').path])
+        self.assertTrue(track.parent.indexed)
+        self.assertTrue(track.indexed)
+        movie = self.storage.get_by_id(
+            self.ids_by_path(self.storage)[self.content.child('video').child('movie.avi').path])
+        self.assertEqual(movie.scan_info['size'], 10)
+        self.assertNotEqual(movie.caption, None)
+
+    def test_changed_directory(self):
+        ids = self.ids_by_path(self.storage)
+        self.storage.release()
+        album = self.content.child('audio').child('album-1')
+        album.child('track-1.mp3').remove()
+        album.child('track-3.mp3').touch()
+        # make sure the change is visible in the mtime of the directory
+        album.changed()
+        os.utime(album.path, (album.getAccessTime(), album.getModificationTime() + 10))
+        return self.create_store().addCallback(self.check_changed, ids)
+
+    def check_changed(self, result, ids):
+        album = self.content.child('audio').child('album-1')
+        new_ids = self.ids_by_path(self.storage)
+        self.assertNotIn(album.child('track-1.mp3').path, new_ids)
+        self.assertEqual(new_ids[album.child('track-2.mp3').path],
+                         ids[album.child('track-2.mp3').path])
+        self.assertNotIn(new_ids[album.child('track-3.mp3').path],
+                         ids.values())
+        self.assertNotIn(album.child('track-1.mp3').path,
+                         self.storage.scan_index.entries)
+
+
+class TestFSStorageScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_content = FilePath(self.mktemp())
+        for n in range(3):
+            album = self.tmp_content.child('album-%d' % n)
+            album.makedirs()
+            for t in range(5):
+                album.child('track-%d.mp3' % t).touch()
+
+    def tearDown(self):
+        self.tmp_content.remove()
+
+    def test_scan_is_incremental(self):
+        """ the scan doesn't block, and its progress is reported
+        """
+        storage = fs_storage.FSStore(None, name='my media',
+                                     content=self.tmp_content.path,
+                                     urlbase='http://fsstore-host/xyz',
+                                     enable_inotify=False)
+        progress = storage.get_scan_progress()
+        self.assertEqual(progress['scans'], 1)
+        self.assertTrue(len(storage.store) < 19)
+
+        def check(result):
+            self.assertEqual(len(storage.store), 19)
+            progress = storage.get_scan_progress()
+            self.assertEqual(progress['scans'], 0)
+            self.assertEqual(progress['pending'], 0)
+            self.assertEqual(progress['directories'], 4)
+            self.assertEqual(progress['entries'], 18)
+        return storage.initial_scan.addCallback(check)
+
+
+class _ContentDirectoryServer(object):
+
+    def __init__(self):
+        self.variables = []
+
+    def set_variable(self, instance, name, value):
+        self.variables.append((name, value))
+
+
+class _Server(object):
+
+    def __init__(self):
+        self.coherence = self
+        self.config = {}
+        self.content_directory_server = _ContentDirectoryServer()
+
+
+class TestFSStorageNotify(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(fs_storage, 'reactor', self.clock)
+        self.tmp_content = FilePath(self.mktemp())
+        self.album = self.tmp_content.child('album')
+        self.album.makedirs()
+        self.album.child('track-1.mp3').touch()
+        self.server = _Server()
+        self.storage = fs_storage.FSStore(self.server, name='my media',
+                                          content=self.tmp_content.path,
+                                          urlbase='http://fsstore-host/xyz',
+                                          enable_inotify=False)
+        return self.storage.initial_scan
+
+    def tearDown(self):
+        self.tmp_content.remove()
+
+    def test_batched_events(self):
+        """ the events of a bulk change are applied together,
+            and announced with one ContainerUpdateIDs value
+        """
+        album_id = self.storage.get_id_by_name('1000', self.album.path)
+        album = self.storage.get_by_id(album_id)
+        del self.server.content_directory_server.variables[:]
+
+        for n in range(2, 5):
+            self.album.child('track-%d.mp3' % n).touch()
+            self.storage.notify(None, self.album.child('track-%d.mp3' % n),
+                                inotify.IN_CREATE, album_id)
+        self.album.child('track-1.mp3').remove()
+        self.storage.notify(None, self.album.child('track-1.mp3'),
+                            inotify.IN_DELETE, album_id)
+        # created and gone again before we had a look at it
+        self.storage.notify(None, self.album.child('temp.mp3'),
+                            inotify.IN_CREATE, album_id)
+        self.storage.notify(None, self.album.child('temp.mp3'),
+                            inotify.IN_DELETE, album_id)
+        self.assertEqual(album.get_child_count(), 1)
+
+        self.clock.advance(0.5)
+        self.assertEqual(sorted(c.get_name() for c in album.get_children()),
+                         ['track-2.mp3', 'track-3.mp3', 'track-4.mp3'])
+        variables = self.server.content_directory_server.variables
+        self.assertEqual([name for name, value in variables],
+                         ['SystemUpdateID', 'ContainerUpdateIDs'])
+        self.assertEqual(variables[1][1],
+                         '%s,%s' % (album_id, album.get_update_id()))
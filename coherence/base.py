@@ -21,10 +21,14 @@ import coherence.extern.louie as louie
 
 from coherence import __version__
 from coherence import log
+from coherence import transcode_cache
 
 from coherence.upnp.core.ssdp import SSDPServer
 from coherence.upnp.core.msearch import MSearch
 from coherence.upnp.core.device import Device, RootDevice
+from coherence.upnp.core import event
+from coherence.upnp.core import description_cache
+from coherence.upnp.core import soap_proxy
 from coherence.upnp.core.utils import parse_xml, get_ip_address, get_host_address
 
 from coherence.upnp.core.utils import Site
@@ -395,6 +399,8 @@ class Coherence(log.Loggable):
         self.external_address = ':'.join((self.hostname, str(self.web_server_port)))
 
 
+        description_cache.setup(self.config.get('description_cache', 'no'))
+
         if(self.config.get('controlpoint', 'no') == 'yes' or
            self.config.get('json', 'no') == 'yes'):
             self.ctrl = ControlPoint(self)
@@ -406,6 +412,9 @@ class Coherence(log.Loggable):
         if self.config.get('transcoding', 'no') == 'yes':
             from coherence.transcoder import TranscoderManager
             self.transcoder_manager = TranscoderManager(self)
+            transcode_cache.setup(
+                self.config.get('transcode_cache', 'no'),
+                int(self.config.get('transcode_cache_size', 1024)) * 1024 * 1024)
 
         self.dbus = None
         if self.config.get('use_dbus', 'no') == 'yes':
@@ -540,8 +549,11 @@ class Coherence(log.Loggable):
             self.ssdp_server.shutdown()
             if self.ctrl:
                 self.ctrl.shutdown()
+            event.notification_pool.close()
             self.warning('Coherence UPnP framework shutdown')
-            return result
+            d = soap_proxy.close_connections()
+            d.addBoth(lambda _: result)
+            return d
 
         def _shutdown():
             self.mirabeau = None
@@ -37,6 +37,10 @@ class Dispatcher(object):
 
     __signals__ = {}
 
+    # the (deferred, signal) pairs save_emit has to deliver with the
+    # next mainloop iteration, None while no delivery is scheduled
+    _pending_emits = None
+
     def __init__(self):
         self.receivers = {}
         for signal in self.__signals__.iterkeys():
@@ -91,15 +95,27 @@ class Dispatcher(object):
         return result_dfr
 
     def save_emit(self, signal, *args, **kwargs):
+        # nobody is listening, nothing to schedule
+        if len(self._get_receivers(signal)) == 0:
+            return defer.succeed([])
         deferred = defer.Deferred()
         # run the deferred_emit in as a callback
         deferred.addCallback(self.deferred_emit, *args, **kwargs)
         # and callback the deferred with the signal as the 'result' in the
-        # next mainloop iteration
-        from twisted.internet import reactor
-        reactor.callLater(0, deferred.callback, signal)
+        # next mainloop iteration, together with all other signals
+        # emitted until then
+        if self._pending_emits is None:
+            self._pending_emits = []
+            from twisted.internet import reactor
+            reactor.callLater(0, self._emit_pending)
+        self._pending_emits.append((deferred, signal))
         return deferred
 
+    def _emit_pending(self):
+        pending, self._pending_emits = self._pending_emits, None
+        for deferred, signal in pending:
+            deferred.callback(signal)
+
     def _merge_results_and_receivers(self, result, receivers):
         # make a list of (rec1, res1), (rec2, res2), (rec3, res3) ...
         return [(receiver, result[counter])
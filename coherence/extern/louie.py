@@ -77,6 +77,13 @@ def disconnect(receiver, signal=All, sender=Any, weak=True):
     return _global_dispatcher.disconnect(receiver)
 
 
+def has_receivers(signal):
+    """ tell whether sending signal would reach anyone,
+        to spare building costly arguments
+    """
+    return len(_global_dispatcher._get_receivers(signal)) > 0
+
+
 def send(signal=All, sender=Anonymous, *arguments, **named):
     if signal in (Any, All):
         raise NotImplemented("This is not allowed. Signal HAS to be something")
@@ -84,6 +91,15 @@ def send(signal=All, sender=Anonymous, *arguments, **named):
     return _global_dispatcher.save_emit(signal, *arguments, **named)
 
 
+def send_sync(signal=All, sender=Anonymous, *arguments, **named):
+    """ call the receivers of signal right away instead of with
+        the next mainloop iteration, for internal hot paths
+    """
+    if signal in (Any, All):
+        raise NotImplemented("This is not allowed. Signal HAS to be something")
+    return _global_dispatcher.emit(signal, *arguments, **named)
+
+
 def send_minimal(signal=All, sender=Anonymous, *arguments, **named):
     return send(signal, sender, *arguments, **named)
 
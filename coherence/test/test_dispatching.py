@@ -1,6 +1,9 @@
 
+import time
+
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python import log
 from coherence.dispatcher import Dispatcher, UnknownSignal, Receiver, \
         SignalingProperty, ChangedSignalingProperty, CustomSignalingProperty
 
@@ -86,6 +89,26 @@ class TestDispatching(unittest.TestCase):
         dfr.addCallback(test, 2)
         return dfr
 
+    def test_save_emit_without_receivers(self):
+        dfr = self.dispatcher.save_emit('test')
+        self.assertTrue(dfr.called)
+        self.assertIs(self.dispatcher._pending_emits, None)
+
+    def test_save_emit_coalesced(self):
+
+        def test(res):
+            self.assertEquals(self.target.called, 3)
+            self.assertIs(self.dispatcher._pending_emits, None)
+
+        self.dispatcher.connect('test', self.target.callback)
+        dfrs = [self.dispatcher.save_emit('test') for i in range(3)]
+        # one delivery for all three
+        self.assertEquals(len(self.dispatcher._pending_emits), 3)
+        self.assertEquals(self.target.called, 0)
+        dfr = defer.DeferredList(dfrs)
+        dfr.addCallback(test)
+        return dfr
+
     def test_connect_typo(self):
         self.assertRaises(UnknownSignal, self.dispatcher.connect, 'Test', None)
 
@@ -472,3 +495,54 @@ class TestStayInObjectSignaling(unittest.TestCase):
 
         self.assertEquals(self.foo.emitted[0][1][0], 'A')
         self.assertEquals(self.bar.emitted[0][1][0], 'B')
+
+
+# Benchmark
+
+def legacy_save_emit(dispatcher, signal, *args, **kwargs):
+    """ save_emit as it was before the fast path and the coalescing """
+    deferred = defer.Deferred()
+    deferred.addCallback(dispatcher.deferred_emit, *args, **kwargs)
+    reactor.callLater(0, deferred.callback, signal)
+    return deferred
+
+
+class TestDispatchingBenchmark(unittest.TestCase):
+    """ logs the events/sec the emit variants reach to the trial log """
+
+    events = 5000
+
+    def setUp(self):
+        self.dispatcher = TestDispatcher()
+        self.target = SimpleTarget()
+
+    def measure(self, name, emit):
+        start = time.time()
+        dfrs = [emit('test', i) for i in xrange(self.events)]
+        dfr = defer.DeferredList(dfrs)
+
+        def done(result):
+            elapsed = max(time.time() - start, 1e-6)
+            log.msg('%s: %d events/sec' % (name, self.events / elapsed))
+            return result
+        dfr.addCallback(done)
+        return dfr
+
+    def test_without_receivers(self):
+        dfr = self.measure('legacy save_emit without receivers',
+                        lambda *args: legacy_save_emit(self.dispatcher, *args))
+        dfr.addCallback(lambda _: self.measure('save_emit without receivers',
+                                            self.dispatcher.save_emit))
+        return dfr
+
+    def test_with_receiver(self):
+        self.dispatcher.connect('test', lambda i: None)
+        dfr = self.measure('legacy save_emit',
+                        lambda *args: legacy_save_emit(self.dispatcher, *args))
+        dfr.addCallback(lambda _: self.measure('save_emit',
+                                            self.dispatcher.save_emit))
+
+        def emit(*args):
+            return defer.succeed(self.dispatcher.emit(*args))
+        dfr.addCallback(lambda _: self.measure('emit', emit))
+        return dfr
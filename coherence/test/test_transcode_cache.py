@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{transcode_cache}
+"""
+
+import os
+import urllib
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer
+from twisted.web import resource, server, error, client
+
+from coherence import transcode_cache
+from coherence.upnp.core import utils
+
+CONTENT = ''.join(map(chr, range(251))) * 400
+
+
+class Output(resource.Resource):
+    """ the output of a transcoder, served from the cache """
+    isLeaf = True
+
+    def __init__(self, cache, key, transcode):
+        resource.Resource.__init__(self)
+        self.cache = cache
+        self.key = key
+        self.transcode = transcode
+
+    def render(self, request):
+        output = self.cache.get(self.key, 'audio/mpeg', self.transcode)
+        return output.render(request)
+
+
+class TranscodeCacheMixin(object):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.cache = transcode_cache.TranscodeCache(self.path)
+        self.transcodes = []
+
+    def transcode(self, path):
+        """ writes the start of the output, the rest follows
+            with finish
+        """
+        with open(path, 'wb') as f:
+            f.write(CONTENT[:1000])
+        d = defer.Deferred()
+        self.transcodes.append((path, d))
+        return d
+
+    def finish(self, index=0):
+        path, d = self.transcodes[index]
+        with open(path, 'ab') as f:
+            f.write(CONTENT[1000:])
+        d.callback(None)
+
+    def transcoded(self, path):
+        with open(path, 'wb') as f:
+            f.write(CONTENT)
+
+    def source(self, name='source', data='source'):
+        path = os.path.join(self.path, '..', name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+class TestTranscodeCache(TranscodeCacheMixin, unittest.TestCase):
+
+    def test_key(self):
+        path = self.source()
+        key = self.cache.key(path, 'mp3')
+        self.assertEqual(self.cache.key('file://' + urllib.quote(path), 'mp3'),
+                         key)
+        self.assertNotEqual(self.cache.key(path, 'wav'), key)
+        self.assertNotEqual(self.cache.key(path, None, 'lame'), key)
+        self.source(data='changed')
+        self.assertNotEqual(self.cache.key(path, 'mp3'), key)
+        self.assertIs(self.cache.key('http://10.0.0.1/1.mp3', 'mp3'), None)
+        self.assertIs(self.cache.key(path + '.missing', 'mp3'), None)
+
+    def test_hit(self):
+        """ a finished output is served as a file """
+        self.cache.get('1', 'audio/mpeg', self.transcoded)
+        output = self.cache.get('1', 'audio/mpeg', self.fail)
+        self.assertIsInstance(output, utils.StaticFile)
+        with open(output.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_failed(self):
+        """ a failed transcode isn't kept """
+        self.cache.get('1', 'audio/mpeg', self.transcode)
+        path, d = self.transcodes[0]
+        d.errback(RuntimeError('no lame'))
+        self.assertFalse(os.path.exists(path))
+        self.cache.get('1', 'audio/mpeg', self.transcode)
+        self.assertEqual(len(self.transcodes), 2)
+
+    def test_eviction(self):
+        """ the least recently used outputs go first """
+        self.cache.max_size = 2 * len(CONTENT)
+        for key in ('1', '2'):
+            self.cache.get(key, 'audio/mpeg', self.transcoded)
+        self.cache.get('1', 'audio/mpeg', self.fail)
+        self.cache.get('3', 'audio/mpeg', self.transcoded)
+        self.assertEqual(self.cache._entries.keys(), ['1', '3'])
+        self.assertFalse(os.path.exists(os.path.join(self.path, '2')))
+
+    def test_on_disk(self):
+        """ finished outputs are taken over, partial ones dropped """
+        self.cache.get('1', 'audio/mpeg', self.transcoded)
+        self.cache.get('2', 'audio/mpeg', self.transcode)
+        cache = transcode_cache.TranscodeCache(self.path)
+        self.assertEqual(cache._entries.keys(), ['1'])
+        self.assertEqual(os.listdir(self.path), ['1'])
+        cache.get('1', 'audio/mpeg', self.fail)
+
+
+class TestTranscodeCacheServing(TranscodeCacheMixin, unittest.TestCase):
+    """ outputs served through HTTP """
+
+    def setUp(self):
+        TranscodeCacheMixin.setUp(self)
+        self.port = reactor.listenTCP(
+            0, server.Site(Output(self.cache, '1', self.transcode),
+                           timeout=None),
+            interface="127.0.0.1")
+        self.url = "http://127.0.0.1:%d/" % self.port.getHost().port
+
+    def tearDown(self):
+        utils.file_growth.release_idle()
+        return self.port.stopListening()
+
+    def test_shared_partial(self):
+        """ concurrent readers follow the same transcode """
+        d = defer.gatherResults([utils.getPage(self.url),
+                                 utils.getPage(self.url)])
+        reactor.callLater(0.1, self.finish)
+
+        def check(results):
+            self.assertEqual(len(self.transcodes), 1)
+            for data, headers in results:
+                self.assertEqual(data, CONTENT)
+                self.assertEqual(headers['content-type'], ['audio/mpeg'])
+            self.assertTrue(self.cache._entries['1'].complete)
+
+        d.addCallback(check)
+        return d
+
+    def test_range(self):
+        """ a finished output is served with Range support """
+        self.cache.get('1', 'audio/mpeg', self.transcoded)
+
+        def partial(failure):
+            failure.trap(error.Error)
+            self.assertEqual(failure.value.status, '206')
+            self.assertEqual(failure.value.response, CONTENT[100:200])
+
+        d = utils.getPage(self.url, headers={'range': 'bytes=100-199'})
+        d.addCallbacks(self.fail, partial)
+        return d
+
+    def test_failed_reader(self):
+        """ a reader of a failed transcode doesn't get a complete
+            response
+        """
+        d = client.Agent(reactor).request('GET', self.url)
+        d.addCallback(client.readBody)
+        reactor.callLater(0.1, lambda: self.transcodes[0][1].errback(
+            RuntimeError('no lame')))
+        return self.assertFailure(d, client.PartialDownloadError,
+                                  client.ResponseFailed)
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, defer
 
+from coherence import transcode_cache
 from coherence.transcoder import TranscoderManager, get_transcoder_name
 
 from coherence.transcoder import (PCMTranscoder, WAVTranscoder, MP3Transcoder,
         MP4Transcoder, MP2TSTranscoder, ThumbTranscoder, GStreamerTranscoder,
-        ExternalProcessPipeline)
+        ExternalProcessPipeline, ExternalProcessProtocol, ExternalProcessWriter)
 
 known_transcoders = [PCMTranscoder, WAVTranscoder, MP3Transcoder, MP4Transcoder,
         MP2TSTranscoder, ThumbTranscoder]
@@ -147,3 +151,44 @@ class TestTranscoderAutoloading(TranscoderTestMixin, TestCase):
 
         self.assertNotEquals(transcoder_a, transcoder_b)
         self.assertNotEquals(id(transcoder_a), id(transcoder_b))
+
+
+class TestExternalProcessWriter(TestCase):
+    """ outputs of external processes written to the transcode cache """
+
+    def transcode(self, command):
+        def transcode(path):
+            writer = ExternalProcessWriter(path)
+            reactor.spawnProcess(ExternalProcessProtocol(writer),
+                                 '/bin/sh', ['sh', '-c', command], {})
+            return writer.finished
+        return transcode
+
+    def test_done(self):
+        path = self.mktemp()
+        d = self.transcode('echo output')(path)
+
+        def check(name):
+            self.assertEqual(name, path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), 'output\n')
+        return d.addCallback(check)
+
+    def test_killed(self):
+        """ a process killed by a signal fails the transcode and
+            its partial output is dropped
+        """
+        cache = transcode_cache.TranscodeCache(self.mktemp())
+        finished = []
+
+        def transcode(path):
+            finished.append(self.transcode('echo part; kill -9 $$')(path))
+            return finished[0]
+        cache.get('1', 'audio/mpeg', transcode)
+
+        def check(ignored):
+            self.assertNotIn('1', cache._entries)
+            self.assertFalse(os.path.exists(
+                os.path.join(cache.path, '1' + transcode_cache.PARTIAL)))
+        # after the callbacks of the cache
+        return finished[0].addCallback(check)
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+An on-disk cache of transcoded outputs, shared by all transcoders.
+
+An output is stored content-addressed, by the SHA-1 of the source path,
+its modification time and size plus the name and pipeline of the
+transcoder, so a changed source gets transcoded again. A replay, a seek
+or a second renderer asking for the same output is served from the
+cache, a finished output through the regular file path with Range
+support. An output still being produced is shared by all its readers,
+each one following the growing file until the transcode is done.
+
+The finished outputs are evicted least recently used first, once they
+take more than the maximum size together.
+
+The cache is enabled with the 'transcode_cache' option of Coherence:
+'yes' stores the outputs below ~/.coherence/transcodes and any other
+value but 'no' is taken as the directory to store them in. The
+'transcode_cache_size' option is the maximum size in MiB.
+"""
+
+import os
+import sys
+import stat
+import urllib
+from hashlib import sha1
+from collections import OrderedDict
+
+from twisted.internet import defer
+from twisted.web import resource, server
+
+from coherence import log
+from coherence.upnp.core import utils
+
+# bytes the finished outputs may take together
+MAX_SIZE = 1024 * 1024 * 1024
+
+# suffix of an output still being produced
+PARTIAL = '.part'
+
+cache = None
+
+
+def source_path(uri):
+    """ the path of the local file at uri, or None """
+    if uri.startswith('file://'):
+        return urllib.unquote(uri[7:])
+    if '://' in uri:
+        return None
+    return uri
+
+
+class CacheEntry(object):
+    """ the output with digest key, complete or still growing
+        at partial_path
+    """
+
+    def __init__(self, path, key, content_type):
+        self.key = key
+        self.path = os.path.join(path, key)
+        self.partial_path = self.path + PARTIAL
+        self.content_type = content_type
+        self.size = 0
+        self.complete = False
+        self.failed = False
+        self._waiting = []
+
+    def wait(self, callback):
+        """ call callback once the transcode is done,
+            returns a function cancelling the wait
+        """
+        self._waiting.append(callback)
+        return lambda: callback in self._waiting and \
+                       self._waiting.remove(callback)
+
+    def done(self):
+        waiting, self._waiting = self._waiting, []
+        for callback in waiting:
+            callback()
+
+    def resource(self):
+        if self.complete:
+            return utils.StaticFile(self.path, defaultType=self.content_type)
+        return PartialOutput(self)
+
+
+class PartialOutputProducer(utils.SendfileProducer):
+    """ follows an output until its transcode is done """
+
+    def __init__(self, request, fileObject, entry):
+        utils.SendfileProducer.__init__(self, request, fileObject,
+                                        0, sys.maxint, growing=True)
+        self.entry = entry
+
+    def _wait(self):
+        if self.entry.failed:
+            # the reader must not take a truncated output as complete
+            self._abort()
+            return None
+        if self.entry.complete:
+            # everything written is read
+            self._done()
+            return None
+        cancels = []
+
+        def wake():
+            cancel()
+            self.resumeProducing()
+
+        def cancel():
+            for c in cancels:
+                c()
+
+        cancels.append(utils.file_growth.wait(self.fileObject.name, wake))
+        cancels.append(self.entry.wait(wake))
+        return cancel
+
+
+class PartialOutput(resource.Resource, log.Loggable):
+    """ the output of a transcode in progress """
+    logCategory = 'transcode_cache'
+    isLeaf = True
+
+    def __init__(self, entry):
+        resource.Resource.__init__(self)
+        log.Loggable.__init__(self)
+        self.entry = entry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', self.entry.content_type)
+        if request.method == 'HEAD':
+            return ''
+        try:
+            f = open(self.entry.partial_path, 'rb')
+        except IOError, msg:
+            if self.entry.complete:
+                # finished meanwhile
+                return self.entry.resource().render(request)
+            self.warning("can't read %s: %s", self.entry.partial_path, msg)
+            request.setResponseCode(404)
+            return ''
+        PartialOutputProducer(request, f, self.entry).start()
+        return server.NOT_DONE_YET
+
+
+class TranscodeCache(log.Loggable):
+    """ transcoded outputs by digest, kept in directory path
+        with at most max_size bytes of finished ones
+    """
+    logCategory = 'transcode_cache'
+
+    def __init__(self, path, max_size=MAX_SIZE):
+        log.Loggable.__init__(self)
+        self.path = path
+        self.max_size = max_size
+        self._entries = OrderedDict()   # digest -> CacheEntry, oldest first
+        self._size = 0                  # of the finished outputs
+        self._load()
+
+    def _load(self):
+        """ take over the finished outputs of an earlier run, in
+            the order they were used, the partial ones are dropped
+        """
+        found = []
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                if name.endswith(PARTIAL):
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                if stat.S_ISREG(st.st_mode):
+                    found.append((st.st_mtime, name, st.st_size))
+        except OSError, msg:
+            self.warning("can't read the transcode cache in %s: %s",
+                         self.path, msg)
+        for mtime, key, size in sorted(found):
+            # the content type is set again by the next get
+            entry = CacheEntry(self.path, key, 'application/octet-stream')
+            entry.size = size
+            entry.complete = True
+            self._entries[key] = entry
+            self._size += size
+        self._evict()
+
+    def key(self, uri, name, pipeline=None):
+        """ the digest of the output of the transcoder name with
+            pipeline for the local file at uri, None for anything
+            that isn't a local file
+        """
+        path = source_path(uri)
+        if path is None:
+            return None
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return sha1(repr((path, st.st_mtime, st.st_size,
+                          name, pipeline))).hexdigest()
+
+    def get(self, key, content_type, transcode):
+        """ a resource serving the output with digest key
+
+            Without one transcode is called with the path to write
+            the output to, returning a Deferred firing once the
+            output is complete.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            entry = CacheEntry(self.path, key, content_type)
+            self._entries[key] = entry
+            self.info("transcoding into %s", entry.partial_path)
+            d = defer.maybeDeferred(transcode, entry.partial_path)
+            d.addCallbacks(self._finished, self._failed,
+                           callbackArgs=(entry,), errbackArgs=(entry,))
+        else:
+            self.debug("%s taken from the cache", key)
+            self._entries[key] = entry
+            entry.content_type = content_type
+            if entry.complete:
+                try:
+                    os.utime(entry.path, None)
+                except OSError:
+                    pass
+        return entry.resource()
+
+    def _finished(self, result, entry):
+        try:
+            os.rename(entry.partial_path, entry.path)
+            entry.size = os.path.getsize(entry.path)
+        except OSError, msg:
+            return self._failed(msg, entry)
+        self.info("transcoded %s, %d bytes", entry.path, entry.size)
+        entry.complete = True
+        self._size += entry.size
+        entry.done()
+        self._evict()
+
+    def _failed(self, reason, entry):
+        self.warning("transcoding into %s failed: %s",
+                     entry.partial_path, reason)
+        entry.failed = True
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        try:
+            os.remove(entry.partial_path)
+        except OSError:
+            pass
+        entry.done()
+
+    def _evict(self):
+        for key, entry in self._entries.items():
+            if self._size <= self.max_size:
+                break
+            if not entry.complete:
+                continue
+            self.info("evicting %s, %d bytes", entry.path, entry.size)
+            del self._entries[key]
+            self._size -= entry.size
+            try:
+                # readers keep their open file
+                os.remove(entry.path)
+            except OSError, msg:
+                self.warning("can't remove %s: %s", entry.path, msg)
+
+
+def setup(option, max_size=MAX_SIZE):
+    """ set up the module cache according to the
+        'transcode_cache' option
+    """
+    global cache
+    if option in (None, 'no'):
+        cache = None
+    elif option == 'yes':
+        cache = TranscodeCache(os.path.expanduser(
+            os.path.join('~', '.coherence', 'transcodes')), max_size)
+    else:
+        cache = TranscodeCache(option, max_size)
+    return cache
@@ -22,9 +22,11 @@ import os.path
 import urllib
 
 from twisted.web import resource, server
-from twisted.internet import protocol
+from twisted.internet import protocol, defer
+from twisted.internet.error import ProcessDone
 
 from coherence import log
+from coherence import transcode_cache
 
 import struct
 
@@ -110,7 +112,7 @@ class DataSink(gst.Element, log.Loggable):
                                         gst.PAD_ALWAYS,
                                         gst.caps_new_any())
 
-    def __init__(self, destination=None, request=None):
+    def __init__(self, destination=None, request=None, done=None):
         gst.Element.__init__(self)
         log.Loggable.__init__(self)
         self.sinkpad = gst.Pad(self._sinkpadtemplate, "sink")
@@ -120,6 +122,8 @@ class DataSink(gst.Element, log.Loggable):
         self.sinkpad.set_event_function(self.eventfunc)
         self.destination = destination
         self.request = request
+        # called in the reactor thread once the destination is written
+        self.done = done
 
         if self.destination is not None:
             self.destination = open(self.destination, 'wb')
@@ -153,6 +157,9 @@ class DataSink(gst.Element, log.Loggable):
         elif event.type == gst.EVENT_EOS:
             if self.destination is not None:
                 self.destination.close()
+                if self.done is not None:
+                    from twisted.internet import reactor
+                    reactor.callFromThread(self.done)
             elif self.request is not None:
                 if len(self.buffer) > 0:
                     self.request.write(self.buffer)
@@ -300,12 +307,17 @@ class BaseTranscoder(resource.Resource, log.Loggable):
     logCategory = 'transcoder'
     addSlash = True
 
+    # whether the output only depends on the source
+    # and may be served from the transcode cache
+    cacheable = True
+
     def __init__(self, uri, destination=None):
         self.info('uri %s %r', uri, type(uri))
         if uri[:7] not in ['file://', 'http://']:
             uri = 'file://' + urllib.quote(uri)   # FIXME
         self.uri = uri
         self.destination = destination
+        self.finished = None
         resource.Resource.__init__(self)
         log.Loggable.__init__(self)
 
@@ -315,6 +327,15 @@ class BaseTranscoder(resource.Resource, log.Loggable):
 
     def render_GET(self, request):
         self.info('render GET %r', request)
+        cache = transcode_cache.cache
+        if cache is not None and self.cacheable:
+            key = cache.key(self.uri, getattr(self, 'name', None),
+                            getattr(self, 'pipeline_description', None))
+            if key is not None:
+                output = cache.get(key, getattr(self, 'contentType',
+                                           'application/octet-stream'),
+                                   self.transcode)
+                return output.render(request)
         request.setResponseCode(200)
         if hasattr(self, 'contentType'):
             request.setHeader('Content-Type', self.contentType)
@@ -334,6 +355,51 @@ class BaseTranscoder(resource.Resource, log.Loggable):
         request.setHeader('Content-Type', self.contentType)
         request.write('')
 
+    def transcode(self, path):
+        """ transcode into the file at path, the returned
+            Deferred fires once the output is complete
+        """
+        self.destination = path
+        self.finished = defer.Deferred()
+        self.start()
+        return self.finished
+
+    def make_sink(self, request):
+        """ the DataSink writing the output of the pipeline
+            to the destination or the request
+        """
+        done = None
+        if self.finished is not None:
+            self.pipeline.get_bus().set_sync_handler(self.on_sync_message)
+            done = self.transcoded
+        return DataSink(destination=self.destination, request=request,
+                        done=done)
+
+    def watch_request(self, request):
+        if request is not None:
+            d = request.notifyFinish()
+            d.addBoth(self.requestFinished)
+
+    def transcoded(self):
+        self.cleanup()
+        finished, self.finished = self.finished, None
+        if finished is not None:
+            finished.callback(self.destination)
+
+    def transcode_failed(self, error):
+        self.cleanup()
+        finished, self.finished = self.finished, None
+        if finished is not None:
+            finished.errback(RuntimeError(str(error)))
+
+    def on_sync_message(self, bus, message):
+        """ called in the streaming thread """
+        if message.type == gst.MESSAGE_ERROR:
+            error, debug = message.parse_error()
+            from twisted.internet import reactor
+            reactor.callFromThread(self.transcode_failed, error)
+        return gst.BUS_PASS
+
     def requestFinished(self, result):
         self.info("requestFinished %r", result)
         """ we need to find a way to destroy the pipeline here
@@ -373,13 +439,12 @@ class PCMTranscoder(BaseTranscoder, InternalTranscoder):
         self.pipeline.add(filter)
         conv.link(filter)
 
-        sink = DataSink(destination=self.destination, request=request)
+        sink = self.make_sink(request)
         self.pipeline.add(sink)
         filter.link(sink)
         self.pipeline.set_state(gst.STATE_PLAYING)
 
-        d = request.notifyFinish()
-        d.addBoth(self.requestFinished)
+        self.watch_request(request)
 
 
 class WAVTranscoder(BaseTranscoder, InternalTranscoder):
@@ -392,15 +457,14 @@ class WAVTranscoder(BaseTranscoder, InternalTranscoder):
         self.pipeline = gst.parse_launch(
             "%s ! decodebin ! audioconvert ! wavenc name=enc" % self.uri)
         enc = self.pipeline.get_by_name('enc')
-        sink = DataSink(destination=self.destination, request=request)
+        sink = self.make_sink(request)
         self.pipeline.add(sink)
         enc.link(sink)
         #bus = self.pipeline.get_bus()
         #bus.connect('message', self.on_message)
         self.pipeline.set_state(gst.STATE_PLAYING)
 
-        d = request.notifyFinish()
-        d.addBoth(self.requestFinished)
+        self.watch_request(request)
 
 
 class MP3Transcoder(BaseTranscoder, InternalTranscoder):
@@ -413,13 +477,12 @@ class MP3Transcoder(BaseTranscoder, InternalTranscoder):
         self.pipeline = gst.parse_launch(
             "%s ! decodebin ! audioconvert ! lame name=enc" % self.uri)
         enc = self.pipeline.get_by_name('enc')
-        sink = DataSink(destination=self.destination, request=request)
+        sink = self.make_sink(request)
         self.pipeline.add(sink)
         enc.link(sink)
         self.pipeline.set_state(gst.STATE_PLAYING)
 
-        d = request.notifyFinish()
-        d.addBoth(self.requestFinished)
+        self.watch_request(request)
 
 
 class MP4Transcoder(BaseTranscoder, InternalTranscoder):
@@ -434,13 +497,12 @@ class MP4Transcoder(BaseTranscoder, InternalTranscoder):
         self.pipeline = gst.parse_launch(
             "%s ! qtdemux name=d ! queue ! h264parse ! mp4mux name=mux d. ! queue ! mux." % self.uri)
         mux = self.pipeline.get_by_name('mux')
-        sink = DataSink(destination=self.destination, request=request)
+        sink = self.make_sink(request)
         self.pipeline.add(sink)
         mux.link(sink)
         self.pipeline.set_state(gst.STATE_PLAYING)
 
-        d = request.notifyFinish()
-        d.addBoth(self.requestFinished)
+        self.watch_request(request)
 
 
 class MP2TSTranscoder(BaseTranscoder, InternalTranscoder):
@@ -454,13 +516,12 @@ class MP2TSTranscoder(BaseTranscoder, InternalTranscoder):
         self.pipeline = gst.parse_launch(
             "mpegtsmux name=mux %s ! decodebin2 name=d ! queue ! ffmpegcolorspace ! mpeg2enc ! queue ! mux. d. ! queue ! audioconvert ! twolame ! queue ! mux." % self.uri)
         enc = self.pipeline.get_by_name('mux')
-        sink = DataSink(destination=self.destination, request=request)
+        sink = self.make_sink(request)
         self.pipeline.add(sink)
         enc.link(sink)
         self.pipeline.set_state(gst.STATE_PLAYING)
 
-        d = request.notifyFinish()
-        d.addBoth(self.requestFinished)
+        self.watch_request(request)
 
 
 class ThumbTranscoder(BaseTranscoder, InternalTranscoder):
@@ -469,6 +530,8 @@ class ThumbTranscoder(BaseTranscoder, InternalTranscoder):
     """
     contentType = 'image/jpeg'
     name = 'thumb'
+    # the size and type are taken from the request
+    cacheable = False
 
     def start(self, request=None):
         self.info("start %r", request)
@@ -499,13 +562,12 @@ class ThumbTranscoder(BaseTranscoder, InternalTranscoder):
                 "%s ! decodebin2 ! videoscale ! video/x-raw-yuv,width=160,height=160 ! jpegenc name=enc" % self.uri)
             self.contentType = 'image/jpeg'
         enc = self.pipeline.get_by_name('enc')
-        sink = DataSink(destination=self.destination, request=request)
+        sink = self.make_sink(request)
         self.pipeline.add(sink)
         enc.link(sink)
         self.pipeline.set_state(gst.STATE_PLAYING)
 
-        d = request.notifyFinish()
-        d.addBoth(self.requestFinished)
+        self.watch_request(request)
 
 
 class GStreamerTranscoder(BaseTranscoder):
@@ -523,13 +585,12 @@ class GStreamerTranscoder(BaseTranscoder):
         self.info("start %r", request)
         self.pipeline = gst.parse_launch(self.pipeline_description % self.uri)
         enc = self.pipeline.get_by_name('mux')
-        sink = DataSink(destination=self.destination, request=request)
+        sink = self.make_sink(request)
         self.pipeline.add(sink)
         enc.link(sink)
         self.pipeline.set_state(gst.STATE_PLAYING)
 
-        d = request.notifyFinish()
-        d.addBoth(self.requestFinished)
+        self.watch_request(request)
 
 
 class ExternalProcessProtocol(protocol.ProcessProtocol):
@@ -538,7 +599,7 @@ class ExternalProcessProtocol(protocol.ProcessProtocol):
         self.caller = caller
 
     def connectionMade(self):
-        print "pp connection made"
+        self.caller.debug("pp connection made")
 
     def outReceived(self, data):
         #print "outReceived with %d bytes!" % len(data)
@@ -546,7 +607,7 @@ class ExternalProcessProtocol(protocol.ProcessProtocol):
 
     def errReceived(self, data):
         #print "errReceived! with %d bytes!" % len(data)
-        print "pp (err):", data.strip()
+        self.caller.info("pp (err): %s", data.strip())
 
     def inConnectionLost(self):
         #print "inConnectionLost! stdin is closed! (we probably did it)"
@@ -561,16 +622,55 @@ class ExternalProcessProtocol(protocol.ProcessProtocol):
         pass
 
     def processEnded(self, status_object):
-        print "processEnded, status %d" % status_object.value.exitCode
-        print "processEnded quitting"
+        # a process killed by a signal has no exit code
+        self.caller.info("processEnded, status %r", status_object.value)
+        self.caller.status = status_object
         self.caller.ended = True
         self.caller.write_data('')
 
 
-class ExternalProcessProducer(object):
+def spawn_external_process(pipeline, caller):
+    """ start the command line pipeline, with caller
+        getting its output
+    """
+    argv = pipeline.split()
+    executable = argv[0]
+    argv[0] = os.path.basename(argv[0])
+    from twisted.internet import reactor
+    return reactor.spawnProcess(ExternalProcessProtocol(caller),
+                                executable, argv, {})
+
+
+class ExternalProcessWriter(log.Loggable):
+    """ writes the output of an external process to the file at
+        path, finished fires once the process ended, failing unless
+        it exited with 0
+    """
+    logCategory = 'externalprocess'
+
+    def __init__(self, path):
+        log.Loggable.__init__(self)
+        self.file = open(path, 'wb')
+        self.finished = defer.Deferred()
+        self.status = None
+        self.ended = False
+
+    def write_data(self, data):
+        if data:
+            self.file.write(data)
+        if self.ended:
+            self.file.close()
+            if self.status.check(ProcessDone):
+                self.finished.callback(self.file.name)
+            else:
+                self.finished.errback(self.status)
+
+
+class ExternalProcessProducer(log.Loggable):
     logCategory = 'externalprocess'
 
     def __init__(self, pipeline, request):
+        log.Loggable.__init__(self)
         self.pipeline = pipeline
         self.request = request
         self.process = None
@@ -597,12 +697,7 @@ class ExternalProcessProducer(object):
         if not self.request:
             return
         if self.process is None:
-            argv = self.pipeline.split()
-            executable = argv[0]
-            argv[0] = os.path.basename(argv[0])
-            from twisted.internet import reactor
-            self.process = reactor.spawnProcess(ExternalProcessProtocol(self),
-                    executable, argv, {})
+            self.process = spawn_external_process(self.pipeline, self)
 
     def pauseProducing(self):
         pass
@@ -629,6 +724,14 @@ class ExternalProcessPipeline(resource.Resource, log.Loggable):
 
     def render(self, request):
         print "ExternalProcessPipeline render"
+        cache = transcode_cache.cache
+        if cache is not None:
+            key = cache.key(self.uri, None, self.pipeline_description)
+            if key is not None:
+                output = cache.get(key, getattr(self, 'contentType',
+                                           'application/octet-stream'),
+                                   self.transcode)
+                return output.render(request)
         try:
             if self.contentType:
                 request.setHeader('Content-Type', self.contentType)
@@ -638,6 +741,14 @@ class ExternalProcessPipeline(resource.Resource, log.Loggable):
         ExternalProcessProducer(self.pipeline_description % self.uri, request)
         return server.NOT_DONE_YET
 
+    def transcode(self, path):
+        """ run the pipeline with its output going into the file at
+            path, the returned Deferred fires once it ended
+        """
+        writer = ExternalProcessWriter(path)
+        spawn_external_process(self.pipeline_description % self.uri, writer)
+        return writer.finished
+
 
 def transcoder_class_wrapper(klass, content_type, pipeline):
     def create_object(uri):
@@ -12,8 +12,10 @@ TODO:
 
 """
 import os
+import re
 import urllib
 from datetime import datetime
+from xml.sax.saxutils import escape
 
 DC_NS = 'http://purl.org/dc/elements/1.1/'
 UPNP_NS = 'urn:schemas-upnp-org:metadata-1-0/upnp/'
@@ -70,6 +72,95 @@ def is_video(mimetype):
     return False
 
 
+# the properties a DIDL-Lite object always carries, whatever
+# the Filter of a Browse or Search request says
+REQUIRED_PROPERTIES = frozenset(('@id', '@parentID', '@restricted',
+                                 'dc:title', 'upnp:class'))
+
+_parsed_filters = {}
+
+
+def parse_filter(filter):
+    """ converts the Filter argument of a Browse or Search request
+        into the set of property names to include,
+        or None when all properties are wanted
+    """
+    if filter is None:
+        return None
+    try:
+        return _parsed_filters[filter]
+    except KeyError:
+        pass
+    names = [f.strip() for f in filter.split(',')]
+    if '*' in names:
+        wanted = None
+    else:
+        wanted = set(REQUIRED_PROPERTIES)
+        for name in names:
+            if len(name) == 0:
+                continue
+            wanted.add(name)
+            if name.startswith('res@'):
+                # a res attribute implies the res element itself
+                wanted.add('res')
+            elif '@' in name:
+                wanted.add(name.split('@', 1)[0])
+        wanted = frozenset(wanted)
+    if len(_parsed_filters) > 64:
+        _parsed_filters.clear()
+    _parsed_filters[filter] = wanted
+    return wanted
+
+
+def filteredTextElement(wanted, parent, tag, namespace, text):
+    """ create a subelement with text content, unless the text is None
+        or the property isn't in the set of wanted properties
+    """
+    if text is None:
+        return None
+    if wanted is not None:
+        if namespace in my_namespaces:
+            name = '%s:%s' % (my_namespaces[namespace], tag)
+        else:
+            name = tag
+        if name not in wanted:
+            return None
+    return textElement(parent, tag, namespace, text)
+
+
+# the namespace declarations ET puts on the root of a serialized element
+_xmlns_re = re.compile(r' xmlns:(\w+)="([^"]*)"')
+
+MAX_CACHED_FRAGMENTS = 16
+
+
+def serialize_fragment(element):
+    """ serialize an element for embedding into a DIDL-Lite document,
+        returns the serialized element without the declarations
+        of our well-known namespaces, and the prefixes of these
+        namespaces it uses
+    """
+    data = ET.tostring(element, encoding='utf-8')
+    end = data.index('>')
+    prefixes = set()
+
+    def strip(m):
+        prefix, uri = m.groups()
+        if my_namespaces.get(uri) != prefix:
+            return m.group(0)
+        prefixes.add(prefix)
+        return ''
+
+    head = _xmlns_re.sub(strip, data[:end])
+    return head + data[end:], tuple(sorted(prefixes))
+
+
+def _escape_attribute(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return escape(value, {'"': '&quot;'})
+
+
 class Resources(list):
 
     """ a list of resources, always sorted after an append """
@@ -270,10 +361,12 @@ class Resource(object):
 
         root.text = self.data
 
+        wanted = kwargs.get('filter', None)
         for attrname in self.__attributes:
             val = getattr(self, attrname, None)
             if val is not None:
-                root.attrib[attrname] = str(val)
+                if wanted is None or 'res@' + attrname in wanted:
+                    root.attrib[attrname] = str(val)
 
         return root
 
@@ -384,6 +477,8 @@ class Object(log.Loggable):
     refID = None
     server_uuid = None
 
+    _fragments = None
+
     def __init__(self, id=None, parentID=None, title=None, restricted=False,
                        creator=None):
         log.Loggable.__init__(self)
@@ -468,37 +563,64 @@ class Object(log.Loggable):
         else:
             root.attrib['restricted'] = '0'
 
-        textElementIfNotNone(root, 'creator', DC_NS, self.creator)
-        textElementIfNotNone(root, 'writeStatus', UPNP_NS, self.writeStatus)
+        wanted = kwargs.get('filter', None)
+        filteredTextElement(wanted, root, 'creator', DC_NS, self.creator)
+        filteredTextElement(wanted, root, 'writeStatus', UPNP_NS, self.writeStatus)
 
         if self.date is not None:
             if isinstance(self.date, datetime):
-                textElement(root, 'date', DC_NS, self.date.isoformat())
+                filteredTextElement(wanted, root, 'date', DC_NS, self.date.isoformat())
             else:
-                textElement(root, 'date', DC_NS, self.date)
-        else:
+                filteredTextElement(wanted, root, 'date', DC_NS, self.date)
+        elif wanted is None or 'dc:date' in wanted:
             textElement(root, 'date', DC_NS, utils.datefaker().isoformat())
 
-        if self.albumArtURI is not None:
-            e = textElement(root, 'albumArtURI', UPNP_NS, self.albumArtURI)
+        e = filteredTextElement(wanted, root, 'albumArtURI', UPNP_NS, self.albumArtURI)
+        if e is not None:
             e.attrib['dlna:profileID'] = 'JPEG_TN'
 
-        textElementIfNotNone(root, 'artist', UPNP_NS, self.artist)
-        textElementIfNotNone(root, 'genre', UPNP_NS, self.genre)
+        filteredTextElement(wanted, root, 'artist', UPNP_NS, self.artist)
+        filteredTextElement(wanted, root, 'genre', UPNP_NS, self.genre)
 
         if self.genres is not None:
             for genre in self.genres:
-                textElement(root, 'genre', UPNP_NS, genre)
+                filteredTextElement(wanted, root, 'genre', UPNP_NS, genre)
 
-        textElementIfNotNone(root, 'originalTrackNumber', UPNP_NS, self.originalTrackNumber)
-        textElementIfNotNone(root, 'description', DC_NS, self.description)
-        textElementIfNotNone(root, 'longDescription', UPNP_NS, self.longDescription)
-        textElementIfNotNone(root, 'server_uuid', UPNP_NS, self.server_uuid)
+        filteredTextElement(wanted, root, 'originalTrackNumber', UPNP_NS, self.originalTrackNumber)
+        filteredTextElement(wanted, root, 'description', DC_NS, self.description)
+        filteredTextElement(wanted, root, 'longDescription', UPNP_NS, self.longDescription)
+        filteredTextElement(wanted, root, 'server_uuid', UPNP_NS, self.server_uuid)
         return root
 
     def toString(self, **kwargs):
         return ET.tostring(self.toElement(**kwargs), encoding='utf-8')
 
+    def toFragment(self, version, **kwargs):
+        """ returns the serialized element of this object,
+            as L{serialize_fragment} does
+
+            the result is cached per client profile - the keyword
+            arguments of toElement - and reused as long as
+            I{version} stays the same
+        """
+        key = (kwargs.get('upnp_client', ''),
+               kwargs.get('parent_container', None),
+               kwargs.get('requested_id', None),
+               kwargs.get('transcoding', False),
+               kwargs.get('filter', None))
+        if self._fragments is None:
+            self._fragments = {}
+        try:
+            cached_version, fragment = self._fragments[key]
+            if cached_version == version:
+                return fragment
+        except KeyError:
+            if len(self._fragments) >= MAX_CACHED_FRAGMENTS:
+                self._fragments.clear()
+        fragment = serialize_fragment(self.toElement(**kwargs))
+        self._fragments[key] = (version, fragment)
+        return fragment
+
     def fromElement(self, elt):
         """
         TODO:
@@ -543,7 +665,8 @@ class Object(log.Loggable):
             elif child.tag.endswith('server_uuid'):
                 self.server_uuid = child.text
             elif child.tag.endswith('res'):
-                res = Resource.fromString(ET.tostring(child))
+                res = Resource()
+                res.fromElement(child)
                 self.res.append(res)
 
     @classmethod
@@ -574,16 +697,21 @@ class Item(Object):
 
         root = Object.toElement(self, **kwargs)
 
-        textElementIfNotNone(root, 'director', UPNP_NS, self.director)
-        textElementIfNotNone(root, 'refID', None, self.refID)
+        wanted = kwargs.get('filter', None)
+        filteredTextElement(wanted, root, 'director', UPNP_NS, self.director)
+        filteredTextElement(wanted, root, 'refID', None, self.refID)
 
         if self.actors is not None:
             for actor in self.actors:
-                textElement(root, 'actor', DC_NS, actor)
+                filteredTextElement(wanted, root, 'actor', DC_NS, actor)
 
         #if self.language is not None:
         #    ET.SubElement(root, qname('language',DC_NS)).text = self.language
 
+        if wanted is not None and 'res' not in wanted:
+            # the client asked us to leave out the resources
+            return root
+
         if kwargs.get('transcoding', False) == True:
             res = self.res.get_matching(['*:*:*:*'], protocol_type='http-get')
             if len(res) > 0 and is_audio(res[0].protocolInfo):
@@ -635,10 +763,11 @@ class ImageItem(Item):
 
     def toElement(self, **kwargs):
         root = Item.toElement(self, **kwargs)
-        textElementIfNotNone(root, 'rating', UPNP_NS, self.rating)
-        textElementIfNotNone(root, 'storageMedium', UPNP_NS, self.storageMedium)
-        textElementIfNotNone(root, 'publisher', DC_NS, self.publisher)
-        textElementIfNotNone(root, 'rights', DC_NS, self.rights)
+        wanted = kwargs.get('filter', None)
+        filteredTextElement(wanted, root, 'rating', UPNP_NS, self.rating)
+        filteredTextElement(wanted, root, 'storageMedium', UPNP_NS, self.storageMedium)
+        filteredTextElement(wanted, root, 'publisher', DC_NS, self.publisher)
+        filteredTextElement(wanted, root, 'rights', DC_NS, self.rights)
         return root
 
 
@@ -648,7 +777,7 @@ class Photo(ImageItem):
 
     def toElement(self, **kwargs):
         root = ImageItem.toElement(self, **kwargs)
-        textElementIfNotNone(root, 'album', UPNP_NS, self.album)
+        filteredTextElement(kwargs.get('filter', None), root, 'album', UPNP_NS, self.album)
         return root
 
 
@@ -668,10 +797,11 @@ class AudioItem(Item):
     #@dlna.AudioItem
     def toElement(self, **kwargs):
         root = Item.toElement(self, **kwargs)
-        textElementIfNotNone(root, 'publisher', DC_NS, self.publisher)
-        textElementIfNotNone(root, 'language', DC_NS, self.language)
-        textElementIfNotNone(root, 'relation', DC_NS, self.relation)
-        textElementIfNotNone(root, 'rights', DC_NS, self.rights)
+        wanted = kwargs.get('filter', None)
+        filteredTextElement(wanted, root, 'publisher', DC_NS, self.publisher)
+        filteredTextElement(wanted, root, 'language', DC_NS, self.language)
+        filteredTextElement(wanted, root, 'relation', DC_NS, self.relation)
+        filteredTextElement(wanted, root, 'rights', DC_NS, self.rights)
         return root
 
     def fromElement(self, elt):
@@ -695,10 +825,11 @@ class MusicTrack(AudioItem):
 
     def toElement(self, **kwargs):
         root = AudioItem.toElement(self, **kwargs)
-        textElementIfNotNone(root, 'album', UPNP_NS, self.album)
-        textElementIfNotNone(root, 'playlist', UPNP_NS, self.playlist)
-        textElementIfNotNone(root, 'storageMedium', UPNP_NS, self.storageMedium)
-        textElementIfNotNone(root, 'contributor', DC_NS, self.contributor)
+        wanted = kwargs.get('filter', None)
+        filteredTextElement(wanted, root, 'album', UPNP_NS, self.album)
+        filteredTextElement(wanted, root, 'playlist', UPNP_NS, self.playlist)
+        filteredTextElement(wanted, root, 'storageMedium', UPNP_NS, self.storageMedium)
+        filteredTextElement(wanted, root, 'contributor', DC_NS, self.contributor)
         return root
 
 
@@ -720,10 +851,11 @@ class VideoItem(Item):
 
     def toElement(self, **kwargs):
         root = Item.toElement(self, **kwargs)
+        wanted = kwargs.get('filter', None)
         for attr_name, ns in self.valid_attrs.iteritems():
             value = getattr(self, attr_name, None)
             if value:
-                textElement(root, attr_name, ns, value)
+                filteredTextElement(wanted, root, attr_name, ns, value)
         return root
 
     def fromElement(self, elt):
@@ -783,13 +915,15 @@ class Container(Object):
         if self.childCount is not None:
             root.attrib['childCount'] = str(self.childCount)
 
-        textElementIfNotNone(root, 'createclass', UPNP_NS, self.createClass)
+        wanted = kwargs.get('filter', None)
+        filteredTextElement(wanted, root, 'createclass', UPNP_NS, self.createClass)
 
         if not isinstance(self.searchClass, (list, tuple)):
             self.searchClass = [self.searchClass]
         for i in self.searchClass:
-            sc = textElement(root, 'searchClass', UPNP_NS, i)
-            sc.attrib['includeDerived'] = '1'
+            sc = filteredTextElement(wanted, root, 'searchClass', UPNP_NS, i)
+            if sc is not None:
+                sc.attrib['includeDerived'] = '1'
 
         if self.searchable is not None:
             if self.searchable in (1, '1', True, 'true', 'True'):
@@ -797,8 +931,9 @@ class Container(Object):
             else:
                 root.attrib['searchable'] = '0'
 
-        for res in self.res:
-            root.append(res.toElement(**kwargs))
+        if wanted is None or 'res' in wanted:
+            for res in self.res:
+                root.append(res.toElement(**kwargs))
         return root
 
     def fromElement(self, elt):
@@ -864,13 +999,23 @@ class StorageFolder(Container):
     upnp_class = Container.upnp_class + '.storageFolder'
 
 
+class _Fragment(ElementInterface):
+
+    """ stands in for the element of an already serialized object """
+
+    def __init__(self, data, prefixes):
+        ElementInterface.__init__(self, 'fragment', {})
+        self.data = data
+        self.prefixes = prefixes
+
+
 class DIDLElement(ElementInterface, log.Loggable):
 
     logCategory = 'didllite'
 
     def __init__(self, upnp_client='',
                  parent_container=None, requested_id=None,
-                 transcoding=False):
+                 transcoding=False, filter=None):
         ElementInterface.__init__(self, 'DIDL-Lite', {})
         log.Loggable.__init__(self)
         self.attrib['xmlns'] = 'urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/'
@@ -879,16 +1024,31 @@ class DIDLElement(ElementInterface, log.Loggable):
         self.parent_container = parent_container
         self.requested_id = requested_id
         self.transcoding = transcoding
+        self.filter = parse_filter(filter)
 
     def addContainer(self, id, parentID, title, restricted=False):
         e = Container(id, parentID, title, restricted, creator='')
         self.append(e.toElement())
 
-    def addItem(self, item):
-        self.append(item.toElement(upnp_client=self.upnp_client,
-                                   parent_container=self.parent_container,
-                                   requested_id=self.requested_id,
-                                   transcoding=self.transcoding))
+    def addItem(self, item, update_id=None):
+        """ add a DIDLLite object to the result
+
+            when an I{update_id} is given, the serialized object
+            is taken from the cache of the object, as long as
+            it was cached for the same update_id
+        """
+        kwargs = dict(upnp_client=self.upnp_client,
+                      parent_container=self.parent_container,
+                      requested_id=self.requested_id,
+                      transcoding=self.transcoding,
+                      filter=self.filter)
+        if update_id is not None and hasattr(item, 'toFragment'):
+            # the childCount of a container may change
+            # without its update_id being incremented
+            version = (update_id, getattr(item, 'childCount', None))
+            self.append(_Fragment(*item.toFragment(version, **kwargs)))
+        else:
+            self.append(item.toElement(**kwargs))
         self._items.append(item)
 
     def rebuild(self):
@@ -897,7 +1057,8 @@ class DIDLElement(ElementInterface, log.Loggable):
             self.append(item.toElement(upnp_client=self.upnp_client,
                                        parent_container=self.parent_container,
                                        requested_id=self.requested_id,
-                                       transcoding=self.transcoding))
+                                       transcoding=self.transcoding,
+                                       filter=self.filter))
 
     def numItems(self):
         return len(self)
@@ -911,7 +1072,37 @@ class DIDLElement(ElementInterface, log.Loggable):
         """
         #preamble = """<?xml version="1.0" encoding="utf-8"?>"""
         #return preamble + ET.tostring(self,encoding='utf-8')
-        return ET.tostring(self, encoding='utf-8')
+        for child in self:
+            if isinstance(child, _Fragment):
+                break
+        else:
+            return ET.tostring(self, encoding='utf-8')
+
+        # some of the objects are serialized already,
+        # so just concatenate them
+        fragments = []
+        prefixes = set()
+        for child in self:
+            if isinstance(child, _Fragment):
+                data, used = child.data, child.prefixes
+            else:
+                data, used = serialize_fragment(child)
+            fragments.append(data)
+            prefixes.update(used)
+        head = ['<' + self.tag]
+        attributes = []
+        for name, value in sorted(self.attrib.items()):
+            if name[:1] == '{':
+                uri, name = name[1:].split('}', 1)
+                prefixes.add(my_namespaces[uri])
+                name = '%s:%s' % (my_namespaces[uri], name)
+            attributes.append(' %s="%s"' % (name, _escape_attribute(value)))
+        namespaces = dict((v, k) for k, v in my_namespaces.items())
+        for prefix in sorted(prefixes):
+            head.append(' xmlns:%s="%s"' % (prefix, namespaces[prefix]))
+        head.extend(attributes)
+        head.append('>')
+        return ''.join(head + fragments + ['</%s>' % self.tag])
 
     def get_upnp_class(self, name):
         try:
@@ -932,15 +1123,63 @@ class DIDLElement(ElementInterface, log.Loggable):
     @classmethod
     def fromString(cls, aString):
         instance = cls()
-        elt = utils.parse_xml(aString, 'utf-8')
-        elt = elt.getroot()
-        for node in elt.getchildren():
-            upnp_class_name = node.findtext('{%s}class' % 'urn:schemas-upnp-org:metadata-1-0/upnp/')
-            upnp_class = instance.get_upnp_class(upnp_class_name.strip())
-            new_node = upnp_class.fromString(ET.tostring(node))
-            instance.addItem(new_node)
+        for item in instance._objects(aString):
+            instance.addItem(item)
         return instance
 
+    @classmethod
+    def objectsFromString(cls, aString):
+        """ the DIDLLite objects of a DIDL-Lite document, for when
+            just getItems() of fromString would be used
+        """
+        return list(cls()._objects(aString))
+
+    @classmethod
+    def recordsFromString(cls, aString):
+        """ an ObjectRecord for each object of a DIDL-Lite document """
+        elt = utils.parse_xml(aString, 'utf-8')
+        return [ObjectRecord.fromElement(node)
+                for node in elt.getroot().getchildren()]
+
+    def _objects(self, aString):
+        # each object is built straight from its element
+        elt = utils.parse_xml(aString, 'utf-8')
+        for node in elt.getroot().getchildren():
+            upnp_class_name = node.findtext('{%s}class' % UPNP_NS)
+            item = self.get_upnp_class(upnp_class_name.strip())
+            item.fromElement(node)
+            yield item
+
+
+class ObjectRecord(object):
+    """ just the id, parentID, title, upnp_class and the
+        resources, as (uri, protocolInfo) tuples, of an object
+    """
+
+    __slots__ = ('id', 'parentID', 'title', 'upnp_class', 'res')
+
+    def __init__(self, id=None, parentID=None, title=None,
+                 upnp_class=None, res=None):
+        self.id = id
+        self.parentID = parentID
+        self.title = title
+        self.upnp_class = upnp_class
+        self.res = res or []
+
+    @classmethod
+    def fromElement(cls, elt):
+        record = cls(elt.attrib.get('id'), elt.attrib.get('parentID'))
+        for child in elt:
+            tag = child.tag
+            if tag.endswith('title'):
+                record.title = child.text
+            elif tag.endswith('class'):
+                record.upnp_class = child.text and child.text.strip()
+            elif tag.endswith('res'):
+                record.res.append((child.text,
+                                   child.attrib.get('protocolInfo')))
+        return record
+
 
 def element_to_didl(item):
     """ a helper method to create a DIDLElement out of one ET element
@@ -46,6 +46,43 @@ class Argument:
             }
 
 
+class DispatchPlan(object):
+    """ what serving a call of an action takes, worked out once
+        from its arguments
+
+        in_names are the names of the in arguments, out_names the
+        names of the out arguments in the order of the response and
+        bindings the (argument name, state variable name) pairs of
+        the out arguments tied to a state variable.
+    """
+
+    def __init__(self, action):
+        self.in_names = frozenset(argument.name for argument
+                                  in action.get_in_arguments())
+        out_arguments = action.get_out_arguments()
+        self.out_names = tuple(argument.name for argument in out_arguments)
+        self.bindings = tuple((argument.name, argument.state_variable)
+                              for argument in out_arguments
+                              if argument.name[0:11] != 'A_ARG_TYPE_')
+
+    def check_arguments(self, kwargs):
+        """ the (invalid, missing) argument names of a call,
+            vendor arguments starting with X_ are passed
+        """
+        names = set(kwargs)
+        missing = self.in_names - names
+        invalid = [name for name in names - self.in_names
+                   if not name.startswith('X_')]
+        return invalid, missing
+
+    def build_result(self, result):
+        """ the out arguments of result in the order of the action """
+        ordered_result = OrderedDict()
+        for name in self.out_names:
+            ordered_result[name] = result[name]
+        return ordered_result
+
+
 class Action(log.Loggable):
     logCategory = 'action'
 
@@ -56,6 +93,8 @@ class Action(log.Loggable):
         self.implementation = implementation
         self.arguments_list = arguments_list
         self.callback = None
+        # set by the ServiceServer serving the action
+        self.plan = None
 
     def _get_client(self):
         client = self.service._get_client(self.name)
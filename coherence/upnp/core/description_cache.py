@@ -0,0 +1,235 @@
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+A cache of parsed device and service descriptions for the control point.
+
+Documents are stored content-addressed, by the SHA-1 of their data,
+and found by their URL or by a model key, e.g. the service type plus
+the manufacturer, model name and model number of the device offering
+it. A description found in the cache is handed out without a network
+round trip, the URL is then revalidated in the background with a
+conditional GET.
+
+The cache is enabled with the 'description_cache' option of Coherence:
+'memory' keeps the descriptions in memory only, 'yes' additionally
+stores them below ~/.coherence/descriptions and any other value
+is taken as the directory to store them in.
+"""
+
+import os
+import time
+import json
+from hashlib import sha1
+
+from twisted.internet import defer
+from twisted.web import error
+
+from coherence import log
+from coherence.upnp.core import utils
+
+# seconds until a URL is revalidated again
+REVALIDATE_INTERVAL = 300
+
+cache = None
+
+
+def _parse(data):
+    try:
+        return utils.parse_xml(data, 'utf-8')
+    except Exception:
+        return None
+
+
+def _header(headers, name):
+    try:
+        return headers[name][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+class DescriptionCache(log.Loggable):
+    """ descriptions by SHA-1 digest, with the URLs and model keys
+        pointing to them, optionally kept in directory path
+    """
+    logCategory = 'description_cache'
+
+    def __init__(self, path=None):
+        log.Loggable.__init__(self)
+        self.path = path
+        self._documents = {}    # digest -> (data, tree)
+        self._urls = {}         # url -> {'digest', 'etag', 'last-modified'}
+        self._models = {}       # model key -> digest
+        self._validated = {}    # url -> time of the last revalidation
+        if self.path is not None:
+            self._load_index()
+
+    def _index_file(self):
+        return os.path.join(self.path, 'index.json')
+
+    def _load_index(self):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(self._index_file()) as f:
+                index = json.load(f)
+            self._urls = dict((str(url), dict((str(k), v and str(v))
+                                              for k, v in entry.items()))
+                              for url, entry in index['urls'].items())
+            self._models = dict((str(key), str(digest))
+                                for key, digest in index['models'].items())
+        except (IOError, OSError, ValueError, KeyError), msg:
+            self.info("starting with an empty description cache in %s: %s",
+                      self.path, msg)
+
+    def _save_index(self):
+        if self.path is None:
+            return
+        try:
+            with open(self._index_file() + '.tmp', 'w') as f:
+                json.dump({'urls': self._urls, 'models': self._models}, f)
+            os.rename(self._index_file() + '.tmp', self._index_file())
+        except (IOError, OSError), msg:
+            self.warning("can't write the description cache index: %s", msg)
+
+    def _model_key(self, model):
+        if model is None or None in model or '' in model:
+            return None
+        return '|'.join(model)
+
+    def _document(self, digest):
+        try:
+            return self._documents[digest]
+        except KeyError:
+            pass
+        if self.path is None:
+            return None
+        try:
+            with open(os.path.join(self.path, digest + '.xml'), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        tree = _parse(data)
+        if tree is None or sha1(data).hexdigest() != digest:
+            return None
+        self._documents[digest] = (data, tree)
+        return data, tree
+
+    def lookup(self, url, model=None):
+        """ the cached (data, tree) of the description at url, or of
+            the same model, or None
+        """
+        entry = self._urls.get(url)
+        if entry is not None:
+            document = self._document(entry['digest'])
+            if document is not None:
+                return document
+        key = self._model_key(model)
+        if key is not None and key in self._models:
+            return self._document(self._models[key])
+        return None
+
+    def store(self, url, data, headers=None, model=None):
+        """ remember the description at url, returns its (data, tree)
+            with tree being None for an invalid document,
+            which isn't cached
+        """
+        digest = sha1(data).hexdigest()
+        document = self._documents.get(digest)
+        if document is None:
+            tree = _parse(data)
+            if tree is None:
+                return data, None
+            document = self._documents[digest] = (data, tree)
+            if self.path is not None:
+                try:
+                    with open(os.path.join(self.path, digest + '.xml'), 'wb') as f:
+                        f.write(data)
+                except IOError, msg:
+                    self.warning("can't store description of %s: %s", url, msg)
+        self._urls[url] = {'digest': digest,
+                           'etag': _header(headers, 'etag'),
+                           'last-modified': _header(headers, 'last-modified')}
+        key = self._model_key(model)
+        if key is not None:
+            self._models[key] = digest
+        self._validated[url] = time.time()
+        self._save_index()
+        return document
+
+    def fetch(self, url, model=None, check=None):
+        """ returns a Deferred firing with the (data, tree) of the
+            description at url
+
+            A cached description check(tree) returns False for,
+            e.g. one of another device now answering at the same
+            url, is fetched again.
+        """
+        document = self.lookup(url, model)
+        if document is not None and check is not None and \
+           not check(document[1]):
+            self.info("cached description of %s doesn't fit, fetching it again",
+                      url)
+            document = None
+        if document is None:
+            d = utils.getPage(url)
+            d.addCallback(lambda (data, headers):
+                          self.store(url, data, headers, model))
+            return d
+        self.debug("description of %s taken from the cache", url)
+        if time.time() - self._validated.get(url, 0) > REVALIDATE_INTERVAL:
+            self.revalidate(url, model)
+        return defer.succeed(document)
+
+    def revalidate(self, url, model=None):
+        """ fetch the description at url again, if it changed """
+        self._validated[url] = time.time()
+        headers = {}
+        entry = self._urls.get(url)
+        if entry is not None:
+            if entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last-modified'] is not None:
+                headers['If-Modified-Since'] = entry['last-modified']
+
+        def got_page((data, headers)):
+            self.store(url, data, headers, model)
+
+        def got_error(failure):
+            if failure.check(error.Error) and failure.value.status == '304':
+                self.debug("description of %s is unchanged", url)
+            else:
+                self.info("revalidating the description of %s failed: %s",
+                          url, failure.getErrorMessage())
+
+        d = utils.getPage(url, headers=headers)
+        d.addCallbacks(got_page, got_error)
+        return d
+
+
+def setup(option):
+    """ set up the module cache according to the
+        'description_cache' option
+    """
+    global cache
+    if option in (None, 'no'):
+        cache = None
+    elif option == 'memory':
+        cache = DescriptionCache()
+    elif option == 'yes':
+        cache = DescriptionCache(os.path.expanduser(
+            os.path.join('~', '.coherence', 'descriptions')))
+    else:
+        cache = DescriptionCache(option)
+    return cache
+
+
+def fetch(url, model=None, check=None):
+    """ returns a Deferred firing with the (data, tree) of the
+        description at url, tree is None for an invalid document
+    """
+    if cache is not None:
+        return cache.fetch(url, model, check)
+    d = utils.getPage(url)
+    d.addCallback(lambda (data, headers): (data, _parse(data)))
+    return d
@@ -10,7 +10,7 @@ import time
 from twisted.internet import defer
 
 from coherence.upnp.core.service import Service
-from coherence.upnp.core import utils
+from coherence.upnp.core import description_cache
 from coherence import log
 
 import coherence.extern.louie as louie
@@ -453,14 +453,9 @@ class RootDevice(Device):
 
         def gotPage(x):
             self.debug("got device description from %r", self.location)
-            data, headers = x
-            xml_data = None
-            try:
-                xml_data = utils.parse_xml(data, 'utf-8')
-            except:
+            data, xml_data = x
+            if xml_data is None:
                 self.warning("Invalid device description received from %r", self.location)
-                import traceback
-                self.debug(traceback.format_exc())
 
             if xml_data is not None:
                 tree = xml_data.getroot()
@@ -484,7 +479,16 @@ class RootDevice(Device):
             self.warning("error getting device description from %r", url)
             self.info(failure)
 
-        utils.getPage(self.location).addCallbacks(gotPage, gotError, None, None, [self.location], None)
+        def same_device(tree):
+            """ the cached description is the one of the device
+                announced with our USN
+            """
+            udn = tree.findtext('./{%s}device/{%s}UDN' % (ns, ns))
+            return udn is not None and \
+                   udn.strip() == self.usn.split('::')[0]
+
+        d = description_cache.fetch(self.location, check=same_device)
+        d.addCallbacks(gotPage, gotError, None, None, [self.location], None)
 
     def make_fullyqualified(self, url):
         if url.startswith('http://'):
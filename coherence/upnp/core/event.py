@@ -5,12 +5,14 @@
 # Copyright 2006,2007,2008,2009 Frank Scholz <coherence@beebits.net>
 
 import time
+from collections import deque
 from urlparse import urlsplit
 
 from twisted.internet import reactor, defer
 from twisted.web import resource, server
 from twisted.web.http import datetimeToString
-from twisted.internet.protocol import Protocol, ClientCreator, _InstanceFactory
+from twisted.internet.protocol import Protocol, ClientCreator, ClientFactory
+from twisted.protocols.basic import LineReceiver
 from twisted.python import failure
 
 from coherence import log, SERVER_ID
@@ -124,8 +126,7 @@ class EventSubscriptionServer(resource.Resource, log.Loggable):
                 #print headers['sid']
                 if self.subscribers.has_key(headers['sid']):
                     s = self.subscribers[headers['sid']]
-                    s['timeout'] = headers['timeout']
-                    s['created'] = time.time()
+                    self.service.renew_subscriber(s, headers['timeout'])
                 elif not headers.has_key('callback'):
                     request.setResponseCode(404)
                     request.setHeader('SERVER', SERVER_ID)
@@ -165,7 +166,7 @@ class EventSubscriptionServer(resource.Resource, log.Loggable):
         else:
             headers = request.getAllHeaders()
             try:
-                del self.subscribers[headers['sid']]
+                self.service.remove_subscriber(headers['sid'], 'unsubscribed')
             except:
                 """ XXX if not found set right error code """
                 pass
@@ -362,87 +363,344 @@ def subscribe(service, action='subscribe'):
     #print "event.subscribe finished"
 
 
-class NotificationProtocol(Protocol, log.Loggable):
+NOTIFY_TIMEOUT = 30             # seconds to wait for a connection or response
+NOTIFY_IDLE_TIMEOUT = 60        # seconds an unused connection is kept open
+MAX_PIPELINED_NOTIFICATIONS = 8     # requests in flight on one connection
+MAX_QUEUED_NOTIFICATIONS = 32       # undelivered notifications per subscriber
+MAX_NOTIFICATION_FAILURES = 3       # consecutive failures before a drop
+
+
+class SubscriberDropped(Exception):
+    """ the subscriber was too slow or unreachable and
+        doesn't receive any further notifications
+    """
+
+
+class Notification(object):
+    """ a NOTIFY request for one subscriber, with its SEQ number
+        taken at the time it was queued
+    """
+
+    def __init__(self, s, path, host, port, xml):
+        self.sid = s['sid']
+        self.seq = s['seq']
+        self.deferred = defer.Deferred()
+        self.retried = False
+        self.dropped = False
+        request = ['NOTIFY %s HTTP/1.1' % path,
+                    'HOST:  %s:%d' % (host, port),
+                    'SEQ:  %d' % self.seq,
+                    'CONTENT-TYPE:  text/xml;charset="utf-8"',
+                    'SID:  %s' % self.sid,
+                    'NTS:  upnp:propchange',
+                    'NT:  upnp:event',
+                    'Content-Length: %d' % len(xml),
+                    '',
+                    xml]
+        self.request = '\r\n'.join(request)
+
+
+class NotificationProtocol(LineReceiver, log.Loggable):
+    """ a persistent HTTP/1.1 connection to a subscriber's callback host
+
+        NOTIFY requests are written in the order they are handed in,
+        the responses are matched against them in that same order.
+    """
 
     logCategory = "notification_protocol"
 
+    def __init__(self, channel):
+        log.Loggable.__init__(self)
+        self.channel = channel
+        self.in_flight = deque()
+        self.timeout_checker = None
+        self._status = None
+        self._headers = {}
+        self._length = 0
+
     def connectionMade(self):
-        self.timeout_checker = reactor.callLater(30, lambda: self.transport.loseConnection())
+        self.channel.connected(self)
 
-    def dataReceived(self, data):
-        try:
+    def send(self, notification):
+        self.in_flight.append(notification)
+        self.transport.write(notification.request)
+        self.reset_timeout()
+
+    def reset_timeout(self):
+        if self.timeout_checker is not None and self.timeout_checker.active():
             self.timeout_checker.cancel()
-        except:
-            pass
-        cmd, headers = utils.parse_http_response(data)
-        self.debug("notification response received %r %r", cmd, headers)
-        if cmd[1] != '200':
-            self.warning("response with error code %r received from %s "
-                         "upon our notification",
-                         cmd[1], self.service.device.friendly_name)
-        self.transport.loseConnection()
+        if len(self.in_flight) > 0:
+            timeout = NOTIFY_TIMEOUT
+        else:
+            timeout = NOTIFY_IDLE_TIMEOUT
+        self.timeout_checker = reactor.callLater(timeout, self.transport.loseConnection)
+
+    def lineReceived(self, line):
+        if self._status is None:
+            if line == '':
+                return
+            self._status = line.split(None, 2)
+            self._headers = {}
+        elif line != '':
+            key, _, value = line.partition(':')
+            self._headers[key.strip().lower()] = value.strip()
+        else:
+            try:
+                self._length = int(self._headers.get('content-length', 0))
+            except ValueError:
+                self._length = 0
+            if self._length > 0:
+                self.setRawMode()
+            else:
+                self.response_received()
+
+    def rawDataReceived(self, data):
+        rest = data[self._length:]
+        self._length -= len(data) - len(rest)
+        if self._length == 0:
+            self.response_received()
+            self.setLineMode(rest)
+
+    def response_received(self):
+        status, headers = self._status, self._headers
+        self._status = None
+        self.debug("notification response received %r %r", status, headers)
+        if len(status) < 2:
+            status.append('')
+        persistent = (status[0] == 'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close' and
+                      'transfer-encoding' not in headers)
+        if len(self.in_flight) > 0:
+            self.channel.response_received(self.in_flight.popleft(), status[1])
+        self.channel.persistent = persistent
+        if not persistent:
+            self.transport.loseConnection()
+            return
+        self.reset_timeout()
+        self.channel.send_pending()
 
     def connectionLost(self, reason):
-        try:
+        if self.timeout_checker is not None and self.timeout_checker.active():
             self.timeout_checker.cancel()
-        except:
-            pass
         self.debug("connection closed %r", reason)
+        self.channel.disconnected(self, reason)
 
 
-def send_notification(s, xml):
+class NotificationFactory(ClientFactory):
+
+    noisy = False
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def buildProtocol(self, addr):
+        return NotificationProtocol(self.channel)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.channel.connection_failed(reason)
+
+
+class NotificationChannel(log.Loggable):
+    """ the queue of notifications for one callback host,
+        delivered over a single connection
+
+        Requests are only pipelined once the host answered with
+        a HTTP/1.1 keep-alive response.
     """
-    send a notification a subscriber
-    return its response
+
+    logCategory = "notification_protocol"
+
+    def __init__(self, pool, host, port):
+        log.Loggable.__init__(self)
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.queue = deque()
+        self.protocol = None
+        self.connector = None
+        self.persistent = None
+
+    def add(self, notification):
+        self.queue.append(notification)
+        self.send_pending()
+
+    def send_pending(self):
+        if self.protocol is None:
+            if self.connector is None and len(self.queue) > 0:
+                self.debug("connecting to %s:%d", self.host, self.port)
+                self.connector = reactor.connectTCP(self.host, self.port,
+                                                    NotificationFactory(self),
+                                                    timeout=NOTIFY_TIMEOUT)
+            return
+        in_flight = self.protocol.in_flight
+        while len(self.queue) > 0:
+            if len(in_flight) > 0 and self.persistent != True:
+                break
+            if len(in_flight) >= MAX_PIPELINED_NOTIFICATIONS:
+                break
+            notification = self.queue.popleft()
+            if not notification.dropped:
+                self.protocol.send(notification)
+
+    def connected(self, protocol):
+        self.connector = None
+        self.protocol = protocol
+        self.send_pending()
+
+    def connection_failed(self, reason):
+        self.connector = None
+        self.info("can't connect to %s:%d for notifications", self.host, self.port)
+        queue, self.queue = self.queue, deque()
+        for notification in queue:
+            self.pool.delivery_failed(notification, reason)
+        self.pool.channel_closed(self)
+
+    def response_received(self, notification, status):
+        self.pool.response_received(notification, status)
+
+    def disconnected(self, protocol, reason):
+        if protocol is self.protocol:
+            self.protocol = None
+        # a request may cross the peer closing an idle connection,
+        # so unanswered notifications get one more chance
+        for notification in reversed(protocol.in_flight):
+            if notification.retried:
+                self.pool.delivery_failed(notification, reason)
+            else:
+                notification.retried = True
+                self.queue.appendleft(notification)
+        protocol.in_flight.clear()
+        if len([n for n in self.queue if not n.dropped]) > 0:
+            self.send_pending()
+        else:
+            self.queue.clear()
+            self.pool.channel_closed(self)
+
+    def close(self):
+        if self.connector is not None:
+            self.connector.disconnect()
+        if self.protocol is not None:
+            self.protocol.transport.loseConnection()
+
+
+class NotificationPool(log.Loggable):
+    """ delivers GENA event notifications over keep-alive connections,
+        one channel per subscriber callback host
+
+        Each subscriber may have at most MAX_QUEUED_NOTIFICATIONS
+        undelivered notifications. A subscriber exceeding that, failing
+        MAX_NOTIFICATION_FAILURES times in a row or answering with
+        412 Precondition Failed is dropped, the Deferreds of its
+        outstanding notifications fail with L{SubscriberDropped}.
     """
-    logger = log.getLogger("notification_protocol")
 
-    _, host_port, path, _, _ = urlsplit(s['callback'])
-    if path == '':
-        path = '/'
-    if host_port.find(':') != -1:
-        host, port = tuple(host_port.split(':'))
-        port = int(port)
-    else:
-        host = host_port
-        port = 80
+    logCategory = "notification_protocol"
 
-    def send_request(p, port_item):
-        request = ['NOTIFY %s HTTP/1.1' % path,
-                    'HOST:  %s:%d' % (host, port),
-                    'SEQ:  %d' % s['seq'],
-                    'CONTENT-TYPE:  text/xml;charset="utf-8"',
-                    'SID:  %s' % s['sid'],
-                    'NTS:  upnp:propchange',
-                    'NT:  upnp:event',
-                    'Content-Length: %d' % len(xml),
-                    '',
-                    xml]
+    def __init__(self):
+        log.Loggable.__init__(self)
+        self.channels = {}
+        self.pending = {}
+        self.failures = {}
+
+    def send(self, s, xml):
+        sid = s['sid']
+        pending = self.pending.setdefault(sid, [])
+        if len(pending) >= MAX_QUEUED_NOTIFICATIONS:
+            self.warning("subscriber %s has %d undelivered notifications, dropping it",
+                         sid, len(pending))
+            self.drop(sid)
+            return defer.fail(failure.Failure(SubscriberDropped(sid)))
+
+        _, host_port, path, _, _ = urlsplit(s['callback'])
+        if path == '':
+            path = '/'
+        if host_port.find(':') != -1:
+            host, port = tuple(host_port.split(':'))
+            port = int(port)
+        else:
+            host = host_port
+            port = 80
 
-        request = '\r\n'.join(request)
-        logger.info("send_notification.send_request to %r %r",
-                 s['sid'], s['callback'])
-        logger.debug("request: %r", request)
+        notification = Notification(s, path, host, port, xml)
         s['seq'] += 1
         if s['seq'] > 0xffffffff:
             s['seq'] = 1
-        p.transport.write(request)
-        port_item.disconnect()
-        #return p.transport.write(request)
-
-    def got_error(failure, port_item):
-        port_item.disconnect()
-        logger.info("error sending notification to %r %r",
-                 s['sid'], s['callback'])
-        logger.debug(failure)
-    #c = ClientCreator(reactor, NotificationProtocol)
-    #d = c.connectTCP(host, port)
+        pending.append(notification)
+        self.info("send_notification to %r %r, seq %d",
+                  sid, s['callback'], notification.seq)
+        self.debug("request: %r", notification.request)
 
-    d = defer.Deferred()
-    f = _InstanceFactory(reactor, NotificationProtocol(), d)
-    port_item = reactor.connectTCP(host, port, f, timeout=30, bindAddress=None)
+        try:
+            channel = self.channels[(host, port)]
+        except KeyError:
+            channel = self.channels[(host, port)] = NotificationChannel(self, host, port)
+        channel.add(notification)
+        return notification.deferred
+
+    def _done(self, notification):
+        pending = self.pending.get(notification.sid)
+        if pending is None or notification not in pending:
+            return
+        pending.remove(notification)
+        if not pending:
+            del self.pending[notification.sid]
+
+    def response_received(self, notification, status):
+        if notification.dropped:
+            return
+        if status == '200':
+            self._done(notification)
+            self.failures.pop(notification.sid, None)
+            notification.deferred.callback(status)
+        elif status == '412':
+            self.info("subscriber %s doesn't know its subscription anymore",
+                      notification.sid)
+            self.drop(notification.sid)
+        else:
+            self.warning("response with error code %r received from %s "
+                         "upon our notification", status, notification.sid)
+            self.delivery_failed(notification, failure.Failure(
+                Exception("NOTIFY failed with status %s" % status)))
+
+    def delivery_failed(self, notification, reason):
+        if notification.dropped:
+            return
+        sid = notification.sid
+        self._done(notification)
+        self.failures[sid] = self.failures.get(sid, 0) + 1
+        self.info("error sending notification to %r, seq %d",
+                  sid, notification.seq)
+        self.debug(reason)
+        if self.failures[sid] >= MAX_NOTIFICATION_FAILURES:
+            self.warning("subscriber %s failed %d notifications in a row, dropping it",
+                         sid, self.failures[sid])
+            notification.dropped = True
+            self.drop(sid)
+            reason = failure.Failure(SubscriberDropped(sid))
+        notification.deferred.errback(reason)
+
+    def drop(self, sid):
+        """ fail all outstanding notifications of subscriber sid """
+        self.failures.pop(sid, None)
+        for notification in self.pending.pop(sid, []):
+            notification.dropped = True
+            notification.deferred.errback(failure.Failure(SubscriberDropped(sid)))
+
+    def channel_closed(self, channel):
+        if self.channels.get((channel.host, channel.port)) is channel:
+            del self.channels[(channel.host, channel.port)]
+
+    def close(self):
+        for channel in self.channels.values():
+            channel.close()
+
+
+notification_pool = NotificationPool()
 
-    d.addCallback(send_request, port_item)
-    d.addErrback(got_error, port_item)
 
-    return d, port_item
+def send_notification(s, xml):
+    """
+    send a notification a subscriber
+    return a Deferred firing with its response status
+    """
+    return notification_pool.send(s, xml)
@@ -11,10 +11,9 @@ from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
 from twisted.internet import task
 
-from coherence.upnp.core import utils
 import coherence.extern.louie as louie
 from coherence import log
-from coherence.upnp.core.ssdp import SSDP_PORT, SSDP_ADDR
+from coherence.upnp.core.ssdp import SSDP_PORT, SSDP_ADDR, parse_datagram
 
 
 class MSearch(DatagramProtocol, log.Loggable):
@@ -38,10 +37,10 @@ class MSearch(DatagramProtocol, log.Loggable):
             self._port.stopListening()
 
     def datagramReceived(self, data, (host, port)):
-        cmd, headers, content = utils.parse_http_response(data)
-        del content # we do not need the content
-        self.info('datagramReceived from %s:%d, protocol %s code %s', host, port, cmd[0], cmd[1])
-        if cmd[0].startswith('HTTP/1.') and cmd[1] == '200':
+        cmd, headers = parse_datagram(data)
+        self.info('datagramReceived from %s:%d, %s', host, port, ' '.join(cmd))
+        if (len(cmd) == 2 and cmd[0].startswith('HTTP/1.') and cmd[1] == '200' and
+            not self.ssdp_server.is_duplicate(headers)):
             self.msg('for %r', headers['usn'])
             if self.ssdp_server.service_seen(host, headers['st'], headers):
                 self.info('register as remote %(usn)s, %(st)s, %(location)s',
@@ -49,7 +48,8 @@ class MSearch(DatagramProtocol, log.Loggable):
 
         # make raw data available
         # send out the signal after we had a chance to register the device
-        louie.send('UPnP.SSDP.datagram_received', None, data, host, port)
+        if louie.has_receivers('UPnP.SSDP.datagram_received'):
+            louie.send('UPnP.SSDP.datagram_received', None, data, host, port)
 
     def double_discover(self):
         " Because it's worth it (with UDP's reliability) "
@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+""" UPnP ContentDirectory SearchCriteria and SortCriteria
+
+    a parser for the search expressions of the ContentDirectory
+    Search action, compiling them into plain Python callables
+    that are evaluated against DIDLLite objects,
+    a compiler for the SortCriteria of Browse and Search,
+    and a flat index a MediaServer backend can populate
+    to answer Search requests without walking its tree
+
+    grammar, according to the ContentDirectory:1 specification:
+
+    searchCrit  ::= searchExp | asterisk
+    searchExp   ::= relExp |
+                    searchExp wChar+ logOp wChar+ searchExp |
+                    '(' wChar* searchExp wChar* ')'
+    logOp       ::= 'and' | 'or'
+    relExp      ::= property wChar+ binOp wChar+ quotedVal |
+                    property wChar+ existsOp wChar+ boolVal
+    binOp       ::= relOp | stringOp
+    relOp       ::= '=' | '!=' | '<' | '<=' | '>' | '>='
+    stringOp    ::= 'contains' | 'doesNotContain' | 'derivedfrom'
+    existsOp    ::= 'exists'
+    boolVal     ::= 'true' | 'false'
+"""
+
+import re
+from datetime import datetime
+
+from twisted.python.util import OrderedDict
+
+
+class SearchCriteriaError(ValueError):
+    """ the SearchCriteria string can't be parsed """
+
+
+# the properties we know how to evaluate, announced
+# as the SearchCapabilities of a ContentDirectory
+SEARCH_CAPABILITIES = ','.join((
+    '@id', '@parentID', '@refID',
+    'dc:title', 'dc:creator', 'dc:date', 'dc:description',
+    'dc:publisher', 'dc:language',
+    'upnp:class', 'upnp:artist', 'upnp:album', 'upnp:genre',
+    'upnp:originalTrackNumber', 'upnp:actor', 'upnp:director',
+    'res', 'res@protocolInfo', 'res@size', 'res@duration'))
+
+# the properties we know how to sort by
+SORT_CAPABILITIES = SEARCH_CAPABILITIES
+
+# the compiled criteria, keyed by the criteria string
+MAX_CACHED_CRITERIA = 256
+_compiled = {}
+_compiled_sort = {}
+
+_token_re = re.compile(r'''
+    \s*(?:
+      (?P<paren>[()])
+    | "(?P<quoted>(?:\\.|[^"\\])*)"
+    | (?P<relop>!=|<=|>=|=|<|>)
+    | (?P<word>[^\s()"=<>!]+)
+    )''', re.VERBOSE)
+
+_unescape_re = re.compile(r'\\(.)')
+
+STRING_OPERATORS = ('contains', 'doesnotcontain', 'derivedfrom')
+
+
+def _tokenize(criteria):
+    tokens = []
+    pos = 0
+    end = len(criteria.rstrip())
+    while pos < end:
+        m = _token_re.match(criteria, pos)
+        if m is None or m.end() == pos:
+            raise SearchCriteriaError(
+                "invalid SearchCriteria %r at position %d" % (criteria, pos))
+        pos = m.end()
+        for kind in ('paren', 'quoted', 'relop', 'word'):
+            value = m.group(kind)
+            if value is not None:
+                if kind == 'quoted':
+                    value = _unescape_re.sub(r'\1', value)
+                tokens.append((kind, value))
+                break
+    return tokens
+
+
+def _as_text(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.decode('utf-8', 'replace')
+
+
+def _as_number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
+def _values(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [v for v in value if v is not None]
+    return [value]
+
+
+def _attribute_getter(attribute):
+    return lambda obj: _values(getattr(obj, attribute, None))
+
+
+def _res_getter(attribute):
+    def get(obj):
+        res = getattr(obj, 'res', None) or []
+        return [getattr(r, attribute, None) for r in res
+                if getattr(r, attribute, None) is not None]
+    return get
+
+
+def _genre_getter(obj):
+    genres = getattr(obj, 'genres', None)
+    if genres:
+        return _values(genres)
+    return _values(getattr(obj, 'genre', None))
+
+
+_special_properties = {
+    '@id': _attribute_getter('id'),
+    '@parentid': _attribute_getter('parentID'),
+    '@refid': _attribute_getter('refID'),
+    '@childcount': _attribute_getter('childCount'),
+    'upnp:class': _attribute_getter('upnp_class'),
+    'upnp:genre': _genre_getter,
+    'upnp:actor': _attribute_getter('actors'),
+    'res': _res_getter('data'),
+}
+
+
+def property_getter(name):
+    """ returns a callable extracting the list of values
+        for the DIDL-Lite property I{name} from a DIDLLite object
+    """
+    key = name.lower()
+    try:
+        return _special_properties[key]
+    except KeyError:
+        pass
+    if key.startswith('res@'):
+        return _res_getter(name[4:])
+    if ':' in name:
+        name = name.split(':', 1)[1]
+    return _attribute_getter(name)
+
+
+def _relation(prop, op, operand):
+    get = property_getter(prop)
+    operand = _as_text(operand)
+    lowered = operand.lower()
+
+    if op == 'exists':
+        if lowered not in ('true', 'false'):
+            raise SearchCriteriaError("exists expects true or false, not %r" % operand)
+        wanted = (lowered == 'true')
+        return lambda obj: (len(get(obj)) > 0) == wanted
+
+    if op == 'contains':
+        return lambda obj: any(lowered in _as_text(v).lower() for v in get(obj))
+
+    if op == 'doesnotcontain':
+        return lambda obj: not any(lowered in _as_text(v).lower() for v in get(obj))
+
+    if op == 'derivedfrom':
+        prefix = lowered + '.'
+
+        def derivedfrom(obj):
+            for v in get(obj):
+                v = _as_text(v).lower()
+                if v == lowered or v.startswith(prefix):
+                    return True
+            return False
+        return derivedfrom
+
+    if op == '=':
+        return lambda obj: any(_as_text(v).lower() == lowered for v in get(obj))
+
+    if op == '!=':
+        return lambda obj: not any(_as_text(v).lower() == lowered for v in get(obj))
+
+    number = _as_number(operand)
+    compare = {'<': lambda a, b: a < b,
+               '<=': lambda a, b: a <= b,
+               '>': lambda a, b: a > b,
+               '>=': lambda a, b: a >= b}[op]
+
+    def relational(obj):
+        for v in get(obj):
+            if number is not None:
+                n = _as_number(v)
+                if n is not None:
+                    if compare(n, number):
+                        return True
+                    continue
+            if compare(_as_text(v).lower(), lowered):
+                return True
+        return False
+    return relational
+
+
+class _Parser(object):
+
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.tokens = _tokenize(criteria)
+        self.pos = 0
+
+    def error(self, msg):
+        raise SearchCriteriaError("%s in SearchCriteria %r" % (msg, self.criteria))
+
+    def peek(self):
+        try:
+            return self.tokens[self.pos]
+        except IndexError:
+            return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            self.error("unexpected end")
+        self.pos += 1
+        return token
+
+    def peek_word(self):
+        kind, value = self.peek()
+        if kind == 'word':
+            return value.lower()
+        return None
+
+    def parse(self):
+        if self.tokens in ([], [('word', '*')]):
+            return lambda obj: True
+        matcher = self.parse_or()
+        if self.pos != len(self.tokens):
+            self.error("unexpected %r" % self.peek()[1])
+        return matcher
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek_word() == 'or':
+            self.pos += 1
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda obj: any(t(obj) for t in terms)
+
+    def parse_and(self):
+        terms = [self.parse_primary()]
+        while self.peek_word() == 'and':
+            self.pos += 1
+            terms.append(self.parse_primary())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda obj: all(t(obj) for t in terms)
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind == 'paren' and value == '(':
+            matcher = self.parse_or()
+            if self.next() != ('paren', ')'):
+                self.error("missing ')'")
+            return matcher
+        if kind != 'word':
+            self.error("expected a property, got %r" % value)
+        prop = value
+
+        kind, op = self.next()
+        if kind == 'word':
+            op = op.lower()
+            if op == 'exists':
+                kind, operand = self.next()
+                if kind != 'word':
+                    self.error("expected true or false, got %r" % operand)
+                return _relation(prop, op, operand)
+            if op not in STRING_OPERATORS:
+                self.error("unknown operator %r" % op)
+        elif kind != 'relop':
+            self.error("expected an operator, got %r" % op)
+
+        kind, operand = self.next()
+        if kind != 'quoted':
+            self.error("expected a quoted value, got %r" % operand)
+        return _relation(prop, op, operand)
+
+
+def compile_criteria(criteria):
+    """ parse a SearchCriteria string and return a callable,
+        expecting a DIDLLite object and returning True when
+        the object matches the criteria
+
+        the compiled callables are cached per criteria string,
+        raises L{SearchCriteriaError} on invalid criteria
+    """
+    if criteria is None:
+        criteria = ''
+    try:
+        return _compiled[criteria]
+    except KeyError:
+        pass
+    matcher = _Parser(criteria).parse()
+    if len(_compiled) >= MAX_CACHED_CRITERIA:
+        _compiled.clear()
+    _compiled[criteria] = matcher
+    return matcher
+
+
+def _sort_key(get):
+    def key(obj):
+        values = get(obj)
+        if len(values) == 0:
+            return (0, )
+        value = values[0]
+        number = _as_number(value)
+        if number is not None:
+            return (1, number)
+        return (2, _as_text(value).lower())
+    return key
+
+
+class SortCriteria(object):
+    """ a compiled SortCriteria, like '+dc:title,-dc:date'
+
+        the sort keys of an object are computed once per sort,
+        the ordering is stable for objects with equal keys
+    """
+
+    def __init__(self, criteria):
+        self.criteria = criteria
+        self.keys = []
+        for part in criteria.split(','):
+            part = part.strip()
+            if len(part) == 0:
+                continue
+            descending = False
+            if part[0] in '+-':
+                descending = (part[0] == '-')
+                part = part[1:].strip()
+            m = _token_re.match(part)
+            if m is None or m.group('word') != part:
+                raise SearchCriteriaError("invalid SortCriteria %r" % criteria)
+            self.keys.append((_sort_key(property_getter(part)), descending))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def sort(self, items, get_object=None):
+        """ returns a new list of I{items}, sorted by the criteria,
+
+            I{get_object} maps an item to the DIDLLite object
+            carrying the properties, items are DIDLLite objects
+            themselves if it is omitted
+        """
+        if get_object is None:
+            get_object = lambda item: item
+        decorated = []
+        for item in items:
+            obj = get_object(item)
+            decorated.append(([key(obj) for key, _ in self.keys], item))
+        # stable sorts, from the least to the most significant key
+        for i in range(len(self.keys) - 1, -1, -1):
+            decorated.sort(key=lambda d: d[0][i], reverse=self.keys[i][1])
+        return [item for _, item in decorated]
+
+
+def compile_sort_criteria(criteria):
+    """ parse a SortCriteria string and return a L{SortCriteria},
+        or None when there is nothing to sort by
+
+        the compiled criteria are cached per string,
+        raises L{SearchCriteriaError} on invalid criteria
+    """
+    if not criteria or len(criteria.strip()) == 0:
+        return None
+    try:
+        return _compiled_sort[criteria]
+    except KeyError:
+        pass
+    sort = SortCriteria(criteria)
+    if len(_compiled_sort) >= MAX_CACHED_CRITERIA:
+        _compiled_sort.clear()
+    _compiled_sort[criteria] = sort
+    return sort
+
+
+def _default_parent(item):
+    return getattr(item, 'parent', None)
+
+
+class SearchIndex(object):
+    """ a flat index over the BackendItems of a MediaServer backend
+
+        the backend adds and removes its items as they come and go,
+        the ContentDirectoryServer then evaluates a compiled
+        SearchCriteria over the index instead of walking
+        the container tree
+
+        @ivar get_parent: a callable returning the parent BackendItem
+                          of an item, or a tuple of them when the item
+                          shows up in several containers, used to
+                          restrict a search to the descendants
+                          of a container
+    """
+
+    def __init__(self, get_parent=None):
+        self._items = OrderedDict()
+        if get_parent is None:
+            get_parent = _default_parent
+        self.get_parent = get_parent
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, id):
+        return str(id) in self._items
+
+    def add(self, id, item):
+        self._items[str(id)] = item
+
+    def remove(self, id):
+        try:
+            del self._items[str(id)]
+        except KeyError:
+            pass
+
+    def clear(self):
+        self._items.clear()
+
+    def _parents(self, item):
+        parents = self.get_parent(item)
+        if parents is None:
+            return ()
+        if isinstance(parents, (list, tuple)):
+            return parents
+        return (parents,)
+
+    def in_container(self, item, container):
+        pending = list(self._parents(item))
+        seen = set()
+        while len(pending) > 0:
+            parent = pending.pop()
+            if parent is container:
+                return True
+            if id(parent) in seen:
+                continue
+            seen.add(id(parent))
+            pending.extend(self._parents(parent))
+        return False
+
+    def search(self, criteria, container=None, start=0, count=0, sort=None):
+        """ returns a tuple of the list of matching BackendItems,
+            sliced by I{start} and I{count}, and the total number
+            of matches
+
+            I{criteria} is a SearchCriteria string or an already
+            compiled one, a container without a parent is the root
+            and has everything in scope,
+            I{sort} is an optional compiled L{SortCriteria}
+        """
+        if not callable(criteria):
+            criteria = compile_criteria(criteria)
+        if container is not None and len(self._parents(container)) == 0:
+            container = None
+
+        matches = []
+        for item in self._items.values():
+            if item is container:
+                continue
+            if container is not None and not self.in_container(item, container):
+                continue
+            didl_item = item.get_item()
+            if didl_item is None or not hasattr(didl_item, 'upnp_class'):
+                # nothing we can evaluate synchronously, like a Deferred
+                continue
+            if criteria(didl_item):
+                matches.append((item, didl_item))
+
+        if sort:
+            matches = sort.sort(matches, lambda match: match[1])
+        matches = [item for item, _ in matches]
+
+        total = len(matches)
+        if count > 0:
+            return matches[start:start + count], total
+        return matches[start:], total
@@ -8,12 +8,14 @@
 import os
 
 import time
+import heapq
 import urlparse
 from coherence.upnp.core import action
 from coherence.upnp.core import event
 from coherence.upnp.core import variable
 
 from coherence.upnp.core import utils
+from coherence.upnp.core import description_cache
 from coherence.upnp.core.soap_proxy import SOAPProxy
 from coherence.upnp.core.soap_service import errorCode
 from coherence.upnp.core.event import EventSubscriptionServer
@@ -320,12 +322,10 @@ class Service(log.Loggable):
     def parse_actions(self):
 
         def gotPage(x):
-            self.scpdXML, headers = x
-            try:
-                xml_doc = utils.parse_xml(self.scpdXML, 'utf-8')
-            except Exception as e:
-                self.warning("Invalid service description received from %r: e",
-                             self.get_scpd_url(), e)
+            self.scpdXML, xml_doc = x
+            if xml_doc is None:
+                self.warning("Invalid service description received from %r",
+                             self.get_scpd_url())
                 return
             tree = xml_doc.getroot()
             ns = "urn:schemas-upnp-org:service-1-0"
@@ -378,7 +378,14 @@ class Service(log.Loggable):
             self.info('failure %s', failure)
             louie.send('Coherence.UPnP.Service.detection_failed', self.device, device=self.device)
 
-        utils.getPage(self.get_scpd_url()).addCallbacks(gotPage, gotError, None, None, [self.get_scpd_url()], None)
+        # services of the same type on devices of the same model
+        # share their description
+        model = (self.service_type,
+                 getattr(self.device, 'manufacturer', None),
+                 getattr(self.device, 'model_name', None),
+                 getattr(self.device, 'model_number', None))
+        d = description_cache.fetch(self.get_scpd_url(), model)
+        d.addCallbacks(gotPage, gotError, None, None, [self.get_scpd_url()], None)
 
 moderated_variables = \
         {'urn:schemas-upnp-org:service:AVTransport:2':
@@ -397,6 +404,27 @@ moderated_variables = \
             ['LastChange'],
         }
 
+# the minimal interval in seconds between two events of a
+# moderated variable
+moderation_intervals = \
+        {'LastChange': 0.2,
+         'SystemUpdateID': 2.0,
+         'ContainerUpdateIDs': 2.0,
+        }
+
+# seconds between two runs of check_moderated_variables, or the
+# smallest moderation interval of the service when that is shorter
+MODERATION_CHECK_INTERVAL = 0.5
+
+
+def moderation_check_interval(service_type):
+    """ how often the moderated variables of a service
+        of service_type are to be checked
+    """
+    intervals = [moderation_intervals.get(name, 0)
+                 for name in moderated_variables.get(service_type, [])]
+    return min([MODERATION_CHECK_INTERVAL] + [i for i in intervals if i > 0])
+
 
 class ServiceServer(log.Loggable):
     logCategory = 'service_server'
@@ -427,8 +455,18 @@ class ServiceServer(log.Loggable):
         self._actions = {}
         self._variables = {0: {}}
         self._subscribers = {}
+        self._subscriber_expiry = []
+        # the call of check_subscribers for the head of the expiry heap
+        self._expiry_call = None
+        self._expiry_due = None
+        self._subscription_stats = {'subscribed': 0, 'renewed': 0,
+                                    'unsubscribed': 0, 'expired': 0,
+                                    'dropped': 0}
 
         self._pending_notifications = {}
+        self._changed_variables = util.OrderedDict()
+        self._changes_call = None
+        self._moderated_sent = {}
 
         self.last_change = None
         self.init_var_and_actions()
@@ -441,17 +479,29 @@ class ServiceServer(log.Loggable):
 
         self.putChild(self.subscription_url, EventSubscriptionServer(self))
 
-        self.check_subscribers_loop = task.LoopingCall(self.check_subscribers)
-        self.check_subscribers_loop.start(120.0, now=False)
-
         self.check_moderated_loop = None
         if moderated_variables.has_key(self.service_type):
             self.check_moderated_loop = task.LoopingCall(self.check_moderated_variables)
-            self.check_moderated_loop.start(0.5, now=False)
+            self.check_moderated_loop.start(
+                moderation_check_interval(self.service_type), now=False)
+
+    def stop_checks(self):
+        """ stop the timers of this service, once it goes away """
+        if self._expiry_call is not None and self._expiry_call.active():
+            self._expiry_call.cancel()
+        self._expiry_call = None
+        self._expiry_due = None
+        if self.check_moderated_loop is not None and \
+           self.check_moderated_loop.running:
+            self.check_moderated_loop.stop()
 
     def _release(self):
-        for p in self._pending_notifications.values():
-            p.disconnect()
+        if self._changes_call is not None and self._changes_call.active():
+            self._changes_call.cancel()
+        self._changes_call = None
+        self._changed_variables.clear()
+        for sid in self._subscribers.keys():
+            event.notification_pool.drop(sid)
         self._pending_notifications = {}
 
     def get_action(self, action_name):
@@ -469,9 +519,83 @@ class ServiceServer(log.Loggable):
     def get_subscribers(self):
         return self._subscribers
 
+    def get_subscription_stats(self):
+        """ counters of the subscriptions this service has seen,
+            'active' being the number of current subscribers
+        """
+        stats = self._subscription_stats.copy()
+        stats['active'] = len(self._subscribers)
+        return stats
+
     def rm_notification(self, result, d):
         del self._pending_notifications[d]
 
+    def send_notification(self, s, xml):
+        d = event.send_notification(s, xml)
+        self._pending_notifications[d] = s['sid']
+        d.addErrback(self.notification_failed, s)
+        d.addBoth(self.rm_notification, d)
+
+    def notification_failed(self, failure, s):
+        if failure.check(event.SubscriberDropped):
+            self.remove_subscriber(s['sid'], 'dropped')
+
+    def schedule_expiry(self, subscriber):
+        """ (re)calculate when the subscription ends and put it
+            on the expiry heap, an older entry for the same
+            subscription is skipped once it comes up
+        """
+        timeout = 86400
+        if subscriber['timeout'].startswith('Second-'):
+            try:
+                timeout = int(subscriber['timeout'][len('Second-'):])
+            except ValueError:
+                pass
+        subscriber['expires'] = subscriber['created'] + timeout
+        heapq.heappush(self._subscriber_expiry,
+                       (subscriber['expires'], subscriber['sid']))
+        if len(self._subscriber_expiry) > 2 * len(self._subscribers) + 16:
+            self._subscriber_expiry = [(s['expires'], sid)
+                                       for sid, s in self._subscribers.items()
+                                       if 'expires' in s]
+            heapq.heapify(self._subscriber_expiry)
+        self._schedule_expiry_check()
+
+    def _schedule_expiry_check(self):
+        """ have check_subscribers called once the subscription
+            at the head of the expiry heap ends
+        """
+        due = None
+        if len(self._subscriber_expiry) > 0:
+            due = self._subscriber_expiry[0][0]
+        if self._expiry_call is not None and self._expiry_call.active():
+            if due == self._expiry_due:
+                return
+            self._expiry_call.cancel()
+        self._expiry_call = None
+        self._expiry_due = due
+        if due is not None:
+            self._expiry_call = reactor.callLater(max(0, due - time.time()),
+                                                  self.check_subscribers)
+
+    def renew_subscriber(self, subscriber, timeout):
+        subscriber['timeout'] = timeout
+        subscriber['created'] = time.time()
+        self._subscription_stats['renewed'] += 1
+        self.schedule_expiry(subscriber)
+
+    def remove_subscriber(self, sid, reason='unsubscribed'):
+        """ end the subscription sid, reason is one of 'unsubscribed',
+            'expired' or 'dropped'
+        """
+        subscriber = self._subscribers.pop(sid, None)
+        if subscriber is None:
+            return None
+        self.info("subscriber %s removed, %s", sid, reason)
+        self._subscription_stats[reason] += 1
+        event.notification_pool.drop(sid)
+        return subscriber
+
     def new_subscriber(self, subscriber):
         notify = []
         for vdict in self._variables.values():
@@ -499,10 +623,10 @@ class ServiceServer(log.Loggable):
 
         if evented_variables > 0:
             xml = ET.tostring(root, encoding='utf-8')
-            d, p = event.send_notification(subscriber, xml)
-            self._pending_notifications[d] = p
-            d.addBoth(self.rm_notification, d)
+            self.send_notification(subscriber, xml)
         self._subscribers[subscriber['sid']] = subscriber
+        self._subscription_stats['subscribed'] += 1
+        self.schedule_expiry(subscriber)
 
     def get_id(self):
         return self.id
@@ -541,11 +665,7 @@ class ServiceServer(log.Loggable):
             if(variable.send_events == True and
                 variable.moderated == False and
                 len(self._subscribers) > 0):
-                xml = self.build_single_notification(instance, variable_name, variable.value)
-                for s in self._subscribers.values():
-                    d, p = event.send_notification(s, xml)
-                    self._pending_notifications[d] = p
-                    d.addBoth(self.rm_notification, d)
+                self.variable_changed(variable)
         try:
             variable = self._variables[int(instance)][variable_name]
             if isinstance(value, defer.Deferred):
@@ -555,6 +675,21 @@ class ServiceServer(log.Loggable):
         except:
             pass
 
+    def variable_changed(self, variable):
+        """ gather the changes of non-moderated variables and event them
+            together once this reactor iteration is done, a variable
+            changing several times is evented with its latest value
+        """
+        self._changed_variables[(variable.instance, variable.name)] = variable
+        if self._changes_call is None:
+            self._changes_call = reactor.callLater(0, self.propagate_changes)
+
+    def propagate_changes(self):
+        self._changes_call = None
+        notify = self._changed_variables.values()
+        self._changed_variables.clear()
+        self.propagate_notification(notify)
+
     def get_variable(self, variable_name, instance=0):
         try:
             return self._variables[int(instance)][variable_name]
@@ -623,26 +758,33 @@ class ServiceServer(log.Loggable):
             return
         xml = ET.tostring(root, encoding='utf-8')
         for s in self._subscribers.values():
-            d, p = event.send_notification(s, xml)
-            self._pending_notifications[d] = p
-            d.addBoth(self.rm_notification, d)
+            self.send_notification(s, xml)
 
     def check_subscribers(self):
-        for s in self._subscribers.values():
-            timeout = 86400
-            if s['timeout'].startswith('Second-'):
-                timeout = int(s['timeout'][len('Second-'):])
-            if time.time() > s['created'] + timeout:
-                del s
+        now = time.time()
+        expiry = self._subscriber_expiry
+        while len(expiry) > 0 and expiry[0][0] <= now:
+            expires, sid = heapq.heappop(expiry)
+            s = self._subscribers.get(sid)
+            if s is not None and s['expires'] == expires:
+                self.remove_subscriber(sid, 'expired')
+        self._schedule_expiry_check()
 
     def check_moderated_variables(self):
         if len(self._subscribers) <= 0:
             return
         variables = moderated_variables[self.get_type()]
+        now = time.time()
         notify = []
         for v in variables:
-            for vdict in self._variables.values():
+            interval = moderation_intervals.get(v, 0)
+            for instance, vdict in self._variables.items():
                 if vdict[v].updated == True:
+                    # a variable evented too recently stays updated
+                    # and is picked up again by a later run
+                    if now - self._moderated_sent.get((instance, v), 0) < interval:
+                        continue
+                    self._moderated_sent[(instance, v)] = now
                     vdict[v].updated = False
                     notify.append(vdict[v])
         self.propagate_notification(notify)
@@ -752,6 +894,7 @@ class ServiceServer(log.Loggable):
             arguments_list.append(action.Argument(argument[0], argument[1].lower(), argument[2]))
 
         new_action = action.Action(self, name, implementation, arguments_list)
+        new_action.plan = action.DispatchPlan(new_action)
         self._actions[name] = new_action
         if callback != None:
             new_action.set_callback(callback)
@@ -810,6 +953,7 @@ class ServiceServer(log.Loggable):
                     raise LookupError, "missing callback"
 
             new_action = action.Action(self, name, implementation, arguments)
+            new_action.plan = action.DispatchPlan(new_action)
             self._actions[name] = new_action
             if callback != None:
                 new_action.set_callback(callback)
@@ -982,24 +1126,24 @@ class ServiceControl(log.Loggable):
         """
         self.debug('get_action_results %s', result)
         r = result
-        notify = []
-        for argument in action.get_out_arguments():
-            if argument.name[0:11] != 'A_ARG_TYPE_':
-                if action.get_callback() != None:
-                    variable = self.variables[instance][argument.get_state_variable()]
-                    variable.update(r[argument.name])
+        bindings = action.plan.bindings
+        if len(bindings) > 0:
+            variables = self.variables[instance]
+            if action.get_callback() != None:
+                notify = []
+                for name, state_variable in bindings:
+                    variable = variables[state_variable]
+                    variable.update(r[name])
                     if(variable.send_events == 'yes' and variable.moderated == False):
                         notify.append(variable)
-                else:
-                    variable = self.variables[instance][argument.get_state_variable()]
-                    r[argument.name] = variable.value
-            self.service.propagate_notification(notify)
+                self.service.propagate_notification(notify)
+            else:
+                for name, state_variable in bindings:
+                    r[name] = variables[state_variable].value
         self.info('action_results unsorted %s %s', action.name, r)
         if len(r) == 0:
             return r
-        ordered_result = OrderedDict()
-        for argument in action.get_out_arguments():
-            ordered_result[argument.name] = r[argument.name]
+        ordered_result = action.plan.build_result(r)
         self.info('action_results sorted %s %s', action.name, ordered_result)
         return ordered_result
 
@@ -1028,19 +1172,13 @@ class ServiceControl(log.Loggable):
                 kwargs['ObjectID'] = kwargs['ContainerID']
                 del kwargs['ContainerID']
 
-        in_arguments = action.get_in_arguments()
-        for arg_name, arg in kwargs.iteritems():
-            if arg_name.find('X_') == 0:
-                continue
-            l = [a for a in in_arguments if arg_name == a.get_name()]
-            if len(l) > 0:
-                in_arguments.remove(l[0])
-            else:
-                self.critical('argument %s not valid for action %s', arg_name, action.name)
-                return failure.Failure(errorCode(402))
-        if len(in_arguments) > 0:
+        invalid, missing = action.plan.check_arguments(kwargs)
+        if len(invalid) > 0:
+            self.critical('argument %s not valid for action %s', invalid[0], action.name)
+            return failure.Failure(errorCode(402))
+        if len(missing) > 0:
             self.critical('argument %s missing for action %s',
-                                [a.get_name() for a in in_arguments], action.name)
+                                list(missing), action.name)
             return failure.Failure(errorCode(402))
 
         def callit(*args, **kwargs):
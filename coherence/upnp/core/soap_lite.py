@@ -11,6 +11,9 @@
 
     inspired by ElementSOAP.py
 """
+import re
+from xml.parsers import expat
+
 from twisted.python.util import OrderedDict
 
 from coherence.extern.et import ET, textElement
@@ -22,6 +25,10 @@ NS_XSD = "{http://www.w3.org/1999/XMLSchema}"
 
 SOAP_ENCODING = "http://schemas.xmlsoap.org/soap/encoding/"
 
+# names as decode_call gets them from expat
+SOAP_BODY = "http://schemas.xmlsoap.org/soap/envelope/}Body"
+XSI_TYPE = "http://www.w3.org/1999/XMLSchema-instance}type"
+
 UPNPERRORS = {401: 'Invalid Action',
               402: 'Invalid Args',
               501: 'Action Failed',
@@ -119,8 +126,121 @@ def build_soap_call(method, arguments, is_response=False,
     preamble = """<?xml version="1.0" encoding="utf-8"?>"""
     return preamble + ET.tostring(envelope, 'utf-8')
 
-def decode_result(element):
-    type = element.get('{http://www.w3.org/1999/XMLSchema-instance}type')
+# size of the pieces a response is written in
+CHUNK_SIZE = 64 * 1024
+
+ENVELOPE_HEAD = ('<?xml version="1.0" encoding="utf-8"?>'
+                 '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"'
+                 ' s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+                 '<s:Body>')
+ENVELOPE_TAIL = '</s:Body></s:Envelope>'
+
+_response_templates = {}
+
+
+def _response_template(ns, method):
+    """ the envelope before and after the arguments of the response
+        to method of namespace ns
+    """
+    try:
+        return _response_templates[(ns, method)]
+    except KeyError:
+        pass
+    if ns:
+        head = '%s<u:%sResponse xmlns:u="%s">' % (ENVELOPE_HEAD, method,
+                                                  escape(ns).replace('"', '&quot;'))
+        tail = '</u:%sResponse>%s' % (method, ENVELOPE_TAIL)
+    else:
+        head = '%s<%sResponse>' % (ENVELOPE_HEAD, method)
+        tail = '</%sResponse>%s' % (method, ENVELOPE_TAIL)
+    template = _response_templates[(ns, method)] = (head, tail)
+    return template
+
+
+def escape(text):
+    """ text escaped for XML character data """
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def encode_value(value):
+    """ an argument value as UTF-8 string, as build_soap_call
+        encodes it, but not yet escaped
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, bool):
+        if value:
+            return '1'
+        return '0'
+    return str(value)
+
+
+class SOAPResponse(object):
+    """ the envelope of a response, written in pieces of CHUNK_SIZE
+
+        The envelope is taken from a template per action and the
+        argument values are escaped piece by piece while they are
+        written, so e.g. the DIDL-Lite Result of a Browse isn't
+        copied into an escaped envelope in one go.
+        length is the size of the whole envelope.
+    """
+
+    def __init__(self, ns, method, arguments):
+        head, tail = _response_template(ns, method)
+        self.parts = [head]
+        length = len(head) + len(tail)
+        for name, value in arguments.iteritems():
+            value = encode_value(value)
+            self.parts.extend(('<%s>' % name, (value,), '</%s>' % name))
+            length += (2 * len(name) + 5 + len(value) +
+                       4 * value.count('&') +
+                       3 * (value.count('<') + value.count('>')))
+        self.parts.append(tail)
+        self.length = length
+
+    def chunks(self):
+        """ the pieces of the envelope """
+        pending = []
+        size = 0
+        for part in self.parts:
+            if isinstance(part, tuple):
+                value = part[0]
+                if len(value) + size <= CHUNK_SIZE:
+                    pending.append(escape(value))
+                    size += len(pending[-1])
+                    continue
+                for i in xrange(0, len(value), CHUNK_SIZE):
+                    if pending:
+                        yield ''.join(pending)
+                        pending = []
+                        size = 0
+                    yield escape(value[i:i + CHUNK_SIZE])
+            else:
+                pending.append(part)
+                size += len(part)
+            if size >= CHUNK_SIZE:
+                yield ''.join(pending)
+                pending = []
+                size = 0
+        if pending:
+            yield ''.join(pending)
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
+
+def decode_value(text, type=None):
+    """ the value of an argument with text, typed by
+        its xsi:type attribute
+    """
     if type is not None:
         try:
             prefix, local = type.split(":")
@@ -130,10 +250,88 @@ def decode_result(element):
             pass
 
     if type in ("integer", "int"):
-        return int(element.text)
+        return int(text)
     elif type in ("float", "double"):
-        return float(element.text)
+        return float(text)
     elif type == "boolean":
-        return element.text == "true"
+        return text == "true"
+    else:
+        return text or ""
+
+
+def decode_result(element):
+    return decode_value(element.text,
+                        element.get('{http://www.w3.org/1999/XMLSchema-instance}type'))
+
+
+_non_ascii = re.compile('[\x80-\xff]').search
+
+
+def decode_call(chunks):
+    """ the (ns, method, arguments) of the action called by the
+        envelope coming in chunks, arguments being a list of
+        (name, value) pairs with the values decoded
+
+        The envelope is parsed with expat while it is fed, only the
+        first child of the Body and the text of its arguments are
+        taken, no tree is built and nothing after the action is
+        parsed. Raises ValueError for an envelope without an action
+        and expat.ExpatError for one that isn't well-formed.
+    """
+    # depth, within the Body, the action, the current argument
+    state = [0, False, None, None]
+    arguments = []
+    text = []
+
+    def start(name, attributes):
+        depth = state[0] = state[0] + 1
+        if depth == 4:
+            if state[1]:
+                state[3] = (name, attributes.get(XSI_TYPE))
+                del text[:]
+        elif depth == 3:
+            if state[1] and state[2] is None:
+                state[2] = name
+        elif depth == 2:
+            state[1] = name == SOAP_BODY
+
+    def end(name):
+        depth = state[0]
+        state[0] = depth - 1
+        if depth == 4:
+            if state[3] is not None:
+                name, type = state[3]
+                value = ''.join(text)
+                if _non_ascii(value):
+                    value = value.decode('utf-8')
+                if type is not None:
+                    value = decode_value(value, type)
+                arguments.append((name, value))
+                state[3] = None
+        elif depth == 3 and state[1]:
+            state[1] = False
+            parser.StartElementHandler = None
+            parser.EndElementHandler = None
+            parser.CharacterDataHandler = None
+
+    parser = expat.ParserCreate(None, '}')
+    parser.returns_unicode = False
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text.append
+    for data in chunks:
+        if '\x00' in data:
+            # Guess from who we're getting this?
+            data = data.replace('\x00', '')
+        parser.Parse(data, False)
+        if parser.EndElementHandler is None:
+            break
     else:
-        return element.text or ""
+        parser.Parse('', True)
+    if state[2] is None:
+        raise ValueError("no action in the SOAP envelope")
+    ns, method = None, state[2]
+    if '}' in method:
+        ns, method = method.rsplit('}', 1)
+    return ns, method, arguments
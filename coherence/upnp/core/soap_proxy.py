@@ -3,16 +3,196 @@
 
 # Copyright 2007 - Frank Scholz <coherence@beebits.net>
 
+from urlparse import urlparse
+
+from zope.interface import implements
+
+from twisted.internet import reactor, defer
+from twisted.internet.error import ConnectError, TimeoutError
 from twisted.python import failure
+from twisted.web import error
+from twisted.web.client import Agent, HTTPConnectionPool, readBody, \
+     ResponseNeverReceived, RequestTransmissionFailed
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
 
 from coherence import log
 
 from coherence.extern.et import ET, namespace_map_update
 
-from coherence.upnp.core.utils import getPage, parse_xml
+from coherence.upnp.core.utils import parse_xml
 
 from coherence.upnp.core import soap_lite
 
+# seconds to wait for the response to an action
+SOAP_TIMEOUT = 30
+# times a call is sent again when it couldn't reach the host, or when
+# an idle keep-alive connection turned out to be closed by the host,
+# a call lost on a new connection may have run already and isn't
+SOAP_RETRIES = 1
+# actions sent to one host at a time, further calls wait for them
+MAX_IN_FLIGHT = 4
+# seconds an idle connection is kept open
+SOAP_IDLE_TIMEOUT = 60
+
+USER_AGENT = 'Coherence PageGetter'
+
+
+class PayloadProducer(object):
+    """ writes a SOAP envelope in one go, without
+        going through a cooperator
+    """
+    implements(IBodyProducer)
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.length = len(payload)
+
+    def startProducing(self, consumer):
+        consumer.write(self.payload)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+class ReusingConnectionPool(HTTPConnectionPool):
+    """ tells whether the last connection handed out was an idle
+        one from the pool
+    """
+    reused = False
+
+    def getConnection(self, key, endpoint):
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        # an idle connection is handed out right away,
+        # a new one once it is connected
+        self.reused = d.called
+        return d
+
+
+class SOAPConnectionPool(log.Loggable):
+    """ persistent HTTP/1.1 connections to the hosts we call actions
+        on, with at most max_in_flight calls pending per host
+    """
+    logCategory = 'soap'
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        log.Loggable.__init__(self)
+        self.max_in_flight = max_in_flight
+        self.pool = ReusingConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_in_flight
+        self.pool.cachedConnectionTimeout = SOAP_IDLE_TIMEOUT
+        # we do the retrying ourselves, for POST too
+        self.pool.retryAutomatically = False
+        self.agent = Agent(reactor, pool=self.pool)
+        self._semaphores = {}
+
+    def request(self, url, headers, payload,
+                timeout=SOAP_TIMEOUT, retries=SOAP_RETRIES):
+        """ POST payload to url, returns a Deferred firing with
+            (body, headers) like utils.getPage does, or failing
+            with a twisted.web.error.Error for an HTTP error status
+        """
+        host = urlparse(url).netloc
+        try:
+            semaphore = self._semaphores[host]
+        except KeyError:
+            semaphore = self._semaphores[host] = \
+                defer.DeferredSemaphore(self.max_in_flight)
+
+        def release(result):
+            if (not semaphore.waiting and
+                semaphore.tokens == semaphore.limit):
+                self._semaphores.pop(host, None)
+            return result
+
+        d = semaphore.run(self._request, url, headers, payload,
+                          timeout, retries)
+        d.addBoth(release)
+        return d
+
+    def _request(self, url, headers, payload, timeout, retries):
+        http_headers = Headers()
+        for name, value in headers.items():
+            http_headers.setRawHeaders(name, [value])
+        if not http_headers.hasHeader('user-agent'):
+            http_headers.setRawHeaders('user-agent', [USER_AGENT])
+        self.pool.reused = False
+        d = self.agent.request('POST', url, http_headers,
+                               PayloadProducer(payload))
+        reused = self.pool.reused
+        timed_out = []
+
+        def cancel():
+            timed_out.append(True)
+            d.cancel()
+
+        timeout_call = reactor.callLater(timeout, cancel)
+
+        def got_response(response):
+            d = readBody(response)
+            d.addCallback(got_body, response)
+            return d
+
+        def got_body(body, response):
+            if not 200 <= response.code < 300:
+                raise error.Error(str(response.code), response.phrase, body)
+            return body, dict((name.lower(), values) for name, values
+                              in response.headers.getAllRawHeaders())
+
+        def got_result(result):
+            if timeout_call.active():
+                timeout_call.cancel()
+            return result
+
+        def got_error(failure):
+            if timed_out:
+                self.warning("no response from %s within %ds", url, timeout)
+                raise TimeoutError(url)
+            if retries > 0 and (failure.check(ConnectError) or
+                                (reused and
+                                 failure.check(ResponseNeverReceived,
+                                               RequestTransmissionFailed))):
+                self.info("resending call to %s: %s", url,
+                          failure.getErrorMessage())
+                return self._request(url, headers, payload,
+                                     timeout, retries - 1)
+            return failure
+
+        d.addCallback(got_response)
+        d.addBoth(got_result)
+        d.addErrback(got_error)
+        return d
+
+    def close(self):
+        """ drop all connections, returns a Deferred firing
+            once they are closed
+        """
+        return self.pool.closeCachedConnections()
+
+
+pool = None
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        pool = SOAPConnectionPool()
+    return pool
+
+
+def close_connections():
+    """ close the connections of the module pool """
+    global pool
+    if pool is None:
+        return defer.succeed(None)
+    d = pool.close()
+    pool = None
+    return d
+
 
 class SOAPProxy(log.Loggable):
     """ A Proxy for making remote SOAP calls.
@@ -29,7 +209,8 @@ class SOAPProxy(log.Loggable):
 
     logCategory = 'soap'
 
-    def __init__(self, url, namespace=None, envelope_attrib=None, header=None, soapaction=None):
+    def __init__(self, url, namespace=None, envelope_attrib=None, header=None, soapaction=None,
+                 timeout=SOAP_TIMEOUT, retries=SOAP_RETRIES):
         log.Loggable.__init__(self)
         self.url = url
         self.namespace = namespace
@@ -37,14 +218,18 @@ class SOAPProxy(log.Loggable):
         self.action = None
         self.soapaction = soapaction
         self.envelope_attrib = envelope_attrib
+        self.timeout = timeout
+        self.retries = retries
 
     def callRemote(self, soapmethod, arguments):
         soapaction = soapmethod or self.soapaction
         if '#' not in soapaction:
             soapaction = '#'.join((self.namespace[1], soapaction))
-        self.action = soapaction.split('#')[1]
+        # the action of the last call, the result of each
+        # call is looked up by its own action
+        action = self.action = soapaction.split('#')[1]
 
-        self.info("callRemote %r %r %r %r", self.soapaction, soapmethod, self.namespace, self.action)
+        self.info("callRemote %r %r %r %r", self.soapaction, soapmethod, self.namespace, action)
 
         headers = {'content-type': 'text/xml ;charset="utf-8"',
                     'SOAPACTION': '"%s"' % soapaction, }
@@ -52,10 +237,10 @@ class SOAPProxy(log.Loggable):
             headers.update(arguments['headers'])
             del arguments['headers']
 
-        payload = soap_lite.build_soap_call("{%s}%s" % (self.namespace[1], self.action), arguments,
+        payload = soap_lite.build_soap_call("{%s}%s" % (self.namespace[1], action), arguments,
                                             encoding=None)
 
-        self.info("callRemote soapaction:  %s %s", self.action, self.url)
+        self.info("callRemote soapaction:  %s %s", action, self.url)
         self.debug("callRemote payload:  %s", payload)
 
         def gotError(error, url):
@@ -71,11 +256,13 @@ class SOAPProxy(log.Loggable):
                 self.debug(traceback.format_exc())
             return error
 
-        return getPage(self.url, postdata=payload, method="POST",
-                        headers=headers
-                      ).addCallbacks(self._cbGotResult, gotError, None, None, [self.url], None)
+        d = get_pool().request(self.url, headers, payload,
+                               timeout=self.timeout, retries=self.retries)
+        return d.addCallbacks(self._cbGotResult, gotError, [action], None, [self.url], None)
 
-    def _cbGotResult(self, result):
+    def _cbGotResult(self, result, action=None):
+        if action is None:
+            action = self.action
         #print "_cbGotResult 1", result
         page, headers = result
         #result = SOAPpy.parseSOAPRPC(page)
@@ -89,17 +276,17 @@ class SOAPProxy(log.Loggable):
         self.debug("result: %r", page)
 
         tree = parse_xml(page)
-        #print tree, "find %s" % self.action
+        #print tree, "find %s" % action
 
         #root = tree.getroot()
         #print_c(root)
 
         body = tree.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')
         #print "body", body
-        response = body.find('{%s}%sResponse' % (self.namespace[1], self.action))
+        response = body.find('{%s}%sResponse' % (self.namespace[1], action))
         if response == None:
             """ fallback for improper SOAP action responses """
-            response = body.find('%sResponse' % self.action)
+            response = body.find('%sResponse' % action)
         self.debug("callRemote response  %s", response)
         result = {}
         if response != None:
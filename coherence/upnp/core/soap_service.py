@@ -3,20 +3,28 @@
 
 # Copyright 2007 - Frank Scholz <coherence@beebits.net>
 
+from xml.parsers import expat
+
 from twisted.web import server, resource
 from twisted.python import failure
+from twisted.python.util import OrderedDict
 from twisted.internet import defer
 
 from coherence import log, SERVER_ID
 
 from coherence.extern.et import ET, namespace_map_update
 
-from coherence.upnp.core.utils import parse_xml
-
 from coherence.upnp.core import soap_lite
 
 import coherence.extern.louie as louie
 
+# the request body is parsed in pieces of this size
+REQUEST_CHUNK_SIZE = 4096
+
+# sent with the headers and body of each request,
+# when something is connected to it
+COMMAND_RECEIVED = 'UPnPTest.Control.Client.CommandReceived'
+
 
 class errorCode(Exception):
     def __init__(self, status):
@@ -24,6 +32,35 @@ class errorCode(Exception):
         self.status = status
 
 
+class ResponseProducer(object):
+    """ writes the chunks of a SOAPResponse whenever
+        the transport took the one before
+    """
+
+    def __init__(self, request, response):
+        self.request = request
+        self.chunks = response.chunks()
+
+    def start(self):
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.request is None:
+            return
+        try:
+            chunk = self.chunks.next()
+        except StopIteration:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+        else:
+            self.request.write(chunk)
+
+    def stopProducing(self):
+        self.request = None
+        self.chunks = None
+
+
 class UPnPPublisher(resource.Resource, log.Loggable):
     """ Based upon twisted.web.soap.SOAPPublisher and
         extracted to remove the SOAPpy dependency
@@ -38,6 +75,7 @@ class UPnPPublisher(resource.Resource, log.Loggable):
     envelope_attrib = None
 
     def _sendResponse(self, request, response, status=200):
+        """ response is either a string or a SOAPResponse """
         self.debug('_sendResponse %s %s', status, response)
         if status == 200:
             request.setResponseCode(200)
@@ -49,9 +87,16 @@ class UPnPPublisher(resource.Resource, log.Loggable):
         else:
             mimeType = "text/xml"
         request.setHeader("Content-type", mimeType)
-        request.setHeader("Content-length", str(len(response)))
         request.setHeader("EXT", '')
         request.setHeader("SERVER", SERVER_ID)
+        if isinstance(response, soap_lite.SOAPResponse):
+            request.setHeader("Content-length", str(response.length))
+            if response.length > soap_lite.CHUNK_SIZE:
+                ResponseProducer(request, response).start()
+                return
+            response = str(response)
+        else:
+            request.setHeader("Content-length", str(len(response)))
         request.write(response)
         request.finish()
 
@@ -62,10 +107,12 @@ class UPnPPublisher(resource.Resource, log.Loggable):
     def _gotResult(self, result, request, methodName, ns):
         self.debug('_gotResult %s %s %s %s', result, request, methodName, ns)
 
-        response = soap_lite.build_soap_call("{%s}%s" % (ns, methodName), result,
-                                                is_response=True,
-                                                encoding=None)
-        #print "SOAP-lite response", response
+        if isinstance(result, (dict, OrderedDict)):
+            response = soap_lite.SOAPResponse(ns, methodName, result)
+        else:
+            response = soap_lite.build_soap_call("{%s}%s" % (ns, methodName), result,
+                                                    is_response=True,
+                                                    encoding=None)
         self._sendResponse(request, response)
 
     def _gotError(self, failure, request, methodName, ns):
@@ -92,44 +139,30 @@ class UPnPPublisher(resource.Resource, log.Loggable):
 
     def render(self, request):
         """Handle a SOAP command."""
-        data = request.content.read()
         headers = request.getAllHeaders()
         self.info('soap_request: %s', headers)
 
-        # allow external check of data
-        louie.send('UPnPTest.Control.Client.CommandReceived', None, headers, data)
-
-        def print_c(e):
-            for c in e.getchildren():
-                print c, c.tag
-                print_c(c)
-
-        tree = parse_xml(data)
-        #root = tree.getroot()
-        #print_c(root)
-
-        body = tree.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        method = body.getchildren()[0]
-        methodName = method.tag
-        ns = None
-
-        if methodName.startswith('{') and methodName.rfind('}') > 1:
-            ns, methodName = methodName[1:].split('}')
-
-        args = []
-        kwargs = {}
-        for child in method.getchildren():
-            kwargs[child.tag] = soap_lite.decode_result(child)
-            args.append(kwargs[child.tag])
-
-        #p, header, body, attrs = SOAPpy.parseSOAPRPC(data, 1, 1, 1)
-        #methodName, args, kwargs, ns = p._name, p._aslist, p._asdict, p._ns
-
         try:
             headers['content-type'].index('text/xml')
         except:
-            self._gotError(failure.Failure(errorCode(415)), request, methodName)
+            self._gotError(failure.Failure(errorCode(415)), request, None, None)
+            return server.NOT_DONE_YET
+
+        if louie.has_receivers(COMMAND_RECEIVED):
+            # allow external check of data
+            data = request.content.read()
+            louie.send(COMMAND_RECEIVED, None, headers, data)
+            chunks = [data]
+        else:
+            chunks = iter(lambda: request.content.read(REQUEST_CHUNK_SIZE), '')
+
+        try:
+            ns, methodName, arguments = soap_lite.decode_call(chunks)
+        except (expat.ExpatError, ValueError), msg:
+            self.info('no action in the SOAP request: %s', msg)
+            self._gotError(failure.Failure(errorCode(401)), request, None, None)
             return server.NOT_DONE_YET
+        args = [value for name, value in arguments]
 
         self.debug('headers: %r', headers)
 
@@ -153,8 +186,7 @@ class UPnPPublisher(resource.Resource, log.Loggable):
             if(headers.has_key('user-agent') and
                     headers['user-agent'].find('Philips-Software-WebClient/4.32') == 0):
                 keywords['X_UPnPClient'] = 'Philips-TV'
-            for k, v in kwargs.items():
-                keywords[str(k)] = v
+            keywords.update(arguments)
             self.info('call %s %s', methodName, keywords)
             if hasattr(function, "useKeywords"):
                 d = defer.maybeDeferred(function, **keywords)
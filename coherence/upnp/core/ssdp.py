@@ -11,6 +11,8 @@
 #
 
 import random
+import re
+import heapq
 import string
 import sys
 import time
@@ -20,14 +22,58 @@ from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor, error
 from twisted.internet import task
 from twisted.web.http import datetimeToString
+from twisted.python.util import OrderedDict
 
 from coherence import log, SERVER_ID
-from coherence.upnp.core import utils
 import coherence.extern.louie as louie
 
 SSDP_PORT = 1900
 SSDP_ADDR = '239.255.255.250'
 
+# the headers of a M-SEARCH response, in the order they are sent
+RESPONSE_HEADERS = ('CACHE-CONTROL', 'EXT', 'LOCATION', 'SERVER', 'ST', 'USN')
+
+# the headers of a received datagram SSDP processing looks at
+DATAGRAM_HEADERS = frozenset(('cache-control', 'location', 'mx', 'nt',
+                              'nts', 'server', 'st', 'usn'))
+
+# seconds a repeated announcement of a service is ignored
+DUPLICATE_WINDOW = 2.0
+
+# seconds a remote service is kept beyond its max-age
+EXPIRY_GRACE = 30
+
+_max_age_re = re.compile(r'max-age\s*=\s*(\d+)', re.IGNORECASE)
+
+
+def parse_max_age(cache_control, default=1800):
+    """ the max-age in seconds of a CACHE-CONTROL header value """
+    match = _max_age_re.search(cache_control or '')
+    if match is None:
+        return default
+    return int(match.group(1))
+
+
+def parse_datagram(data):
+    """ split a SSDP datagram into the first two elements of its
+        start line and a dict of the DATAGRAM_HEADERS found,
+        with lowercased names
+    """
+    end = data.find('\r\n\r\n')
+    if end != -1:
+        data = data[:end]
+    lines = data.splitlines()
+    if len(lines) == 0:
+        return [], {}
+    cmd = lines[0].split(None, 2)[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        if name in DATAGRAM_HEADERS:
+            headers[name] = value.strip()
+    return cmd, headers
+
 
 class SSDPServer(DatagramProtocol, log.Loggable):
     """A class implementing a SSDP server.  The notifyReceived and
@@ -39,11 +85,24 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         # Create SSDP server
         log.Loggable.__init__(self)
         self._known = {}
+        # local registrations, st -> [usn] and usn -> pre-rendered
+        # M-SEARCH response without the DATE header
+        self._local_by_st = {}
+        self._responses = OrderedDict()
+        # (host, port, st) -> time until which the same search is ignored
+        self._searches = {}
+        # usn -> ((nts, location), time until a repetition is ignored)
+        self._recent = {}
+        # remote registrations, usn -> max-age, and a heap of
+        # (expiry time, usn), outdated entries are skipped
+        self._max_age = {}
+        self._expiry = []
+        self._expire_call = None
+        self._expire_at = None
         self._callbacks = {}
         self.__test = test
         self.active_calls = []
         self._resend_notify_loop = None
-        self._expire_loop = None
         self._port = None
         if not self.__test:
             try:
@@ -61,10 +120,6 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             # notify every 777 seconds (~ 13 Minutes)
             self._resend_notify_loop.start(777.0, now=False)
 
-            self._expire_loop = task.LoopingCall(self._expire)
-            # expire every 333 seconds (~ 5.5 Minutes)
-            self._expire_loop.start(333.0, now=False)
-
     def stopNotifying(self):
         if self._resend_notify_loop and self._resend_notify_loop.running:
             self._resend_notify_loop.stop()
@@ -77,8 +132,9 @@ class SSDPServer(DatagramProtocol, log.Loggable):
                 call.cancel()
         if not self.__test:
             self.stopNotifying()
-            if self._expire_loop.running:
-                self._expire_loop.stop()
+            if self._expire_call is not None and self._expire_call.active():
+                self._expire_call.cancel()
+            self._expire_call = None
             # Make sure we send out the byebye notifications.
             for st in self._known:
                 if self._known[st]['MANIFESTATION'] == 'local':
@@ -86,23 +142,46 @@ class SSDPServer(DatagramProtocol, log.Loggable):
 
     def datagramReceived(self, data, (host, port)):
         """Handle a received multicast datagram."""
-        cmd, headers, content = utils.parse_http_response(data)
-        cmd = cmd[:2] # we are interested in only the first two elements
-        del content # we do not need the content
-        self.info('SSDP command %s %s - from %s:%d', cmd[0], cmd[1], host, port)
+        cmd, headers = parse_datagram(data)
+        self.info('SSDP command %s - from %s:%d', ' '.join(cmd), host, port)
         self.debug('with headers: %s', headers)
         if cmd == ['M-SEARCH', '*']:
             # SSDP discovery
             self._discoveryRequest(headers, (host, port))
         elif cmd == ['NOTIFY', '*']:
             # SSDP presence
-            self._notifyReceived(headers, (host, port))
+            if not self.is_duplicate(headers):
+                self._notifyReceived(headers, (host, port))
         else:
-            self.warning('Unknown SSDP command %s %s', *cmd)
+            self.warning('Unknown SSDP command %s', ' '.join(cmd))
 
         # make raw data available
         # send out the signal after we had a chance to register the device
-        louie.send('UPnP.SSDP.datagram_received', None, data, host, port)
+        if louie.has_receivers('UPnP.SSDP.datagram_received'):
+            louie.send('UPnP.SSDP.datagram_received', None, data, host, port)
+
+    def is_duplicate(self, headers):
+        """ tell whether the same announcement of a service, by its
+            USN, NTS and LOCATION, was processed within the last
+            DUPLICATE_WINDOW seconds
+        """
+        usn = headers.get('usn')
+        if usn is None:
+            return False
+        now = reactor.seconds()
+        key = (headers.get('nts'), headers.get('location'))
+        try:
+            last_key, until = self._recent[usn]
+            if last_key == key and until > now:
+                self.debug('ignoring repeated announcement of %r', usn)
+                return True
+        except KeyError:
+            if len(self._recent) > 2 * len(self._known) + 64:
+                for k, (_, until) in self._recent.items():
+                    if until <= now:
+                        del self._recent[k]
+        self._recent[usn] = (key, now + DUPLICATE_WINDOW)
+        return False
 
     def register(self, manifestation, usn, st, location,
                         server=SERVER_ID,
@@ -129,7 +208,12 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         self.debug('%r', self._known[usn])
 
         if manifestation == 'local':
+            self._max_age.pop(usn, None)
+            self._index(usn)
             self.doNotify(usn)
+        else:
+            self._max_age[usn] = parse_max_age(cache_control)
+            self._schedule_expiry(usn)
 
         if st == 'upnp:rootdevice':
             louie.send('Coherence.UPnP.SSDP.new_device', None,
@@ -137,7 +221,7 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             #self.callback("new_device", st, self._known[usn])
 
     def unRegister(self, usn):
-        if not self._isKnown(usn):
+        if not self.isKnown(usn):
             return
         self.info("Un-registering %s", usn)
         st = self._known[usn]['ST']
@@ -145,8 +229,29 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             louie.send('Coherence.UPnP.SSDP.removed_device', None,
                        device_type=st, infos=self._known[usn])
             #self.callback("removed_device", st, self._known[usn])
+        self._unindex(usn)
+        self._max_age.pop(usn, None)
         del self._known[usn]
 
+    def _index(self, usn):
+        """ make a local registration available for M-SEARCH responses """
+        self._unindex(usn)
+        entry = self._known[usn]
+        response = ['HTTP/1.1 200 OK']
+        response.extend('%s: %s' % (k, entry[k]) for k in RESPONSE_HEADERS)
+        response.append('')
+        self._responses[usn] = '\r\n'.join(response)
+        self._local_by_st.setdefault(entry['ST'], []).append(usn)
+
+    def _unindex(self, usn):
+        if self._responses.pop(usn, None) is None:
+            return
+        for st, usns in self._local_by_st.items():
+            if usn in usns:
+                usns.remove(usn)
+                if len(usns) == 0:
+                    del self._local_by_st[st]
+
     def isKnown(self, usn):
         return self._known.has_key(usn)
 
@@ -159,6 +264,8 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         """
         try:
             self._known[headers['usn']]['last-seen'] = time.time()
+            if headers['usn'] in self._max_age:
+                self._schedule_expiry(headers['usn'])
         except KeyError:
             self.register('remote', headers['usn'], service_type,
                           headers['location'], headers['server'],
@@ -185,13 +292,20 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         louie.send('Coherence.UPnP.Log', None, 'SSDP', host,
                    'Notify %s for %s' % (headers['nts'], headers['usn']))
 
-    def __send__discovery_request(self, response, destination, delay, usn):
-        self.info('send discovery response delayed by %ds for %s to %r',
-                  delay, usn, destination)
-        try:
-            self.transport.write(response, destination)
-        except (AttributeError, socket.error), msg:
-            self.info("failure sending out byebye notification: %r", msg)
+    def __send__discovery_request(self, usns, destination, delay, st):
+        self.info('send discovery responses delayed by %ds for %s to %r',
+                  delay, st, destination)
+        date = 'DATE: %s\r\n\r\n' % datetimeToString()
+        for usn in usns:
+            response = self._responses.get(usn)
+            if response is None:
+                # unregistered in the meantime
+                continue
+            try:
+                self.transport.write(response + date, destination)
+            except (AttributeError, socket.error), msg:
+                self.info("failure sending out discovery response: %r", msg)
+                break
 
     def _discoveryRequest(self, headers, (host, port)):
         """Process a discovery request.  The response must be sent to
@@ -202,25 +316,35 @@ class SSDPServer(DatagramProtocol, log.Loggable):
         louie.send('Coherence.UPnP.Log', None, 'SSDP', host,
                    'M-Search for %s' % headers['st'])
         # Do we know about this service?
-        for known in self._known.values():
-            if known['MANIFESTATION'] == 'remote':
-                continue
-            elif known['SILENT'] and headers['st'] == 'ssdp:all':
-                continue
-            elif (headers['st'] == known['ST'] or
-                  headers['st'] == 'ssdp:all'):
-                response = []
-                response.append('HTTP/1.1 200 OK')
-                for k, v in known.iteritems():
-                    if k not in ('MANIFESTATION', 'SILENT', 'HOST'):
-                        response.append('%s: %s' % (k, v))
-                response.append('DATE: %s' % datetimeToString())
-                response.extend(('', ''))
-                response = '\r\n'.join(response)
-
-                delay = random.randint(0, int(headers['mx']))
-                reactor.callLater(delay, self.__send__discovery_request,
-                                  response, (host, port), delay, known['USN'])
+        st = headers['st']
+        if st == 'ssdp:all':
+            usns = [usn for usn in self._responses.keys()
+                    if not self._known[usn]['SILENT']]
+        else:
+            usns = self._local_by_st.get(st, [])[:]
+        if len(usns) == 0:
+            return
+        try:
+            mx = int(headers['mx'])
+        except (KeyError, ValueError):
+            mx = 0
+
+        # answer a searcher repeating itself only once per MX window
+        now = reactor.seconds()
+        key = (host, port, st)
+        if self._searches.get(key, 0) > now:
+            self.info('ignoring repeated discovery request from (%s,%d) for %s',
+                      host, port, st)
+            return
+        if len(self._searches) > 256:
+            for k, until in self._searches.items():
+                if until <= now:
+                    del self._searches[k]
+        self._searches[key] = now + max(mx, 1)
+
+        delay = random.randint(0, mx)
+        reactor.callLater(delay, self.__send__discovery_request,
+                          usns, (host, port), delay, st)
 
     def __build_response(self, cmd, usn):
         resp = ['NOTIFY * HTTP/1.1',
@@ -271,29 +395,50 @@ class SSDPServer(DatagramProtocol, log.Loggable):
             if entry['MANIFESTATION'] == 'local':
                 self.doNotify(usn)
 
+    def _expires(self, usn):
+        return (self._known[usn]['last-seen'] + self._max_age[usn] +
+                EXPIRY_GRACE)
+
+    def _schedule_expiry(self, usn):
+        """ put the current expiry time of the remote service usn
+            on the heap, and make sure _expire runs by then
+        """
+        heapq.heappush(self._expiry, (self._expires(usn), usn))
+        if len(self._expiry) > 2 * len(self._max_age) + 64:
+            self._expiry = [(self._expires(u), u) for u in self._max_age]
+            heapq.heapify(self._expiry)
+        self._schedule_expire_call()
+
+    def _schedule_expire_call(self):
+        if self.__test or len(self._expiry) == 0:
+            return
+        expires = self._expiry[0][0]
+        if self._expire_call is not None and self._expire_call.active():
+            if self._expire_at <= expires:
+                return
+            self._expire_call.cancel()
+        self._expire_at = expires
+        self._expire_call = reactor.callLater(max(0, expires - time.time()),
+                                              self._expire)
+
     def _expire(self):
-        """ check if the discovered devices are still ok, or
-            if we haven't received a new discovery response
+        """ remove the discovered devices and services we haven't
+            received a new announcement for within their max-age
         """
-        self.debug("Checking devices/services are still valid")
-        removable = []
-        for usn, entry in self._known.iteritems():
-            if entry['MANIFESTATION'] == 'local':
+        self._expire_call = None
+        now = time.time()
+        while len(self._expiry) > 0 and self._expiry[0][0] < now:
+            expires, usn = heapq.heappop(self._expiry)
+            if usn not in self._max_age or self._expires(usn) != expires:
                 continue
-            expiry = int(entry['CACHE-CONTROL'].split('=')[1])
-            now = time.time()
-            last_seen = entry['last-seen']
-            self.debug("Checking if %r is still valid - "
-                       "last seen %d (+%d), now %d",
-                       entry['USN'], last_seen, expiry, now)
-            if last_seen + expiry + 30 < now:
-                self.debug("Expiring: %r", entry)
-                if entry['ST'] == 'upnp:rootdevice':
-                    louie.send('Coherence.UPnP.SSDP.removed_device', None,
-                               device_type=entry['ST'], infos=entry)
-                removable.append(usn)
-        for usn in removable:
+            entry = self._known[usn]
+            self.debug("Expiring: %r", entry)
+            if entry['ST'] == 'upnp:rootdevice':
+                louie.send('Coherence.UPnP.SSDP.removed_device', None,
+                           device_type=entry['ST'], infos=entry)
+            del self._max_age[usn]
             del self._known[usn]
+        self._schedule_expire_call()
 
     def subscribe(self, name, callback):
         self._callbacks.setdefault(name, []).append(callback)
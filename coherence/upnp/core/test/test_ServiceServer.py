@@ -18,8 +18,11 @@ except ImportError:
 from twisted.trial import unittest
 from twisted.internet.defer import Deferred
 from twisted.internet import task
+from twisted.internet.error import ConnectionRefusedError
+from twisted.python import failure
+from twisted.test.proto_helpers import MemoryReactorClock
 
-from coherence.upnp.core import service, device
+from coherence.upnp.core import service, device, event
 from coherence.extern.et import ET
 
 
@@ -93,14 +96,7 @@ class ValidButEmptyDescriptionXML(unittest.TestCase):
             'UnknownService', version=1, backend=None)
 
     def tearDown(self):
-        try:
-            self.service_server.check_subscribers_loop.stop()
-        except AttributeError:
-            pass
-        try:
-            self.service_server.service_service.check_moderated_loop.stop()
-        except AttributeError:
-            pass
+        self.service_server.stop_checks()
 
     def test_init(self):
         """ Test initialization of ServiceServer() instance """
@@ -128,7 +124,7 @@ class ValidButEmptyDescriptionXML(unittest.TestCase):
         # :todo: implement a test for
         # self.putChild(self.subscription_url, EventSubscriptionServer(self))
 
-        self.assertIsInstance(srv.check_subscribers_loop,task.LoopingCall)
+        self.assertIs(srv._expiry_call, None)
         self.assertIs(srv.check_moderated_loop, None)
 
     def test_getters(self):
@@ -267,14 +263,7 @@ class ValidDescriptionXML_SwitchPower(unittest.TestCase,
             'SwitchPower', version=1, backend=None)
 
     def tearDown(self):
-        try:
-            self.service_server.check_subscribers_loop.stop()
-        except AttributeError:
-            pass
-        try:
-            self.service_server.service_service.check_moderated_loop.stop()
-        except AttributeError:
-            pass
+        self.service_server.stop_checks()
 
     def test_init(self):
         """ Test initialization of ServiceServer() instance """
@@ -301,7 +290,7 @@ class ValidDescriptionXML_SwitchPower(unittest.TestCase,
         # :todo: implement a test for
         # self.putChild(self.subscription_url, EventSubscriptionServer(self))
 
-        self.assertIsInstance(srv.check_subscribers_loop,task.LoopingCall)
+        self.assertIs(srv._expiry_call, None)
         self.assertIs(srv.check_moderated_loop, None)
 
     def test_getters(self):
@@ -329,6 +318,233 @@ class ValidDescriptionXML_SwitchPower(unittest.TestCase,
         self.assertIs(srv.propagate_notification([]), None)
 
 
+
+class FakeNotificationPool(object):
+
+    def __init__(self):
+        self.sent = []
+        self.xml = []
+        self.dropped = []
+
+    def send(self, s, xml):
+        d = Deferred()
+        self.sent.append((s['sid'], d))
+        self.xml.append(xml)
+        return d
+
+    def drop(self, sid):
+        self.dropped.append(sid)
+
+
+class Subscriptions_SwitchPower(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakeNotificationPool()
+        self.patch(event, 'notification_pool', self.pool)
+        self.service_server = ServiceServer4Test(
+            'SwitchPower', version=1, backend=None)
+
+    def tearDown(self):
+        self.service_server.stop_checks()
+
+    def subscribe(self, sid, created, timeout='Second-300'):
+        s = {'sid': sid, 'callback': 'http://127.0.0.1:4004/events',
+             'seq': 0, 'timeout': timeout, 'created': created}
+        self.service_server.new_subscriber(s)
+        return s
+
+    def test_expiry(self):
+        srv = self.service_server
+        now = time.time()
+        self.subscribe('uuid:1', now - 400)
+        self.subscribe('uuid:2', now)
+        self.assertEqual([sid for sid, d in self.pool.sent],
+                         ['uuid:1', 'uuid:2'])
+        srv.check_subscribers()
+        self.assertEqual(srv.get_subscribers().keys(), ['uuid:2'])
+        self.assertEqual(self.pool.dropped, ['uuid:1'])
+        stats = srv.get_subscription_stats()
+        self.assertEqual(stats['active'], 1)
+        self.assertEqual(stats['subscribed'], 2)
+        self.assertEqual(stats['expired'], 1)
+
+    def test_renew(self):
+        srv = self.service_server
+        s = self.subscribe('uuid:1', time.time() - 200)
+        for i in range(50):
+            srv.renew_subscriber(s, 'Second-100')
+        # stale heap entries are skipped and compacted
+        self.assertTrue(len(srv._subscriber_expiry) <= 18)
+        s['created'] -= 150
+        srv.check_subscribers()
+        self.assertEqual(srv.get_subscribers(), {'uuid:1': s})
+        srv.renew_subscriber(s, 'Second-1')
+        now = time.time()
+        self.patch(time, 'time', lambda: now + 2)
+        srv.check_subscribers()
+        self.assertEqual(srv.get_subscribers(), {})
+        stats = srv.get_subscription_stats()
+        self.assertEqual((stats['renewed'], stats['expired']), (51, 1))
+
+    def test_expiry_call(self):
+        """ a subscription is removed once it ends, the call
+            follows the head of the expiry heap
+        """
+        clock = task.Clock()
+        self.patch(service, 'reactor', clock)
+        srv = self.service_server
+        now = time.time()
+        self.patch(time, 'time', lambda: now)
+        s = self.subscribe('uuid:1', now)
+        self.assertEqual(clock.getDelayedCalls()[0].getTime(), 300)
+        srv.renew_subscriber(s, 'Second-10')
+        self.subscribe('uuid:2', now, 'Second-60')
+        self.assertEqual([c.getTime() for c in clock.getDelayedCalls()], [10])
+        now += 10
+        clock.advance(10)
+        self.assertEqual(srv.get_subscribers().keys(), ['uuid:2'])
+        self.assertEqual([c.getTime() for c in clock.getDelayedCalls()], [60])
+        srv.remove_subscriber('uuid:2')
+        # stale heap entries are popped as they come up
+        now += 290
+        clock.advance(290)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(srv.get_subscription_stats()['expired'], 1)
+
+    def test_dropped(self):
+        srv = self.service_server
+        s = self.subscribe('uuid:1', time.time())
+        srv.send_notification(s, '<e/>')
+        self.assertEqual(len(srv._pending_notifications), 2)
+        for sid, d in self.pool.sent:
+            d.errback(event.SubscriberDropped(sid))
+        self.assertEqual(srv._pending_notifications, {})
+        self.assertEqual(srv.get_subscribers(), {})
+        self.assertEqual(srv.get_subscription_stats()['dropped'], 1)
+        srv.remove_subscriber('uuid:1')
+        self.assertEqual(srv.get_subscription_stats()['unsubscribed'], 0)
+
+    def test_dead_subscriber(self):
+        """ a subscriber failing its notifications one after the
+            other is removed through the real notification pool
+        """
+        clock = MemoryReactorClock()
+        self.patch(event, 'reactor', clock)
+        self.patch(event, 'notification_pool', event.NotificationPool())
+        srv = self.service_server
+        s = self.subscribe('uuid:1', time.time())
+        for i in range(event.MAX_NOTIFICATION_FAILURES):
+            if i > 0:
+                srv.send_notification(s, '<e/>')
+            self.assertEqual(srv.get_subscribers().keys(), ['uuid:1'])
+            factory = clock.tcpClients[-1][2]
+            factory.clientConnectionFailed(
+                None, failure.Failure(ConnectionRefusedError()))
+        self.assertEqual(srv.get_subscribers(), {})
+        self.assertEqual(srv._pending_notifications, {})
+        self.assertEqual(srv.get_subscription_stats()['dropped'], 1)
+        self.assertEqual(event.notification_pool.pending, {})
+
+    def test_changes_gathered(self):
+        """ several changes within one reactor iteration
+            are evented once, with the latest value
+        """
+        clock = task.Clock()
+        self.patch(service, 'reactor', clock)
+        srv = self.service_server
+        self.subscribe('uuid:1', time.time())
+        self.subscribe('uuid:2', time.time())
+        del self.pool.sent[:], self.pool.xml[:]
+        for value in ('1', '0', '1'):
+            srv.set_variable(0, 'Status', value)
+        self.assertEqual(self.pool.sent, [])
+        clock.advance(0)
+        self.assertEqual([sid for sid, d in self.pool.sent],
+                         ['uuid:1', 'uuid:2'])
+        xml = self.pool.xml
+        self.assertEqual(len(xml), 2)
+        self.assertIs(xml[0], xml[1])
+        self.assertIn('<Status>1</Status>', xml[0])
+
+
+
+class Backend(object):
+    """ answers every action of a service """
+
+    def __getattr__(self, name):
+        if name.startswith('upnp_'):
+            return lambda **kwargs: {}
+        raise AttributeError(name)
+
+
+class Moderation(unittest.TestCase):
+
+    def test_check_interval(self):
+        """ the moderated variables are checked as often as
+            the shortest of their intervals asks for
+        """
+        for id, interval in (('AVTransport', 0.2), ('ContentDirectory', 0.5)):
+            srv = ServiceServer4Test(id, version=1, backend=Backend())
+            self.assertEqual(srv.check_moderated_loop.interval, interval)
+            srv.stop_checks()
+        self.assertEqual(service.moderation_check_interval(
+            'urn:schemas-upnp-org:service:SwitchPower:1'),
+            service.MODERATION_CHECK_INTERVAL)
+
+
+class ServiceControl4Test(service.ServiceControl):
+
+    def __init__(self, server):
+        service.ServiceControl.__init__(self)
+        self.service = server
+        self.variables = server.get_variables()
+        self.actions = server.get_actions()
+
+
+class Control_SwitchPower(unittest.TestCase):
+
+    def setUp(self):
+        self.service_server = ServiceServer4Test(
+            'SwitchPower', version=1, backend=None)
+        self.control = ServiceControl4Test(self.service_server)
+
+    def tearDown(self):
+        self.service_server.stop_checks()
+
+    def call(self, name, **kwargs):
+        results = []
+        d = self.control.soap__generic(soap_methodName=name, **kwargs)
+        if isinstance(d, Deferred):
+            d.addBoth(results.append)
+        else:
+            results.append(d)
+        return results[0]
+
+    def test_plan(self):
+        plan = self.service_server.get_action('GetTarget').plan
+        self.assertEqual(plan.in_names, frozenset())
+        self.assertEqual(plan.out_names, ('RetTargetValue',))
+        self.assertEqual(plan.bindings, (('RetTargetValue', 'Target'),))
+        plan = self.service_server.get_action('SetTarget').plan
+        self.assertEqual(plan.in_names, frozenset(['NewTargetValue']))
+        self.assertEqual(plan.check_arguments(
+            {'NewTargetValue': '1', 'X_UPnPClient': 'XBox', 'Foo': '1'}),
+            (['Foo'], frozenset()))
+
+    def test_results_from_variables(self):
+        self.service_server.set_variable(0, 'Target', '1')
+        result = self.call('GetTarget')
+        self.assertEqual(result.items(), [('RetTargetValue', '1')])
+        self.assertEqual(self.call('SetTarget', NewTargetValue='0',
+                                   X_UPnPClient='XBox'), {})
+
+    def test_invalid_arguments(self):
+        for kwargs in ({}, {'NewTargetValue': '1', 'Foo': '1'}):
+            result = self.call('SetTarget', **kwargs)
+            self.assertEqual(result.value.status, 402)
+        self.assertEqual(self.call('Unknown').value.status, 401)
+
+
 # :todo: test get_action(name)
 # :todo: test rm_notification
 # :todo: testsubscribtions
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.description_cache}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.web import error
+
+from coherence.upnp.core import description_cache, utils
+
+URL_1 = 'http://10.0.0.1:4004/RenderingControl.xml'
+URL_2 = 'http://10.0.0.2:4004/RenderingControl.xml'
+MODEL = ('urn:schemas-upnp-org:service:RenderingControl:1',
+         'ACME', 'Renderer', '1.0')
+
+SCPD = ('<?xml version="1.0"?>'
+        '<scpd xmlns="urn:schemas-upnp-org:service-1-0">'
+        '<actionList/><serviceStateTable/></scpd>')
+
+
+class TestDescriptionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.responses = []
+        self.patch(utils, 'getPage', self.getPage)
+
+    def getPage(self, url, headers=None):
+        self.requests.append((url, headers))
+        return self.responses.pop(0)
+
+    def test_fetch(self):
+        cache = description_cache.DescriptionCache()
+        self.responses.append(defer.succeed((SCPD, {'etag': ['"1"']})))
+        results = []
+        cache.fetch(URL_1, MODEL).addCallback(results.append)
+        data, tree = results[0]
+        self.assertEqual(data, SCPD)
+        self.assertEqual(tree.getroot().tag,
+                         '{urn:schemas-upnp-org:service-1-0}scpd')
+        # known by its URL and by its model, no request needed
+        cache.fetch(URL_1).addCallback(results.append)
+        self.responses.append(defer.Deferred())
+        cache.fetch(URL_2, MODEL).addCallback(results.append)
+        self.assertIs(results[1][1], tree)
+        self.assertIs(results[2][1], tree)
+        # just the background revalidation of the new URL
+        self.assertEqual(self.requests, [(URL_1, None), (URL_2, {})])
+
+    def test_check(self):
+        """ a cached description failing the check is fetched again """
+        cache = description_cache.DescriptionCache()
+        cache.store(URL_1, SCPD, {}, MODEL)
+        changed = SCPD.replace('<actionList/>', '<actionList></actionList>')
+        self.responses.append(defer.succeed((changed, {})))
+        results = []
+        cache.fetch(URL_1, check=lambda tree: False).addCallback(results.append)
+        self.assertEqual(self.requests, [(URL_1, None)])
+        self.assertEqual(results[0][0], changed)
+        cache.fetch(URL_1, check=lambda tree: True).addCallback(results.append)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(results[1][0], changed)
+
+    def test_revalidate(self):
+        cache = description_cache.DescriptionCache()
+        cache.store(URL_1, SCPD, {'etag': ['"1"']}, MODEL)
+        self.responses.append(defer.fail(failure.Failure(
+            error.Error('304', 'Not Modified'))))
+        cache.revalidate(URL_1, MODEL)
+        self.assertEqual(self.requests,
+                         [(URL_1, {'If-None-Match': '"1"'})])
+        changed = SCPD.replace('<actionList/>', '<actionList></actionList>')
+        self.responses.append(defer.succeed((changed, {})))
+        cache.revalidate(URL_1, MODEL)
+        self.assertEqual(cache.lookup(URL_2, MODEL)[0], changed)
+
+    def test_invalid(self):
+        cache = description_cache.DescriptionCache()
+        self.assertEqual(cache.store(URL_1, '<scpd', {}, MODEL), ('<scpd', None))
+        self.assertIs(cache.lookup(URL_1, MODEL), None)
+
+    def test_incomplete_model(self):
+        cache = description_cache.DescriptionCache()
+        cache.store(URL_1, SCPD, {}, MODEL[:3] + (None,))
+        self.assertIs(cache.lookup(URL_2, MODEL[:3] + (None,)), None)
+
+    def test_on_disk(self):
+        path = self.mktemp()
+        cache = description_cache.DescriptionCache(path)
+        cache.store(URL_1, SCPD, {'etag': ['"1"']}, MODEL)
+        cache = description_cache.DescriptionCache(path)
+        data, tree = cache.lookup(URL_2, MODEL)
+        self.assertEqual(data, SCPD)
+        self.assertEqual(cache._urls[URL_1]['etag'], '"1"')
@@ -9,11 +9,14 @@
 Test cases for L{upnp.core.DIDLLite}
 """
 
+import time
 from copy import copy
 
 from twisted.trial import unittest
+from twisted.python import log
 
-from coherence.upnp.core import DIDLLite
+from coherence.extern.et import ET
+from coherence.upnp.core import DIDLLite, utils
 
 didl_fragment = """
 <DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/"
@@ -85,3 +88,180 @@ class TestDIDLLite(unittest.TestCase):
             'object.wrongcontainer.wrongalbum.videoAlbum')
         self.assertRaises(AttributeError,
                           DIDLLite.DIDLElement.fromString, wrong_didl_fragment)
+
+    def test_parse_filter(self):
+        self.assertIs(DIDLLite.parse_filter('*'), None)
+        self.assertIs(DIDLLite.parse_filter(None), None)
+        wanted = DIDLLite.parse_filter('dc:creator, res@size')
+        self.assertIn('dc:creator', wanted)
+        self.assertIn('res', wanted)
+        self.assertIn('res@size', wanted)
+        self.assertIn('dc:title', wanted)
+        self.assertNotIn('upnp:artist', wanted)
+
+    def test_DIDLElement_filter(self):
+        """ only the requested properties are serialized
+        """
+        item = DIDLLite.MusicTrack('1', '0', 'Track')
+        item.artist = 'Artist'
+        item.album = 'Album'
+        item.res.append(DIDLLite.Resource('http://host/1', 'http-get:*:audio/mpeg:*'))
+        item.res[0].size = 1234
+        item.res[0].duration = '0:01:00'
+
+        didl = DIDLLite.DIDLElement(filter='upnp:album,res@size')
+        didl.addItem(item)
+        result = didl.toString()
+        self.assertIn('Album', result)
+        self.assertNotIn('Artist', result)
+        self.assertIn('size="1234"', result)
+        self.assertNotIn('duration', result)
+
+        didl = DIDLLite.DIDLElement(filter='dc:title')
+        didl.addItem(item)
+        result = didl.toString()
+        self.assertNotIn('http://host/1', result)
+        self.assertNotIn('Album', result)
+
+        didl = DIDLLite.DIDLElement(filter='*')
+        didl.addItem(item)
+        result = didl.toString()
+        self.assertIn('Artist', result)
+        self.assertIn('duration', result)
+
+    def test_DIDLElement_cached_fragments(self):
+        """ serializing from cached fragments gives the same result
+            as serializing the whole tree
+        """
+        item = DIDLLite.MusicTrack('1', '0', u'Tr\xe4ck <1>')
+        item.artist = 'Artist'
+        item.date = '2001-02-03'
+        item.res.append(DIDLLite.Resource('http://host/1', 'http-get:*:audio/mpeg:*'))
+        container = DIDLLite.Container('2', '0', 'Container')
+        container.date = '2001-02-03'
+        container.childCount = 1
+
+        didl = DIDLLite.DIDLElement()
+        didl.addItem(item)
+        didl.addItem(container)
+        expected = didl.toString()
+
+        didl = DIDLLite.DIDLElement()
+        didl.addItem(item, update_id=1)
+        didl.addItem(container, update_id=1)
+        self.assertEqual(didl.toString(), expected)
+        self.assertEqual(didl.numItems(), 2)
+
+        # unchanged update_id, the cached fragment is used
+        item.artist = 'Someone Else'
+        didl = DIDLLite.DIDLElement()
+        didl.addItem(item, update_id=1)
+        self.assertIn('Artist', didl.toString())
+
+        # a new update_id or childCount invalidates it
+        didl = DIDLLite.DIDLElement()
+        didl.addItem(item, update_id=2)
+        self.assertIn('Someone Else', didl.toString())
+        container.childCount = 2
+        didl = DIDLLite.DIDLElement()
+        didl.addItem(container, update_id=1)
+        self.assertIn('childCount="2"', didl.toString())
+
+        # fragments are cached per client profile
+        didl = DIDLLite.DIDLElement(filter='dc:title')
+        didl.addItem(item, update_id=2)
+        self.assertNotIn('Someone Else', didl.toString())
+
+    def test_DIDLElement_fragments_root(self):
+        """ the attributes of the root are kept, escaped, next to
+            the declarations of the namespaces the fragments use
+        """
+        item = DIDLLite.MusicTrack('1', '0', 'Track')
+        item.artist = 'Artist'
+        didl = DIDLLite.DIDLElement()
+        didl.attrib['{%s}version' % DIDLLite.DLNA_NS] = '1 "a" & <b>'
+        didl.addItem(item, update_id=1)
+        data = didl.toString()
+        self.assertTrue(data.endswith('</item></DIDL-Lite>'))
+        root = utils.parse_xml(data).getroot()
+        self.assertEqual(root.get('{%s}version' % DIDLLite.DLNA_NS),
+                         '1 "a" & <b>')
+        self.assertEqual(root[0].find('{%s}artist' % DIDLLite.UPNP_NS).text,
+                         'Artist')
+
+    def test_objectsFromString(self):
+        """ the objects are the same as the items of fromString
+        """
+        track = DIDLLite.MusicTrack('1', '0', 'Track')
+        track.artist = 'Artist'
+        track.res.append(DIDLLite.Resource('http://host/1', 'http-get:*:audio/mpeg:*'))
+        track.res[0].size = 1234
+        didl = DIDLLite.DIDLElement()
+        didl.addItem(track)
+        didl.addItem(DIDLLite.Container('2', '0', 'Container'))
+        data = didl.toString()
+
+        items = DIDLLite.DIDLElement.fromString(data).getItems()
+        objects = DIDLLite.DIDLElement.objectsFromString(data)
+        self.assertEqual([o.__class__ for o in objects],
+                         [DIDLLite.MusicTrack, DIDLLite.Container])
+        for item, obj in zip(items, objects):
+            for attr in ('id', 'parentID', 'title', 'upnp_class', 'artist'):
+                self.assertEqual(getattr(item, attr), getattr(obj, attr))
+        self.assertEqual(objects[0].artist, 'Artist')
+        self.assertEqual(objects[0].res[0].size, '1234')
+
+    def test_recordsFromString(self):
+        records = DIDLLite.DIDLElement.recordsFromString(didl_fragment)
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual((record.id, record.parentID, record.title),
+                         ('1161', '103', '12'))
+        self.assertEqual(record.upnp_class, 'object.container.album.musicAlbum')
+        self.assertEqual(record.res, [])
+        records = DIDLLite.DIDLElement.recordsFromString(test_didl_fragment)
+        self.assertEqual(records[0].res[0][1], '*:*:audio:*')
+        self.assertRaises(AttributeError, setattr, record, 'artist', 'x')
+
+
+class TestDIDLLiteBenchmark(unittest.TestCase):
+    """ a Browse result of 1000 music tracks """
+
+    def setUp(self):
+        didl = DIDLLite.DIDLElement()
+        for i in range(1000):
+            track = DIDLLite.MusicTrack(str(i), '0', 'Track %d' % i)
+            track.artist = 'Artist'
+            track.album = 'Album'
+            track.res.append(DIDLLite.Resource('http://host/%d' % i,
+                                               'http-get:*:audio/mpeg:*'))
+            didl.addItem(track)
+        self.data = didl.toString()
+
+    def legacy_fromString(self, aString):
+        # the parse, serialize and parse again of each object
+        # DIDLElement.fromString did before
+        instance = DIDLLite.DIDLElement()
+        elt = utils.parse_xml(aString, 'utf-8').getroot()
+        for node in elt.getchildren():
+            upnp_class_name = node.findtext('{%s}class' % DIDLLite.UPNP_NS)
+            upnp_class = instance.get_upnp_class(upnp_class_name.strip())
+            instance.addItem(upnp_class.fromString(ET.tostring(node)))
+        return instance
+
+    def measure(self, parse):
+        start = time.time()
+        result = parse(self.data)
+        return time.time() - start, result
+
+    def test_parse_benchmark(self):
+        legacy, didl = self.measure(self.legacy_fromString)
+        single, elt = self.measure(DIDLLite.DIDLElement.fromString)
+        objects, items = self.measure(DIDLLite.DIDLElement.objectsFromString)
+        records, found = self.measure(DIDLLite.DIDLElement.recordsFromString)
+        log.msg('DIDLElement: 1000 objects, legacy fromString %.3fs, '
+                'fromString %.3fs, objectsFromString %.3fs, '
+                'recordsFromString %.3fs' % (legacy, single, objects, records))
+        self.assertEqual(len(items), 1000)
+        self.assertEqual(len(found), 1000)
+        self.assertEqual(elt.numItems(), didl.numItems())
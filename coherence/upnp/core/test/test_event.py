@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for the GENA notification delivery in L{upnp.core.event}
+"""
+
+from twisted.trial import unittest
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
+from twisted.internet.error import ConnectionRefusedError
+from twisted.python import failure
+
+from coherence.upnp.core import event
+
+OK = 'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+
+
+def subscriber(sid, callback='http://192.168.1.10:4004/events'):
+    return {'sid': sid, 'callback': callback, 'seq': 0,
+            'timeout': 'Second-300', 'created': 0}
+
+
+class TestNotificationPool(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.patch(event, 'reactor', self.reactor)
+        self.pool = event.NotificationPool()
+        self.results = []
+
+    def send(self, s, xml='<e/>'):
+        d = self.pool.send(s, xml)
+        d.addBoth(self.results.append)
+        return d
+
+    def connect(self, index=-1):
+        """ let the pending connection attempt succeed """
+        factory = self.reactor.tcpClients[index][2]
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        return protocol, transport
+
+    def requests(self, transport):
+        return [r for r in transport.value().split('NOTIFY ') if r]
+
+    def test_keep_alive(self):
+        """ notifications for one host share a single connection """
+        s1 = subscriber('uuid:1')
+        s2 = subscriber('uuid:2')
+        self.send(s1)
+        self.send(s2)
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        host, port = self.reactor.tcpClients[0][:2]
+        self.assertEqual((host, port), ('192.168.1.10', 4004))
+        protocol, transport = self.connect()
+        # nothing is pipelined before the host proved to keep connections
+        self.assertEqual(len(self.requests(transport)), 1)
+        protocol.dataReceived(OK)
+        self.assertEqual(self.results, ['200'])
+        self.assertEqual(len(self.requests(transport)), 2)
+        self.send(s1)
+        self.assertEqual(len(self.requests(transport)), 3)
+        protocol.dataReceived(OK + OK)
+        self.assertEqual(self.results, ['200', '200', '200'])
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertFalse(transport.disconnecting)
+        self.assertEqual(self.pool.pending, {})
+
+    def test_seq_order(self):
+        """ SEQ numbers are written in the order they were assigned """
+        s = subscriber('uuid:1')
+        for i in range(4):
+            self.send(s)
+        protocol, transport = self.connect()
+        protocol.dataReceived(OK)
+        seqs = [int(r.split('SEQ:')[1].split('\r\n')[0])
+                for r in self.requests(transport)]
+        self.assertEqual(seqs, [0, 1, 2, 3])
+        self.assertEqual(s['seq'], 4)
+
+    def test_connection_close(self):
+        """ a host closing connections gets one request per connection """
+        s = subscriber('uuid:1')
+        self.send(s)
+        self.send(s)
+        protocol, transport = self.connect()
+        protocol.dataReceived('HTTP/1.1 200 OK\r\nConnection: close\r\n'
+                              'Content-Length: 2\r\n\r\nok')
+        self.assertTrue(transport.disconnecting)
+        protocol.connectionLost(failure.Failure(ConnectionRefusedError()))
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+        protocol, transport = self.connect()
+        self.assertEqual(len(self.requests(transport)), 1)
+        self.assertIn('SEQ:  1', transport.value())
+        protocol.dataReceived(OK)
+        self.assertEqual(self.results, ['200', '200'])
+
+    def test_dead_subscriber(self):
+        """ a subscriber failing repeatedly is dropped """
+        s = subscriber('uuid:1')
+        for i in range(event.MAX_NOTIFICATION_FAILURES + 1):
+            self.send(s)
+        factory = self.reactor.tcpClients[0][2]
+        factory.clientConnectionFailed(None,
+                                       failure.Failure(ConnectionRefusedError()))
+        self.assertEqual(len(self.results), event.MAX_NOTIFICATION_FAILURES + 1)
+        self.assertTrue(self.results[-1].check(event.SubscriberDropped))
+        self.assertEqual(self.pool.pending, {})
+        self.assertEqual(self.pool.channels, {})
+
+    def test_dead_subscriber_one_at_a_time(self):
+        """ a subscriber failing every notification, sent one after
+            the other, is dropped
+        """
+        s = subscriber('uuid:1')
+        for i in range(event.MAX_NOTIFICATION_FAILURES):
+            self.send(s)
+            factory = self.reactor.tcpClients[-1][2]
+            factory.clientConnectionFailed(None,
+                                           failure.Failure(ConnectionRefusedError()))
+        self.assertEqual(len(self.results), event.MAX_NOTIFICATION_FAILURES)
+        for result in self.results[:-1]:
+            self.assertTrue(result.check(ConnectionRefusedError))
+        self.assertTrue(self.results[-1].check(event.SubscriberDropped))
+        self.assertEqual(self.pool.pending, {})
+        self.assertEqual(self.pool.failures, {})
+
+    def test_slow_subscriber(self):
+        """ a subscriber not keeping up with its queue is dropped """
+        s = subscriber('uuid:1')
+        for i in range(event.MAX_QUEUED_NOTIFICATIONS + 1):
+            self.send(s)
+        self.assertEqual(len(self.results), event.MAX_QUEUED_NOTIFICATIONS + 1)
+        for result in self.results:
+            self.assertTrue(result.check(event.SubscriberDropped))
+        # the queued requests are never written
+        protocol, transport = self.connect()
+        self.assertEqual(transport.value(), '')
+
+    def test_forgotten_after_delivery(self):
+        """ nothing is kept about a subscriber without outstanding
+            notifications, after a failure neither
+        """
+        s = subscriber('uuid:1')
+        self.send(s)
+        self.send(s)
+        protocol, transport = self.connect()
+        protocol.dataReceived('HTTP/1.1 500 Internal Server Error\r\n'
+                              'Content-Length: 0\r\n\r\n')
+        self.assertEqual(self.pool.failures, {'uuid:1': 1})
+        protocol.dataReceived(OK)
+        self.assertEqual(self.results[1], '200')
+        self.assertEqual(self.pool.pending, {})
+        self.assertEqual(self.pool.failures, {})
+
+    def test_precondition_failed(self):
+        """ a 412 response ends the subscription """
+        s = subscriber('uuid:1')
+        self.send(s)
+        protocol, transport = self.connect()
+        protocol.dataReceived('HTTP/1.1 412 Precondition Failed\r\n'
+                              'Content-Length: 0\r\n\r\n')
+        self.assertTrue(self.results[0].check(event.SubscriberDropped))
+
+    def test_response_timeout(self):
+        """ an unanswered request closes the connection and is retried once """
+        s = subscriber('uuid:1')
+        self.send(s)
+        protocol, transport = self.connect()
+        self.reactor.advance(event.NOTIFY_TIMEOUT)
+        self.assertTrue(transport.disconnecting)
+        protocol.connectionLost(failure.Failure(ConnectionRefusedError()))
+        protocol, transport = self.connect()
+        self.assertIn('SEQ:  0', transport.value())
+        protocol.connectionLost(failure.Failure(ConnectionRefusedError()))
+        self.assertEqual(len(self.results), 1)
+        self.assertTrue(self.results[0].check(ConnectionRefusedError))
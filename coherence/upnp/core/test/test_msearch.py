@@ -14,6 +14,7 @@ import time
 from twisted.trial import unittest
 from twisted.internet import protocol
 from twisted.test import proto_helpers
+from twisted.python import log
 
 from coherence.upnp.core import msearch, ssdp
 
@@ -79,6 +80,32 @@ class TestMSearch(unittest.TestCase):
         self.assertIs(service1, service2)
         self.assertLess(last_seen1, last_seen2+0.5)
 
+    def test_msearch_response_duplicates(self):
+        data = '\r\n'.join(MSEARCH_RESPONSE_1) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        self.ssdp_server._known[USN_1]['last-seen'] = 0
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        self.assertEqual(self.ssdp_server._known[USN_1]['last-seen'], 0)
+
+    def test_msearch_response_benchmark(self):
+        """ responses of 20 devices with 10 services each
+            to our doubled discovery
+        """
+        datagrams = []
+        for device in range(20):
+            for service in range(10):
+                lines = [l.replace('DDF542FB', 'DDF542FB-%d-%d' % (device, service))
+                         for l in MSEARCH_RESPONSE_1]
+                datagrams.extend(['\r\n'.join(lines) + '\r\n\r\n'] * 2)
+        start = time.time()
+        for i in range(10):
+            for data in datagrams:
+                self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        elapsed = time.time() - start
+        log.msg('MSearch: %d datagrams in %.3fs' %
+                (len(datagrams) * 10, elapsed))
+        self.assertEqual(len(self.ssdp_server._known), 200)
+
     def test_discover(self):
         self.assertEqual(self.tr.written, [])
         self.proto.discover()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.search_criteria}
+"""
+
+from datetime import datetime
+
+from twisted.trial import unittest
+
+from coherence.upnp.core import DIDLLite
+from coherence.upnp.core import search_criteria
+from coherence.upnp.core.search_criteria import (
+    compile_criteria, compile_sort_criteria, SearchCriteriaError, SearchIndex)
+
+
+def _track(id, title, artist=None, genres=None, track_nr=None):
+    item = DIDLLite.MusicTrack(id, 1, title)
+    item.artist = artist
+    item.genres = genres
+    item.originalTrackNumber = track_nr
+    item.date = datetime(2001, 2, 3, 4, 5, 6)
+    item.res.append(DIDLLite.Resource('http://host/%s' % id,
+                                      'http-get:*:audio/mpeg:*'))
+    return item
+
+
+class TestSearchCriteria(unittest.TestCase):
+
+    def setUp(self):
+        self.track = _track('1001', u'Chelsea Hotel', artist=u'Leonard Cohen',
+                            genres=[u'Folk', u'Songwriter'], track_nr=7)
+        self.album = DIDLLite.MusicAlbum('1000', 0, u'Live Songs')
+
+    def matches(self, criteria, obj=None):
+        if obj is None:
+            obj = self.track
+        return compile_criteria(criteria)(obj)
+
+    def test_asterisk_and_empty(self):
+        self.assertTrue(self.matches('*'))
+        self.assertTrue(self.matches(''))
+        self.assertTrue(self.matches(' * ', self.album))
+
+    def test_derivedfrom(self):
+        self.assertTrue(self.matches('upnp:class derivedfrom "object.item.audioItem"'))
+        self.assertTrue(self.matches('upnp:class derivedfrom "object.item"'))
+        self.assertFalse(self.matches('upnp:class derivedfrom "object.item.audio"'))
+        self.assertFalse(self.matches('upnp:class derivedfrom "object.item"', self.album))
+
+    def test_string_operators(self):
+        self.assertTrue(self.matches('dc:title contains "hotel"'))
+        self.assertTrue(self.matches('dc:title doesNotContain "motel"'))
+        self.assertTrue(self.matches('dc:title = "chelsea hotel"'))
+        self.assertTrue(self.matches('dc:title != "Chelsea"'))
+        self.assertTrue(self.matches('upnp:genre = "songwriter"'))
+        self.assertTrue(self.matches('res@protocolInfo contains "audio/mpeg"'))
+
+    def test_relational_operators(self):
+        self.assertTrue(self.matches('upnp:originalTrackNumber > "5"'))
+        self.assertTrue(self.matches('upnp:originalTrackNumber <= "7"'))
+        self.assertFalse(self.matches('upnp:originalTrackNumber < "10" and '
+                                      'upnp:originalTrackNumber >= "8"'))
+        self.assertTrue(self.matches('dc:date >= "2001-01-01"'))
+        self.assertFalse(self.matches('dc:date < "2000"'))
+
+    def test_exists(self):
+        self.assertTrue(self.matches('upnp:artist exists true'))
+        self.assertFalse(self.matches('upnp:artist exists true', self.album))
+        self.assertTrue(self.matches('upnp:album exists false'))
+
+    def test_logical_operators(self):
+        criteria = ('upnp:class derivedfrom "object.item.audioItem" and '
+                    '(dc:title contains "x" or upnp:artist contains "cohen")')
+        self.assertTrue(self.matches(criteria))
+        self.assertFalse(self.matches('dc:title contains "x" or '
+                                      'dc:title contains "y" and dc:title contains "chelsea"'))
+        self.assertTrue(self.matches('dc:title contains "chelsea" or '
+                                     'dc:title contains "y" and dc:title contains "x"'))
+
+    def test_escaped_quotes(self):
+        self.track.title = u'say "hi" \\o/'
+        self.assertTrue(self.matches(r'dc:title = "say \"hi\" \\o/"'))
+
+    def test_compiled_once(self):
+        criteria = 'dc:title contains "hotel"'
+        self.assertIs(compile_criteria(criteria), compile_criteria(criteria))
+        self.assertIn(criteria, search_criteria._compiled)
+
+    def test_invalid(self):
+        for criteria in ('dc:title', 'dc:title contains', 'dc:title contains hotel',
+                         'dc:title like "x"', '(dc:title = "x"',
+                         'dc:title = "x" and', 'dc:title exists maybe',
+                         'dc:title = "x" dc:creator = "y"'):
+            self.assertRaises(SearchCriteriaError, compile_criteria, criteria)
+
+
+class TestSortCriteria(unittest.TestCase):
+
+    def setUp(self):
+        self.tracks = [_track('1', u'b', artist=u'Y', track_nr=10),
+                       _track('2', u'a', artist=u'X', track_nr=9),
+                       _track('3', u'C', artist=u'X', track_nr=2)]
+
+    def test_empty(self):
+        self.assertIs(compile_sort_criteria(''), None)
+        self.assertIs(compile_sort_criteria(' '), None)
+
+    def test_single_key(self):
+        sort = compile_sort_criteria('+dc:title')
+        self.assertEqual([t.title for t in sort.sort(self.tracks)],
+                         [u'a', u'b', u'C'])
+        sort = compile_sort_criteria('-dc:title')
+        self.assertEqual([t.title for t in sort.sort(self.tracks)],
+                         [u'C', u'b', u'a'])
+
+    def test_numeric_key(self):
+        sort = compile_sort_criteria('upnp:originalTrackNumber')
+        self.assertEqual([t.id for t in sort.sort(self.tracks)],
+                         ['3', '2', '1'])
+
+    def test_multiple_keys(self):
+        sort = compile_sort_criteria('+upnp:artist,-dc:title')
+        self.assertEqual(len(sort), 2)
+        self.assertEqual([t.id for t in sort.sort(self.tracks)],
+                         ['3', '2', '1'])
+
+    def test_get_object(self):
+        sort = compile_sort_criteria('dc:title')
+        items = [_Item(t) for t in self.tracks]
+        self.assertEqual([i.item.id for i in sort.sort(items, _Item.get_item)],
+                         ['2', '1', '3'])
+
+    def test_compiled_once(self):
+        self.assertIs(compile_sort_criteria('-dc:date'),
+                      compile_sort_criteria('-dc:date'))
+
+    def test_invalid(self):
+        for criteria in ('+', '-"x"', '+dc:title,(dc:date)'):
+            self.assertRaises(SearchCriteriaError,
+                              compile_sort_criteria, criteria)
+
+
+class _Item(object):
+
+    def __init__(self, item, parent=None):
+        self.item = item
+        self.parent = parent
+
+    def get_item(self):
+        return self.item
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.root = _Item(DIDLLite.Container('0', -1, u'root'))
+        self.album_1 = _Item(DIDLLite.MusicAlbum('1', '0', u'Album 1'), self.root)
+        self.album_2 = _Item(DIDLLite.MusicAlbum('2', '0', u'Album 2'), self.root)
+        self.tracks = []
+        for album in (self.album_1, self.album_2):
+            for n in range(3):
+                id = '%s%d' % (album.item.id, n)
+                self.tracks.append(_Item(_track(id, u'Track %s' % id), album))
+        for i in [self.root, self.album_1, self.album_2] + self.tracks:
+            self.index.add(i.item.id, i)
+
+    def test_search_from_root(self):
+        items, total = self.index.search(
+            'upnp:class derivedfrom "object.item.audioItem"', self.root)
+        self.assertEqual(total, 6)
+        self.assertEqual(items, self.tracks)
+
+    def test_search_container(self):
+        items, total = self.index.search('*', self.album_2)
+        self.assertEqual(total, 3)
+        self.assertEqual(items, self.tracks[3:])
+
+    def test_paging(self):
+        criteria = 'upnp:class derivedfrom "object.item"'
+        items, total = self.index.search(criteria, self.root, 2, 3)
+        self.assertEqual(total, 6)
+        self.assertEqual(items, self.tracks[2:5])
+        items, total = self.index.search(criteria, self.root, 5, 0)
+        self.assertEqual(total, 6)
+        self.assertEqual(items, self.tracks[5:])
+
+    def test_remove(self):
+        self.index.remove('10')
+        self.index.remove('does-not-exist')
+        items, total = self.index.search('dc:title contains "track"', self.album_1)
+        self.assertEqual(total, 2)
+        self.assertNotIn('10', self.index)
+
+    def test_sorted_search(self):
+        sort = compile_sort_criteria('-dc:title')
+        items, total = self.index.search('upnp:class derivedfrom "object.item"',
+                                         self.root, 0, 2, sort=sort)
+        self.assertEqual(total, 6)
+        self.assertEqual(items, [self.tracks[5], self.tracks[4]])
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for the pooled SOAP calls of L{upnp.core.soap_proxy}
+"""
+
+from twisted.trial import unittest
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
+from twisted.internet.error import ConnectionDone, ConnectionRefusedError, \
+     TimeoutError
+from twisted.web.client import ResponseNeverReceived
+from twisted.python import failure
+
+from coherence.upnp.core import soap_proxy
+
+URL = 'http://10.0.0.1:4004/RenderingControl/control'
+NS = 'urn:schemas-upnp-org:service:RenderingControl:1'
+
+ENVELOPE = ('<?xml version="1.0" encoding="utf-8"?>'
+            '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<s:Body>%s</s:Body></s:Envelope>')
+
+FAULT = ('<s:Fault><faultcode>s:Client</faultcode>'
+         '<faultstring>UPnPError</faultstring><detail>'
+         '<UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+         '<errorCode>401</errorCode>'
+         '<errorDescription>Invalid Action</errorDescription>'
+         '</UPnPError></detail></s:Fault>')
+
+
+def response(action, value, status='200 OK'):
+    body = ENVELOPE % ('<u:%sResponse xmlns:u="%s"><Value>%s</Value>'
+                       '</u:%sResponse>' % (action, NS, value, action))
+    return 'HTTP/1.1 %s\r\nContent-Length: %d\r\n\r\n%s' % (
+        status, len(body), body)
+
+
+class Transport(StringTransport):
+
+    def abortConnection(self):
+        self.loseConnection()
+
+
+class TestSOAPProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.patch(soap_proxy, 'reactor', self.reactor)
+        self.patch(soap_proxy, 'pool', soap_proxy.SOAPConnectionPool())
+        self.proxy = soap_proxy.SOAPProxy(URL, namespace=('u', NS))
+        self.results = []
+
+    def call(self, action):
+        d = self.proxy.callRemote(action, {'InstanceID': 0})
+        d.addBoth(self.results.append)
+        return d
+
+    def connect(self, index=-1):
+        """ let the pending connection attempt succeed """
+        factory = self.reactor.tcpClients[index][2]
+        protocol = factory.buildProtocol(None)
+        transport = Transport()
+        protocol.makeConnection(transport)
+        return protocol, transport
+
+    def test_keep_alive(self):
+        """ consecutive calls share one connection """
+        self.call('GetVolume')
+        protocol, transport = self.connect()
+        self.assertIn('Soapaction: "%s#GetVolume"' % NS, transport.value())
+        protocol.dataReceived(response('GetVolume', 42))
+        self.assertEqual(self.results, [{'Value': '42'}])
+        transport.clear()
+        self.call('GetVolume')
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertIn('POST /RenderingControl/control', transport.value())
+        protocol.dataReceived(response('GetVolume', 43))
+        self.assertEqual(self.results[1], {'Value': '43'})
+        self.assertFalse(transport.disconnecting)
+
+    def test_concurrent_actions(self):
+        """ each call reads the response of its own action """
+        self.call('GetVolume')
+        self.call('GetMute')
+        protocol_volume, _ = self.connect(0)
+        protocol_mute, _ = self.connect(1)
+        protocol_mute.dataReceived(response('GetMute', 1))
+        protocol_volume.dataReceived(response('GetVolume', 42))
+        self.assertEqual(self.results, [{'Value': '1'}, {'Value': '42'}])
+
+    def test_in_flight_limit(self):
+        """ calls beyond the limit wait for a pending one """
+        for i in range(soap_proxy.MAX_IN_FLIGHT + 1):
+            self.call('GetVolume')
+        self.assertEqual(len(self.reactor.tcpClients),
+                         soap_proxy.MAX_IN_FLIGHT)
+        protocol, transport = self.connect(0)
+        protocol.dataReceived(response('GetVolume', 42))
+        # the waiting call reuses the connection
+        self.assertEqual(len(self.reactor.tcpClients),
+                         soap_proxy.MAX_IN_FLIGHT)
+        self.assertEqual(transport.value().count('POST '), 2)
+
+    def test_timeout(self):
+        """ an unanswered call fails after the timeout """
+        self.call('GetVolume')
+        protocol, transport = self.connect()
+        self.reactor.advance(soap_proxy.SOAP_TIMEOUT)
+        self.assertTrue(transport.disconnecting)
+        protocol.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertTrue(self.results[0].check(TimeoutError))
+
+    def test_retry(self):
+        """ a call lost with an idle connection the host
+            closed is sent again
+        """
+        self.call('GetVolume')
+        protocol, transport = self.connect()
+        protocol.dataReceived(response('GetVolume', 41))
+        self.call('GetVolume')
+        protocol.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+        protocol, transport = self.connect()
+        protocol.dataReceived(response('GetVolume', 42))
+        self.assertEqual(self.results, [{'Value': '41'}, {'Value': '42'}])
+
+    def test_no_retry_on_new_connection(self):
+        """ a call lost on a new connection may have run already,
+            so it isn't sent again
+        """
+        self.call('Seek')
+        protocol, transport = self.connect()
+        protocol.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertTrue(self.results[0].check(ResponseNeverReceived))
+
+    def test_retry_connect_error(self):
+        """ a call that never reached the host is sent again """
+        self.call('Seek')
+        factory = self.reactor.tcpClients[0][2]
+        factory.clientConnectionFailed(
+            None, failure.Failure(ConnectionRefusedError()))
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+        protocol, transport = self.connect()
+        protocol.dataReceived(response('Seek', 1))
+        self.assertEqual(self.results, [{'Value': '1'}])
+
+    def test_fault(self):
+        """ a SOAP fault fails with its UPnP error """
+        self.call('GetVolume')
+        protocol, transport = self.connect()
+        body = ENVELOPE % FAULT
+        protocol.dataReceived('HTTP/1.1 500 Internal Server Error\r\n'
+                              'Content-Length: %d\r\n\r\n%s' %
+                              (len(body), body))
+        self.assertEqual(self.results[0].getErrorMessage(),
+                         '401 - Invalid Action')
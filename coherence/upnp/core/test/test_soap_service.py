@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for L{upnp.core.soap_service} and the
+request and response envelopes of L{upnp.core.soap_lite}
+"""
+
+import time
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.util import OrderedDict
+from twisted.web.test.requesthelper import DummyRequest
+
+from coherence.upnp.core import soap_lite, soap_service
+import coherence.extern.louie as louie
+from coherence.upnp.core.utils import parse_xml
+
+NS = 'urn:schemas-upnp-org:service:ContentDirectory:1'
+SOAP_BODY = '{http://schemas.xmlsoap.org/soap/envelope/}Body'
+
+BROWSE = ('<?xml version="1.0" encoding="utf-8"?>'
+          '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"'
+          ' s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+          '<s:Body><u:Browse xmlns:u="%s">'
+          '<ObjectID>0</ObjectID>'
+          '<BrowseFlag>BrowseDirectChildren</BrowseFlag>'
+          '<Filter>*</Filter><StartingIndex>0</StartingIndex>'
+          '<RequestedCount>%%d</RequestedCount><SortCriteria></SortCriteria>'
+          '</u:Browse></s:Body></s:Envelope>' % NS)
+
+AVT_NS = 'urn:schemas-upnp-org:service:AVTransport:1'
+GET_POSITION_INFO = ('<?xml version="1.0" encoding="utf-8"?>'
+                     '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"'
+                     ' s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+                     '<s:Body><u:GetPositionInfo xmlns:u="%s">'
+                     '<InstanceID>0</InstanceID>'
+                     '</u:GetPositionInfo></s:Body></s:Envelope>' % AVT_NS)
+
+DIDL = ('<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/"'
+        ' xmlns:dc="http://purl.org/dc/elements/1.1/">%s</DIDL-Lite>')
+ITEM = ('<item id="%d" parentID="0" restricted="1"><dc:title>Tr\xc3\xa4ck &amp; %d'
+        '</dc:title></item>')
+
+
+def parse_response(data):
+    body = parse_xml(data).find(SOAP_BODY)
+    response = body[0]
+    return response.tag, [(e.tag, e.text) for e in response]
+
+
+class ContentDirectory(soap_service.UPnPPublisher):
+
+    def soap_Browse(self, *args, **kwargs):
+        count = int(kwargs['RequestedCount'])
+        result = OrderedDict()
+        result['Result'] = DIDL % ''.join(ITEM % (i, i) for i in range(count))
+        result['NumberReturned'] = count
+        result['TotalMatches'] = count
+        result['UpdateID'] = 1
+        return result
+
+
+class AVTransport(soap_service.UPnPPublisher):
+
+    def soap_GetPositionInfo(self, *args, **kwargs):
+        result = OrderedDict()
+        result['Track'] = 1
+        result['TrackDuration'] = '00:03:00'
+        result['TrackMetaData'] = ''
+        result['TrackURI'] = 'http://10.0.0.1:30020/1'
+        result['RelTime'] = '00:00:10'
+        result['AbsTime'] = '00:00:10'
+        result['RelCount'] = 2147483647
+        result['AbsCount'] = 2147483647
+        return result
+
+
+def post(publisher, envelope, content_type='text/xml; charset="utf-8"'):
+    request = DummyRequest([''])
+    request.method = 'POST'
+    request.content = StringIO(envelope)
+    request.headers['content-type'] = content_type
+    publisher.render(request)
+    return request
+
+
+class TestDecodeCall(unittest.TestCase):
+
+    def test_browse(self):
+        ns, method, arguments = soap_lite.decode_call([BROWSE % 10])
+        self.assertEqual((ns, method), (NS, 'Browse'))
+        self.assertEqual(arguments,
+                         [('ObjectID', '0'),
+                          ('BrowseFlag', 'BrowseDirectChildren'),
+                          ('Filter', '*'), ('StartingIndex', '0'),
+                          ('RequestedCount', '10'), ('SortCriteria', '')])
+
+    def test_same_as_tree(self):
+        """ the arguments are decoded as decode_result does it """
+        envelope = ('<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"'
+                    ' xmlns:xsi="http://www.w3.org/1999/XMLSchema-instance">'
+                    '<s:Body><u:Seek xmlns:u="%s">'
+                    '<InstanceID xsi:type="xsd:int">3</InstanceID>'
+                    '<Speed xsi:type="float">1.5</Speed>'
+                    '<Muted xsi:type="boolean">true</Muted>'
+                    '<Volume xsi:type="int">0</Volume>'
+                    '<Title>caf\xc3\xa9 &amp; &lt;bar&gt;</Title>'
+                    '<Target/></u:Seek></s:Body></s:Envelope>' % AVT_NS)
+        ns, method, arguments = soap_lite.decode_call([envelope])
+        method = parse_xml(envelope).find(SOAP_BODY)[0]
+        self.assertEqual(arguments,
+                         [(e.tag, soap_lite.decode_result(e)) for e in method])
+        self.assertEqual(type(arguments[-1][1]), str)
+
+    def test_pieces(self):
+        """ the envelope may arrive in pieces of any size, the rest
+            after the action isn't looked at
+        """
+        data = GET_POSITION_INFO.replace('</s:Body></s:Envelope>',
+                                         '<broken')
+        chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+        ns, method, arguments = soap_lite.decode_call(chunks)
+        self.assertEqual((ns, method, arguments),
+                         (AVT_NS, 'GetPositionInfo', [('InstanceID', '0')]))
+
+    def test_header(self):
+        """ elements of the Header aren't taken for the action """
+        data = GET_POSITION_INFO.replace(
+            '<s:Body>', '<s:Header><u:Auth xmlns:u="urn:x"><Token>1</Token>'
+            '</u:Auth></s:Header><s:Body>')
+        ns, method, arguments = soap_lite.decode_call([data])
+        self.assertEqual((method, arguments),
+                         ('GetPositionInfo', [('InstanceID', '0')]))
+
+    def test_no_action(self):
+        self.assertRaises(ValueError, soap_lite.decode_call,
+                          [GET_POSITION_INFO.replace('<s:Body>', '<s:Header>')
+                           .replace('</s:Body>', '</s:Header>')])
+
+
+class TestSOAPResponse(unittest.TestCase):
+
+    def test_same_as_build_soap_call(self):
+        arguments = OrderedDict()
+        arguments['Result'] = DIDL % '<item id="1"><dc:title>&amp;</dc:title></item>'
+        arguments['NumberReturned'] = 1
+        arguments['Flag'] = True
+        response = soap_lite.SOAPResponse(NS, 'Browse', arguments)
+        data = str(response)
+        self.assertEqual(len(data), response.length)
+        old = soap_lite.build_soap_call('{%s}Browse' % NS, arguments,
+                                        is_response=True, encoding=None)
+        self.assertEqual(parse_response(data), parse_response(old))
+
+    def test_unicode(self):
+        arguments = OrderedDict()
+        arguments['Title'] = u'<caf\xe9>'
+        arguments['Result'] = DIDL % (ITEM % (1, 1))
+        response = soap_lite.SOAPResponse(NS, 'Browse', arguments)
+        data = str(response)
+        self.assertEqual(len(data), response.length)
+        self.assertEqual(parse_response(data)[1],
+                         [('Title', u'<caf\xe9>'),
+                          ('Result', arguments['Result'].decode('utf-8'))])
+
+    def test_chunks(self):
+        arguments = OrderedDict()
+        arguments['Result'] = '<&>' * soap_lite.CHUNK_SIZE
+        response = soap_lite.SOAPResponse(NS, 'Browse', arguments)
+        chunks = list(response.chunks())
+        self.assertTrue(len(chunks) > 3)
+        data = ''.join(chunks)
+        self.assertEqual(len(data), response.length)
+        self.assertEqual(parse_response(data)[1][0][1], arguments['Result'])
+
+
+class TestUPnPPublisher(unittest.TestCase):
+
+    def browse(self, count):
+        request = post(ContentDirectory(), BROWSE % count)
+        self.assertEqual(request.finished, 1)
+        data = ''.join(request.written)
+        self.assertEqual(str(len(data)),
+                         request.outgoingHeaders['content-length'])
+        return request, parse_response(data)
+
+    def test_small_response(self):
+        request, (tag, arguments) = self.browse(2)
+        self.assertEqual(len(request.written), 1)
+        self.assertEqual(tag, '{%s}BrowseResponse' % NS)
+        self.assertEqual(arguments[1:], [('NumberReturned', '2'),
+                                         ('TotalMatches', '2'),
+                                         ('UpdateID', '1')])
+        self.assertEqual(arguments[0][1],
+                         (DIDL % ''.join(ITEM % (i, i) for i in range(2))).decode('utf-8'))
+
+    def test_streamed_response(self):
+        request, (tag, arguments) = self.browse(5000)
+        self.assertTrue(len(request.written) > 1)
+        self.assertEqual(arguments[1], ('NumberReturned', '5000'))
+        self.assertEqual(len(parse_xml(arguments[0][1]).getroot()), 5000)
+
+    def test_invalid_envelope(self):
+        request = post(ContentDirectory(), '<s:Envelope')
+        self.assertEqual(request.responseCode, 500)
+        self.assertIn('<errorCode>401</errorCode>', ''.join(request.written))
+
+    def test_content_type(self):
+        request = post(ContentDirectory(), BROWSE % 1, 'text/plain')
+        self.assertEqual(request.responseCode, 500)
+        self.assertIn('<errorCode>415</errorCode>', ''.join(request.written))
+
+    def test_command_received(self):
+        """ the test hook gets the request when connected to """
+        received = defer.Deferred()
+
+        def command_received(headers, data):
+            louie.disconnect(command_received, soap_service.COMMAND_RECEIVED)
+            received.callback((headers['content-type'], data))
+
+        louie.connect(command_received, soap_service.COMMAND_RECEIVED)
+        request = post(AVTransport(), GET_POSITION_INFO)
+        self.assertEqual(request.responseCode, 200)
+        received.addCallback(self.assertEqual,
+                             ('text/xml; charset="utf-8"', GET_POSITION_INFO))
+        return received
+
+
+class TestUPnPPublisherBenchmark(unittest.TestCase):
+    """ requests per second through UPnPPublisher.render """
+
+    def measure(self, publisher, envelope, count=2000):
+        start = time.time()
+        for i in xrange(count):
+            request = post(publisher, envelope)
+        self.assertEqual(request.responseCode, 200)
+        return count / (time.time() - start)
+
+    def test_render_benchmark(self):
+        position_info = self.measure(AVTransport(), GET_POSITION_INFO)
+        browse = self.measure(ContentDirectory(), BROWSE % 10)
+        log.msg('UPnPPublisher: GetPositionInfo %d requests/s, '
+                'Browse of 10 items %d requests/s' % (position_info, browse))
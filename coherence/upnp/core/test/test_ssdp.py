@@ -12,10 +12,12 @@ Test cases for L{upnp.core.sspd}
 import time
 
 from twisted.trial import unittest
-from twisted.internet import protocol
+from twisted.internet import protocol, task
 from twisted.test import proto_helpers
+from twisted.python import log
 
 from coherence.upnp.core import ssdp
+import coherence.extern.louie as louie
 
 SSDP_PORT = 1900
 SSDP_ADDR = '239.255.255.250'
@@ -124,3 +126,201 @@ class TestSSDP(unittest.TestCase):
         self.assertEqual((host, port), (SSDP_ADDR, SSDP_PORT))
         recieved = data.splitlines(True)
         self.assertEqual(sorted(recieved), sorted(expected))
+
+
+    def test_parse_datagram(self):
+        data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+        cmd, headers = ssdp.parse_datagram(data)
+        self.assertEqual(cmd, ['NOTIFY', '*'])
+        self.assertEqual(headers, {
+            'nt': 'upnp:rootdevice',
+            'nts': 'ssdp:alive',
+            'location': 'http://10.10.222.94:2869/upnp?content=uuid:e711a4bf',
+            'usn': USN_1,
+            'cache-control': 'max-age=1842',
+            'server': 'Microsoft-Windows-NT/5.1 UPnP/1.0 UPnP-Device-Host/1.0',
+            })
+        self.assertEqual(ssdp.parse_datagram(''), ([], {}))
+
+    def test_ssdp_notify_duplicates(self):
+        alive = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+        byebye = alive.replace('ssdp:alive', 'ssdp:byebye')
+        self.proto.datagramReceived(alive, ('10.20.30.40', 1234))
+        self.proto._known[USN_1]['last-seen'] = 0
+        self.proto.datagramReceived(alive, ('10.20.30.40', 1234))
+        self.assertEqual(self.proto._known[USN_1]['last-seen'], 0)
+        # a device going away and coming back within the window
+        self.proto.datagramReceived(byebye, ('10.20.30.40', 1234))
+        self.assertFalse(self.proto.isKnown(USN_1))
+        self.proto.datagramReceived(alive, ('10.20.30.40', 1234))
+        self.assertTrue(self.proto.isKnown(USN_1))
+
+    def test_datagram_signal(self):
+        """ the raw datagram is only sent out when someone listens """
+        sent = []
+        self.patch(louie, 'send', lambda signal, *args, **kw: sent.append(signal))
+
+        def datagram_received(data, host, port):
+            pass
+        data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        self.assertNotIn('UPnP.SSDP.datagram_received', sent)
+        louie.connect(datagram_received, 'UPnP.SSDP.datagram_received')
+        try:
+            self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        finally:
+            louie.disconnect(datagram_received, 'UPnP.SSDP.datagram_received')
+        self.assertIn('UPnP.SSDP.datagram_received', sent)
+
+
+class TestSSDPBenchmark(unittest.TestCase):
+    """ 20 devices announcing 10 services each, every datagram
+        repeated three times, as on a busy network
+    """
+
+    def setUp(self):
+        self.proto = ssdp.SSDPServer(test=True)
+        self.proto.makeConnection(proto_helpers.FakeDatagramTransport())
+
+    def test_notify_benchmark(self):
+        datagrams = []
+        for device in range(20):
+            for service in range(10):
+                lines = [l.replace('e711a4bf', 'e711a4bf-%d' % device)
+                         for l in SSDP_NOTIFY_1]
+                lines[2] = 'NT:urn:schemas-upnp-org:service:S%d:1' % service
+                lines[5] += '-%d' % service
+                datagrams.extend(['\r\n'.join(lines) + '\r\n\r\n'] * 3)
+        start = time.time()
+        for i in range(10):
+            for data in datagrams:
+                self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        elapsed = time.time() - start
+        log.msg('SSDPServer: %d datagrams in %.3fs' %
+                (len(datagrams) * 10, elapsed))
+        self.assertEqual(len(self.proto._known), 200)
+
+
+SSDP_MSEARCH_1 = (
+    'M-SEARCH * HTTP/1.1',
+    'HOST: 239.255.255.250:1900',
+    'MAN: "ssdp:discover"',
+    'MX: 2',
+    'ST: upnp:rootdevice',
+    )
+
+
+class TestSSDPDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.proto = ssdp.SSDPServer(test=True)
+        self.tr = proto_helpers.FakeDatagramTransport()
+        self.proto.makeConnection(self.tr)
+        for usn, st in (('uuid:1::upnp:rootdevice', 'upnp:rootdevice'),
+                        ('uuid:1', 'uuid:1'),
+                        ('uuid:2::upnp:rootdevice', 'upnp:rootdevice')):
+            self.proto.register('local', usn, st, 'http://10.0.0.1:30020/')
+        data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+        self.proto.datagramReceived(data, ('10.20.30.40', 1234))
+        del self.tr.written[:]
+
+    def search(self, st='upnp:rootdevice', host='10.20.30.50'):
+        data = '\r\n'.join(SSDP_MSEARCH_1).replace('upnp:rootdevice', st)
+        self.proto.datagramReceived(data + '\r\n\r\n', (host, 1900))
+
+    def test_discovery_response(self):
+        self.search()
+        self.assertEqual(self.tr.written, [])
+        self.clock.advance(2)
+        self.assertEqual([(host, port) for data, (host, port) in self.tr.written],
+                         [('10.20.30.50', 1900)] * 2)
+        data = self.tr.written[0][0]
+        self.assertTrue(data.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(data.endswith(' GMT\r\n\r\n'))
+        self.assertIn('\r\nUSN: uuid:1::upnp:rootdevice\r\n', data)
+        self.assertIn('\r\nST: upnp:rootdevice\r\n', data)
+        self.assertIn('\r\nDATE: ', data)
+        # remote entries are never announced
+        self.assertNotIn(USN_1, ''.join(d for d, a in self.tr.written))
+
+    def test_discovery_all(self):
+        self.search('ssdp:all')
+        self.clock.advance(2)
+        self.assertEqual(len(self.tr.written), 3)
+
+    def test_discovery_repeated(self):
+        self.search()
+        self.search()
+        self.search(host='10.20.30.51')
+        self.clock.advance(2)
+        self.assertEqual(len(self.tr.written), 4)
+        self.search()
+        self.clock.advance(2)
+        self.assertEqual(len(self.tr.written), 6)
+
+    def test_discovery_unregistered(self):
+        self.search()
+        self.proto.unRegister('uuid:2::upnp:rootdevice')
+        self.clock.advance(2)
+        self.assertEqual(len(self.tr.written), 1)
+        self.search('uuid:2')
+        self.clock.advance(2)
+        self.assertEqual(len(self.tr.written), 1)
+
+
+class FakeTime(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class TestSSDPExpiry(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ssdp, 'reactor', self.clock)
+        self.time = FakeTime(1000.0)
+        self.patch(ssdp, 'time', self.time)
+        self.proto = ssdp.SSDPServer(test=True)
+        # schedule the expiry on our clock
+        self.proto._SSDPServer__test = False
+        self.proto.makeConnection(proto_helpers.FakeDatagramTransport())
+        self.data = '\r\n'.join(SSDP_NOTIFY_1) + '\r\n\r\n'
+
+    def advance(self, seconds):
+        self.time.now += seconds
+        self.clock.advance(seconds)
+
+    def test_parse_max_age(self):
+        self.assertEqual(ssdp.parse_max_age('max-age=1842'), 1842)
+        self.assertEqual(ssdp.parse_max_age('no-cache="Ext", MAX-AGE = 60'), 60)
+        self.assertEqual(ssdp.parse_max_age('no-cache'), 1800)
+        self.assertEqual(ssdp.parse_max_age(None), 1800)
+
+    def test_expiry(self):
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.proto.register('local', 'uuid:1::upnp:rootdevice',
+                            'upnp:rootdevice', 'http://10.0.0.1:30020/',
+                            cache_control='max-age=10')
+        self.assertEqual(self.proto._max_age, {USN_1: 1842})
+        self.advance(1842 + ssdp.EXPIRY_GRACE - 1)
+        self.assertTrue(self.proto.isKnown(USN_1))
+        self.advance(2)
+        self.assertFalse(self.proto.isKnown(USN_1))
+        self.assertTrue(self.proto.isKnown('uuid:1::upnp:rootdevice'))
+        self.assertEqual(self.proto._max_age, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_expiry_refreshed(self):
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.advance(1000)
+        self.proto.datagramReceived(self.data, ('10.20.30.40', 1234))
+        self.advance(1000)
+        self.assertTrue(self.proto.isKnown(USN_1))
+        self.advance(1000)
+        self.assertFalse(self.proto.isKnown(USN_1))
@@ -10,10 +10,12 @@ Test cases for L{upnp.core.utils}
 """
 
 import os
+import time
 from twisted.trial import unittest
 from twisted.python.filepath import FilePath
-from twisted.internet import reactor
-from twisted.web import static, server
+from twisted.internet import reactor, task
+from twisted.web import static, server, error, client
+from twisted.web.http_headers import Headers
 from twisted.protocols import policies
 
 from coherence.upnp.core import utils
@@ -204,5 +206,249 @@ class TestClient(unittest.TestCase):
         return d
 
 
+class TestSendfile(unittest.TestCase):
+    """ files served by StaticFile and BufferFile, straight
+        through the socket
+    """
+
+    def setUp(self):
+        name = self.mktemp()
+        os.mkdir(name)
+        self.content = (''.join(map(chr, range(251))) * 12600)[:3 * 1024 * 1024 + 7]
+        FilePath(name).child("file").setContent(self.content)
+        root = utils.StaticFile(name)
+        self.buffered = utils.BufferFile(os.path.join(name, 'file'))
+        root.putChild('buffered', self.buffered)
+        self.port = reactor.listenTCP(0, server.Site(root, timeout=None),
+                                      interface="127.0.0.1")
+        self.portno = self.port.getHost().port
+        self.sent = []
+        self.real_sendfile = utils.sendfile
+        if utils.sendfile is not None:
+            self.patch(utils, 'sendfile', self.sendfile)
+
+    def tearDown(self):
+        utils.file_growth.release_idle()
+        return self.port.stopListening()
+
+    def sendfile(self, out_fd, in_fd, offset, count):
+        sent = self.real_sendfile(out_fd, in_fd, offset, count)
+        self.sent.append(sent)
+        return sent
+
+    def getURL(self, path):
+        return "http://127.0.0.1:%d/%s" % (self.portno, path)
+
+    def getRange(self, path, range):
+        """ getPage fails with the partial content """
+        def partial(failure):
+            failure.trap(error.Error)
+            self.assertEqual(failure.value.status, '206')
+            return failure.value.response, {}
+        d = utils.getPage(self.getURL(path), headers={'range': range})
+        d.addCallbacks(self.fail, partial)
+        return d
+
+    def check(self, result, expected):
+        data, headers = result
+        self.assertEqual(len(data), len(expected))
+        self.assertEqual(data, expected)
+        if utils.sendfile is not None:
+            self.assertEqual(sum(self.sent), len(expected))
+
+    def test_whole_file(self):
+        d = utils.getPage(self.getURL("file"))
+        d.addCallback(self.check, self.content)
+        return d
+
+    def test_range(self):
+        d = self.getRange("file", 'bytes=1000-1999999')
+        d.addCallback(self.check, self.content[1000:2000000])
+        return d
+
+    def test_buffer_file(self):
+        d = self.getRange("buffered", 'bytes=5-')
+        d.addCallback(self.check, self.content[5:])
+        return d
+
+    def request(self, path, headers):
+        """ fires with the code, headers and body of the response """
+        agent = client.Agent(reactor)
+        d = agent.request('GET', self.getURL(path), Headers(
+            dict((k, [v]) for k, v in headers.items())))
+
+        def got_response(response):
+            d = client.readBody(response)
+            d.addCallback(lambda body: (response.code, response.headers, body))
+            return d
+        d.addCallback(got_response)
+        return d
+
+    def test_multiple_ranges(self):
+        def check((code, headers, body)):
+            self.assertEqual(code, 206)
+            self.assertIn('multipart/byteranges',
+                          headers.getRawHeaders('content-type')[0])
+            self.assertIn('\r\n\r\n' + self.content[10:20] + '\r\n', body)
+            self.assertIn('\r\n\r\n' + self.content[-5:] + '\r\n', body)
+            self.assertTrue(body.endswith('--\r\n'))
+        d = self.request("buffered", {'range': 'bytes=10-19,-5'})
+        return d.addCallback(check)
+
+    def test_not_satisfiable(self):
+        def check((code, headers, body)):
+            self.assertEqual(code, 416)
+            self.assertEqual(headers.getRawHeaders('content-range'),
+                             ['bytes */%d' % len(self.content)])
+            self.assertEqual(body, '')
+        d = self.request("buffered", {'range': 'bytes=%d-' % len(self.content)})
+        return d.addCallback(check)
+
+    def test_malformed_range(self):
+        """ a range that isn't understood is ignored """
+        def check((code, headers, body)):
+            self.assertEqual(code, 200)
+            self.assertEqual(body, self.content)
+        d = self.request("buffered", {'range': 'lines=1-2'})
+        return d.addCallback(check)
+
+    def test_time_seek(self):
+        self.buffered.set_time_index([(0, 0), (10, 1000), (20, 5000)], 30)
+
+        def check((code, headers, body)):
+            self.assertEqual(code, 206)
+            self.assertEqual(body, self.content[1000:5000])
+            self.assertEqual(headers.getRawHeaders('timeseekrange.dlna.org'),
+                             ['npt=12.000-20.000/30.000 bytes=1000-4999/%d' %
+                              len(self.content)])
+        d = self.request("buffered",
+                         {'TimeSeekRange.dlna.org': 'npt=0:00:12-20'})
+        return d.addCallback(check)
+
+    def test_time_seek_open_end(self):
+        """ an open-ended seek gives the end time actually served """
+        size = len(self.content)
+        self.buffered.set_time_index([(0, 0), (10, 1000)], 120)
+
+        def indexed((code, headers, body)):
+            self.assertEqual(code, 206)
+            self.assertEqual(headers.getRawHeaders('timeseekrange.dlna.org'),
+                             ['npt=10.000-120.000/120.000 bytes=1000-%d/%d' %
+                              (size - 1, size)])
+            self.buffered.set_time_index([], 120)
+            return self.request("buffered",
+                                {'TimeSeekRange.dlna.org': 'npt=30-60'})
+
+        def constant((code, headers, body)):
+            self.assertEqual(code, 206)
+            first, last = size / 4, size / 2 - 1
+            self.assertEqual(body, self.content[first:last + 1])
+            self.assertEqual(headers.getRawHeaders('timeseekrange.dlna.org'),
+                             ['npt=30.000-%.3f/120.000 bytes=%d-%d/%d' %
+                              (120.0 * (last + 1) / size, first, last, size)])
+        d = self.request("buffered", {'TimeSeekRange.dlna.org': 'npt=10-'})
+        d.addCallback(indexed)
+        return d.addCallback(constant)
+
+    def test_file_growth_watch(self):
+        """ the watch of a file is kept between wake-ups and
+            dropped once nobody comes back for it
+        """
+        if utils.inotify is None:
+            raise unittest.SkipTest("no inotify")
+        clock = task.Clock()
+        self.patch(utils, 'reactor', clock)
+        notifier = utils.FileGrowthNotifier()
+        path = self.buffered.path
+        woken = []
+        notifier.wait(path, lambda: woken.append(1))
+        inotify = notifier._inotify
+        notifier._notify(FilePath(path))
+        self.assertEqual(woken, [1])
+        notifier.wait(path, lambda: woken.append(2))
+        self.assertIs(notifier._inotify, inotify)
+        notifier._notify(FilePath(path))
+        self.assertEqual(woken, [1, 2])
+        self.assertIs(notifier._inotify, inotify)
+        clock.advance(utils.GROWING_FILE_RETRY)
+        self.assertIs(notifier._inotify, None)
+        self.assertEqual(notifier._waiting, {})
+
+    def test_time_seek_invalid(self):
+        def check((code, headers, body)):
+            self.assertEqual(code, 400)
+        self.buffered.set_time_index([], 120)
+        d = self.request("buffered", {'TimeSeekRange.dlna.org': 'npt=nan-'})
+        return d.addCallback(check)
+
+    def test_time_seek_unsupported(self):
+        def check((code, headers, body)):
+            self.assertEqual(code, 406)
+        d = self.request("buffered", {'TimeSeekRange.dlna.org': 'npt=10-'})
+        return d.addCallback(check)
+
+    def test_growing_file(self):
+        """ a range beyond the end of a growing file is sent once
+            the file holds it
+        """
+        self.buffered.target_size = len(self.content) + 100
+        start = time.time()
+
+        def grow():
+            with open(self.buffered.path, 'ab') as f:
+                f.write('x' * 100)
+
+        def check((code, headers, body)):
+            self.assertEqual(code, 206)
+            self.assertEqual(body, 'x' * 50)
+            if utils.inotify is not None:
+                self.assertTrue(time.time() - start < utils.GROWING_FILE_BACKSTOP)
+        reactor.callLater(0.2, grow)
+        d = self.request("buffered", {'range': 'bytes=%d-%d' % (
+            len(self.content) + 10, len(self.content) + 59)})
+        return d.addCallback(check)
+
+    def test_parse_time_seek_range(self):
+        self.assertEqual(utils.parse_time_seek_range('npt=1:02:03.5-'),
+                         (3723.5, None))
+        self.assertEqual(utils.parse_time_seek_range('npt=10-20.25'),
+                         (10.0, 20.25))
+        for value in ('npt=20-10', 'bytes=1-2', 'npt=10', 'npt=1:2-',
+                      'npt=nan-', 'npt=inf-', 'npt=0:00:nan-', 'npt=-1-',
+                      'npt=1e3-'):
+            self.assertRaises(ValueError, utils.parse_time_seek_range, value)
+
+    def test_shorter_file(self):
+        """ a file that isn't growing but ends before its
+            announced size aborts the response
+        """
+        size = len(self.content) + 100
+        self.patch(utils.StaticFile, 'getFileSize', lambda f: size)
+        agent = client.Agent(reactor)
+        d = agent.request('GET', self.getURL("file"))
+        d.addCallback(client.readBody)
+        return self.assertFailure(d, client.PartialDownloadError,
+                                  client.ResponseFailed)
+
+    def test_stock_producers(self):
+        """ with an unknown transport layout StaticFile falls
+            back to the producers of static.File
+        """
+        self.patch(utils, 'sendfile_transports', False)
+
+        def check((data, headers)):
+            self.assertEqual(data, self.content[1000:2000])
+            self.assertEqual(self.sent, [])
+        d = self.getRange("file", 'bytes=1000-1999')
+        return d.addCallback(check)
+
+    def test_fallback(self):
+        """ without sendfile the file is read and written """
+        self.patch(utils, 'sendfile', None)
+        d = self.getRange("file", 'bytes=-100')
+        d.addCallback(self.check, self.content[-100:])
+        return d
+
+
 
 # $Id:$
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for the ContainerUpdateIDs of L{upnp.core.variable.StateVariable}
+"""
+
+import time
+
+from twisted.trial import unittest
+
+from coherence.upnp.core import event
+from coherence.upnp.core.test.test_ServiceServer import \
+     ServiceServer4Test, FakeNotificationPool, Backend
+
+
+class TestContainerUpdateIDs(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakeNotificationPool()
+        self.patch(event, 'notification_pool', self.pool)
+        self.service_server = ServiceServer4Test(
+            'ContentDirectory', version=1, backend=Backend())
+        self.variable = self.service_server.get_variable('ContainerUpdateIDs')
+
+    def tearDown(self):
+        self.service_server.stop_checks()
+
+    def test_gathered(self):
+        """ a container changing again moves to the end
+            with its latest update id
+        """
+        for value in ((1, 1), (2, 1), (1, 2), ('3,1,2,2')):
+            self.variable.update(value)
+        self.assertEqual(self.variable.value, '1,2,3,1,2,2')
+        self.assertTrue(self.variable.updated)
+
+    def test_evented(self):
+        """ once evented, the gathering starts over """
+        self.variable.update((1, 1))
+        self.variable.update((2, 1))
+        self.variable.updated = False
+        self.variable.update((2, 1))
+        self.assertEqual(self.variable.value, '2,1')
+        self.assertEqual(self.variable.old_value, '1,1,2,1')
+        self.variable.updated = False
+        self.variable.update((2, 1))
+        self.assertFalse(self.variable.updated)
+
+    def test_set_as_a_whole(self):
+        self.variable.update((1, 1))
+        self.variable.value = '4,1,5,1'
+        self.variable.update((4, 2))
+        self.assertEqual(self.variable.value, '5,1,4,2')
+
+    def test_moderated(self):
+        """ the changes are sent with the next moderated event """
+        srv = self.service_server
+        srv.new_subscriber({'sid': 'uuid:1', 'seq': 0,
+                            'callback': 'http://127.0.0.1:4004/events',
+                            'timeout': 'Second-300', 'created': time.time()})
+        del self.pool.xml[:]
+        for i in range(3):
+            srv.set_variable(0, 'ContainerUpdateIDs', (i, 1))
+        srv.set_variable(0, 'ContainerUpdateIDs', (0, 2))
+        srv.check_moderated_variables()
+        self.assertEqual(len(self.pool.xml), 1)
+        self.assertIn('<ContainerUpdateIDs>1,1,2,1,0,2</ContainerUpdateIDs>',
+                      self.pool.xml[0])
+        self.assertFalse(self.variable.updated)
+
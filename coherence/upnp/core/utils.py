@@ -4,6 +4,11 @@
 # Copyright (C) 2006 Fluendo, S.A. (www.fluendo.com).
 # Copyright 2006, Frank Scholz <coherence@beebits.net>
 
+import os
+import re
+import sys
+import errno
+import bisect
 from os.path import abspath
 import urlparse
 from urlparse import urlsplit
@@ -12,11 +17,13 @@ from coherence.extern.et import parse_xml as et_parse_xml
 
 from coherence import SERVER_ID
 
+import twisted
 from twisted.web import server, http, static
 from twisted.web import client, error
 from twisted.web import proxy, resource, server
 from twisted.internet import reactor, protocol, defer, abstract
 from twisted.python import failure
+from twisted.python.filepath import FilePath
 
 from twisted.python.util import InsensitiveDict
 
@@ -33,6 +40,58 @@ except ImportError:
     have_netifaces = False
 
 
+def _libc_sendfile():
+    """ sendfile(2) of the Linux libc, with the signature of os.sendfile """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendfile = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    _sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    _sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = _sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # pysendfile
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = _libc_sendfile()
+
+# bytes handed to sendfile at once, before others get their turn
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+# SendfileProducer looks into the write buffer of the transport, laid
+# out as in these versions of Twisted, with any other one StaticFile
+# sends through the producers of static.File
+SENDFILE_TWISTED_VERSIONS = ((13, 1), (16, 0))
+sendfile_transports = SENDFILE_TWISTED_VERSIONS[0] <= \
+    (twisted.version.major, twisted.version.minor) < SENDFILE_TWISTED_VERSIONS[1]
+# seconds between looks at a growing file without inotify, and
+# with inotify in case an event went missing
+GROWING_FILE_RETRY = 1.0
+GROWING_FILE_BACKSTOP = 10.0
+
+
 def means_true(value):
     if isinstance(value, basestring):
         value = value.lower()
@@ -467,178 +526,451 @@ def downloadPage(url, file, contextFactory=None, *args, **kwargs):
                         *args, **kwargs)
 
 
-# StaticFile used to be a patched version of static.File. The later
-# was fixed in TwistedWeb 8.2.0 and 9.0.0, while the patched variant
-# contained deprecated and removed code.
-StaticFile = static.File
-
+class FileGrowthNotifier(object):
+    """ calls back who waits for a file to grow, when inotify
+        reports the file being written to
 
-class BufferFile(static.File):
-    """ taken from twisted.web.static and modified
-        accordingly to the patch by John-Mark Gurney
-        http://resnet.uoregon.edu/~gurney_j/jmpc/dist/twisted.web.static.patch
+        The inotify descriptor and the watch of a file are kept while
+        someone waits for it, and for GROWING_FILE_RETRY seconds after
+        the last one was called back, for a reader following the file
+        to come back. Without inotify the waiting ones are called back
+        after GROWING_FILE_RETRY seconds.
     """
 
-    def __init__(self, path, target_size=0, *args):
-        static.File.__init__(self, path, *args)
-        self.target_size = target_size
-        self.upnp_retry = None
+    def __init__(self):
+        self._inotify = None
+        self._waiting = {}   # FilePath -> list of (callback, delayed call)
+        self._idle = {}      # FilePath -> delayed call dropping the watch
+
+    def _notifier(self):
+        if self._inotify is None and inotify is not None:
+            try:
+                self._inotify = inotify.INotify()
+                self._inotify.startReading()
+            except Exception:
+                self._inotify = None
+        return self._inotify
+
+    def wait(self, path, callback):
+        """ call callback once the file at path was written to,
+            returns a function cancelling the wait
+        """
+        notifier = None
+        if path is not None:
+            notifier = self._notifier()
+        if notifier is None:
+            call = reactor.callLater(GROWING_FILE_RETRY, callback)
+            return lambda: call.active() and call.cancel()
+        path = FilePath(path)
+        waiting = self._waiting.get(path)
+        if waiting is None:
+            try:
+                notifier.watch(path, inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE,
+                               callbacks=[self._changed])
+            except Exception:
+                if not self._waiting:
+                    self._release()
+                call = reactor.callLater(GROWING_FILE_RETRY, callback)
+                return lambda: call.active() and call.cancel()
+            waiting = self._waiting[path] = []
+        idle = self._idle.pop(path, None)
+        if idle is not None:
+            idle.cancel()
+        entry = (callback, reactor.callLater(GROWING_FILE_BACKSTOP,
+                                             self._notify, path))
+        waiting.append(entry)
+        return lambda: self._cancel(path, entry)
+
+    def _changed(self, ignored, path, mask):
+        self._notify(path)
+
+    def _notify(self, path):
+        waiting = self._waiting.get(path)
+        if not waiting:
+            return
+        self._waiting[path] = []
+        for callback, call in waiting:
+            if call.active():
+                call.cancel()
+            callback()
+        if not self._waiting.get(path):
+            self._linger(path)
+
+    def _cancel(self, path, entry):
+        waiting = self._waiting.get(path, [])
+        if entry in waiting:
+            waiting.remove(entry)
+            if entry[1].active():
+                entry[1].cancel()
+            if not waiting:
+                self._linger(path)
+
+    def _linger(self, path):
+        """ drop the watch of path unless someone waits for it
+            again within GROWING_FILE_RETRY seconds
+        """
+        if path in self._waiting and path not in self._idle:
+            self._idle[path] = reactor.callLater(GROWING_FILE_RETRY,
+                                                 self._ignore, path)
+
+    def release_idle(self):
+        """ drop the watches nobody waits for right now """
+        for path, call in self._idle.items():
+            call.cancel()
+            self._ignore(path)
+
+    def _ignore(self, path):
+        self._idle.pop(path, None)
+        del self._waiting[path]
+        if self._inotify is not None:
+            try:
+                self._inotify.ignore(path)
+            except KeyError:
+                pass
+        if not self._waiting:
+            self._release()
+
+    def _release(self):
+        if self._inotify is not None:
+            self._inotify.connectionLost(None)
+            self._inotify = None
+
+
+file_growth = FileGrowthNotifier()
+
+
+class SendfileProducer(static.StaticProducer):
+    """ writes size bytes from offset of a file to the request
+
+        As a pull producer it is only asked for more data once the
+        socket took everything before. The data is copied by sendfile()
+        straight from the file to the socket, when the request is served
+        through a plain TCP connection, otherwise it is read and written
+        in chunks. A growing file that doesn't have the data yet is
+        waited for with the file_growth notifier, any other file ending
+        early aborts the response.
+    """
 
-    def render(self, request):
-        #print ""
-        #print "BufferFile", request
+    # written before the data
+    separator = ''
 
-        # FIXME detect when request is REALLY finished
-        if request is None or request.finished:
-            print "No request to render!"
-            return ''
+    def __init__(self, request, fileObject, offset, size, growing=False):
+        static.StaticProducer.__init__(self, request, fileObject)
+        self.offset = offset
+        self.size = size
+        self.growing = growing
+        self.bytesWritten = 0
+        self.transport = None
+        self._waiting = None
+
+    def start(self):
+        self.fileObject.seek(self.offset)
+        # out with the headers, through the transport's buffer
+        self.request.write(self.separator)
+        transport = self.request.transport
+        if (sendfile is not None and sendfile_transports and
+            not getattr(self.request, 'chunked', False) and
+            isinstance(transport, abstract.FileDescriptor) and
+            hasattr(transport, 'socket') and hasattr(self.fileObject, 'fileno') and
+            hasattr(transport, 'dataBuffer') and hasattr(transport, '_tempDataLen')):
+            self.transport = transport
+        self.request.registerProducer(self, False)
+
+    def _buffered(self):
+        transport = self.transport
+        return (len(transport.dataBuffer) > transport.offset or
+                transport._tempDataLen > 0)
+
+    def _sendfile(self, count):
+        if self._buffered():
+            # called again once the transport sent its data
+            return 0
+        try:
+            sent = sendfile(self.transport.fileno(), self.fileObject.fileno(),
+                            self.offset + self.bytesWritten, count)
+        except (OSError, IOError), e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                sent = 0
+            elif e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                # no sendfile for this file or socket
+                self.transport = None
+                self.fileObject.seek(self.offset + self.bytesWritten)
+                return self._write(count)
+            else:
+                self.transport.abortConnection()
+                return 0
+        else:
+            if sent == 0:
+                return None
+            self.bytesWritten += sent
+            self.request.sentLength += sent
+        # to be called once the socket takes more
+        self.transport.startWriting()
+        return sent
+
+    def _write(self, count):
+        data = self.fileObject.read(min(count, self.bufferSize))
+        if not data:
+            return None
+        self.bytesWritten += len(data)
+        # this .write will spin the reactor, calling .doWrite and then
+        # .resumeProducing again, so be prepared for a re-entrant call
+        self.request.write(data)
+        return len(data)
 
-        """You know what you doing."""
-        self.restat()
+    def resumeProducing(self):
+        self._waiting = None
+        if not self.request:
+            return
+        count = min(SENDFILE_CHUNK_SIZE, self.size - self.bytesWritten)
+        if count > 0:
+            if self.transport is not None:
+                sent = self._sendfile(count)
+            else:
+                sent = self._write(count)
+            if sent is None:
+                # the end of a growing file
+                self._waiting = self._wait()
+                return
+        if self.request and self.bytesWritten >= self.size:
+            self._done()
+
+    def _wait(self):
+        """ wait for the file to grow, returns a function
+            cancelling the wait
+        """
+        if not self.growing:
+            self._abort()
+            return None
+        return file_growth.wait(getattr(self.fileObject, 'name', None),
+                                self.resumeProducing)
 
-        if self.type is None:
-            self.type, self.encoding = static.getTypeAndEncoding(self.basename(),
-                                                          self.contentTypes,
-                                                          self.contentEncodings,
-                                                          self.defaultType)
+    def _done(self):
+        self.request.unregisterProducer()
+        self.request.finish()
+        self.stopProducing()
 
-        if not self.exists():
-            return self.childNotFound.render(request)
+    def _abort(self):
+        """ drop the connection of a response that can't be
+            completed, the client must not take it as complete
+        """
+        self.request.unregisterProducer()
+        self.request.transport.abortConnection()
+        self.stopProducing()
 
-        if self.isdir():
-            return self.redirect(request)
+    def stopProducing(self):
+        if self._waiting is not None:
+            self._waiting()
+        self._waiting = None
+        self.transport = None
+        static.StaticProducer.stopProducing(self)
 
-        #for content-length
-        if (self.target_size > 0):
-            fsize = size = int(self.target_size)
-        else:
-            fsize = size = int(self.getFileSize())
 
-        #print fsize
+class MultipartSendfileProducer(SendfileProducer):
+    """ writes the parts of a multipart/byteranges response, rangeInfo
+        is a list of (separator, offset, size) as returned by
+        static.File._doMultipleRangeRequest
+    """
 
-        if size == int(self.getFileSize()):
-            request.setHeader('accept-ranges', 'bytes')
+    def __init__(self, request, fileObject, rangeInfo, growing=False):
+        self.rangeInfo = list(rangeInfo)
+        self.separator, offset, size = self.rangeInfo.pop(0)
+        SendfileProducer.__init__(self, request, fileObject, offset, size,
+                                  growing)
+
+    def _done(self):
+        separator, offset, size = self.rangeInfo.pop(0)
+        self.request.write(separator)
+        if not self.rangeInfo:
+            # that was the final boundary
+            SendfileProducer._done(self)
+            return
+        self.offset = offset
+        self.size = size
+        self.bytesWritten = 0
+        self.fileObject.seek(offset)
 
-        if self.type:
-            request.setHeader('content-type', self.type)
-        if self.encoding:
-            request.setHeader('content-encoding', self.encoding)
 
-        try:
-            f = self.openForReading()
-        except IOError, e:
-            import errno
-            if e[0] == errno.EACCES:
-                return error.ForbiddenResource().render(request)
-            else:
-                raise
-        if request.setLastModified(self.getmtime()) is http.CACHED:
-            return ''
-        trans = True
-
-        range = request.getHeader('range')
-        #print "StaticFile", range
-
-        tsize = size
-        if range is not None:
-            # This is a request for partial data...
-            bytesrange = range.split('=')
-            assert bytesrange[0] == 'bytes', \
-                   "Syntactically invalid http range header!"
-            start, end = bytesrange[1].split('-', 1)
-            if start:
-                start = int(start)
-                # Are we requesting something beyond the current size of the file?
-                if (start >= self.getFileSize()):
-                    # Retry later!
-                    print bytesrange
-                    print "Requesting data beyond current scope -> postpone rendering!"
-                    self.upnp_retry = reactor.callLater(1.0, self.render, request)
-                    return server.NOT_DONE_YET
-
-                f.seek(start)
-                if end:
-                    #print ":%s" % end
-                    end = int(end)
-                else:
-                    end = size - 1
-            else:
-                lastbytes = int(end)
-                if size < lastbytes:
-                    lastbytes = size
-                start = size - lastbytes
-                f.seek(start)
-                fsize = lastbytes
-                end = size - 1
-            size = end + 1
-            fsize = end - int(start) + 1
-            # start is the byte offset to begin, and end is the byte offset
-            # to end..  fsize is size to send, tsize is the real size of
-            # the file, and size is the byte position to stop sending.
-            if fsize <= 0:
-                request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                fsize = tsize
-                trans = False
-            else:
-                request.setResponseCode(http.PARTIAL_CONTENT)
-                request.setHeader('content-range', "bytes %s-%s/%s " % (
-                    str(start), str(end), str(tsize)))
-                #print "StaticFile", start, end, tsize
+class StaticFile(static.File):
+    """ a static.File sending its content through a SendfileProducer
+    """
 
-        request.setHeader('content-length', str(fsize))
+    # whether the file may still be growing
+    growing = False
+
+    def makeProducer(self, request, fileForReading):
+        producer = static.File.makeProducer(self, request, fileForReading)
+        if request.code == http.REQUESTED_RANGE_NOT_SATISFIABLE:
+            request.setHeader('content-length', '0')
+            return SendfileProducer(request, fileForReading, 0, 0)
+        if not sendfile_transports and not self.growing:
+            return producer
+        if isinstance(producer, static.NoRangeStaticProducer):
+            return SendfileProducer(request, fileForReading,
+                                    0, self.getFileSize(), self.growing)
+        if isinstance(producer, static.SingleRangeStaticProducer):
+            return SendfileProducer(request, fileForReading,
+                                    producer.offset, producer.size,
+                                    self.growing)
+        return MultipartSendfileProducer(request, fileForReading,
+                                         producer.rangeInfo, self.growing)
+
+
+# a part of an NPT time, float() would take nan, inf or signs too
+NPT_TIME_PART = re.compile(r'\d+(\.\d*)?$')
+
+
+def parse_npt_time(value):
+    """ seconds of an NPT time, either seconds or h:mm:ss, with
+        optional fractions, raises ValueError for anything else
+    """
+    parts = value.strip().split(':')
+    if len(parts) not in (1, 3):
+        raise ValueError("invalid npt time %r" % value)
+    seconds = 0.0
+    for part in parts:
+        if NPT_TIME_PART.match(part) is None:
+            raise ValueError("invalid npt time %r" % value)
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_time_seek_range(value):
+    """ the (start, end) seconds of a TimeSeekRange.dlna.org header,
+        end being None when open, raises ValueError for anything else
+    """
+    kind, _, times = value.strip().partition('=')
+    if kind.strip() != 'npt':
+        raise ValueError("unsupported time seek range %r" % value)
+    start, sep, end = times.partition('-')
+    if not sep:
+        raise ValueError("invalid time seek range %r" % value)
+    start = parse_npt_time(start)
+    end = end.split('/')[0].strip()
+    if end:
+        end = parse_npt_time(end)
+        if end < start:
+            raise ValueError("invalid time seek range %r" % value)
+    else:
+        end = None
+    return start, end
 
-        if request.method == 'HEAD' or trans == False:
-            # pretend we're a HEAD request, so content-length
-            # won't be overwritten.
-            request.method = 'HEAD'
-            return ''
-        #print "StaticFile out", request.responseHeaders, request.code
 
-        # return data
-        # size is the byte position to stop sending, not how many bytes to send
+class BufferFile(StaticFile):
+    """ a file that may still be growing to target_size, e.g. a
+        recording in progress, with byte ranges beyond its current
+        end being sent as soon as the file holds them
 
-        BufferFileTransfer(f, size - f.tell(), request)
-        # and make sure the connection doesn't get closed
-        return server.NOT_DONE_YET
+        When a time_index of (seconds, byte offset) pairs, ordered
+        by time, or a duration in seconds is set, DLNA time seek
+        requests are answered, by the byte offsets of the index or
+        else by assuming a constant bitrate.
+    """
 
+    growing = True
 
-class BufferFileTransfer(object):
-    """
-    A class to represent the transfer of a file over the network.
-    """
-    request = None
+    def __init__(self, path, target_size=0, *args):
+        StaticFile.__init__(self, path, *args)
+        self.target_size = target_size
+        self.time_index = None
+        self.duration = None
+
+    def getFileSize(self):
+        if self.target_size > 0:
+            return int(self.target_size)
+        return StaticFile.getFileSize(self)
+
+    def set_time_index(self, time_index, duration=None):
+        self.time_index = sorted(time_index)
+        self.duration = duration
+
+    def time_to_offset(self, seconds, end=False):
+        """ the byte offset of the position at seconds, for an end
+            the offset of the first indexed position after it,
+            None when it is beyond the end
+        """
+        size = self.getFileSize()
+        if self.time_index:
+            times = [t for t, offset in self.time_index]
+            if end:
+                i = bisect.bisect_left(times, seconds)
+                if i == len(times):
+                    return None
+            else:
+                i = bisect.bisect_right(times, seconds) - 1
+                if i < 0:
+                    return 0
+            return self.time_index[i][1]
+        if self.duration:
+            if seconds >= self.duration:
+                return None
+            return int(size * seconds / self.duration)
+        return None
+
+    def offset_to_time(self, offset):
+        """ the time of the position at byte offset, for an offset
+            between indexed positions the time of the next one,
+            None when it isn't known
+        """
+        if self.time_index:
+            for seconds, position in self.time_index:
+                if position >= offset:
+                    return seconds
+            return self.duration
+        if self.duration:
+            return self.duration * offset / float(self.getFileSize())
+        return None
+
+    def time_seek(self, request, header):
+        """ turn a TimeSeekRange.dlna.org request into a byte range
+            one, returns False when it can't be satisfied
+        """
+        try:
+            start, end = parse_time_seek_range(header)
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST)
+            return False
+        if not self.time_index and not self.duration:
+            request.setResponseCode(http.NOT_ACCEPTABLE)
+            return False
+        size = self.getFileSize()
+        first = self.time_to_offset(start)
+        if first is None or first >= size:
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            return False
+        last = size - 1
+        if end is not None:
+            offset = self.time_to_offset(end, end=True)
+            if offset is not None and offset > first:
+                last = offset - 1
+        # the time the served range ends at, not the one asked for
+        served = self.offset_to_time(last + 1)
+        if served is None:
+            served = end
+        if self.duration:
+            duration = '%.3f' % self.duration
+        else:
+            duration = '*'
+        request.requestHeaders.setRawHeaders('range',
+                                             ['bytes=%d-%d' % (first, last)])
+        request.setHeader('TimeSeekRange.dlna.org',
+                          'npt=%.3f-%s/%s bytes=%d-%d/%d' % (
+                              start, served is None and '' or '%.3f' % served,
+                              duration, first, last, size))
+        return True
 
-    def __init__(self, file, size, request):
-        self.file = file
-        self.size = size
-        self.request = request
-        self.written = self.file.tell()
-        request.registerProducer(self, 0)
+    def render(self, request):
+        # FIXME detect when request is REALLY finished
+        if request is None or request.finished:
+            return ''
 
-    def resumeProducing(self):
-        #print "resumeProducing", self.request,self.size,self.written
-        if not self.request:
-            return
-        data = self.file.read(min(abstract.FileDescriptor.bufferSize, self.size - self.written))
-        if data:
-            self.written += len(data)
-            # this .write will spin the reactor, calling .doWrite and then
-            # .resumeProducing again, so be prepared for a re-entrant call
-            self.request.write(data)
-        if self.request and self.file.tell() == self.size:
-            self.request.unregisterProducer()
-            self.request.finish()
-            self.request = None
-
-    def pauseProducing(self):
-        pass
+        header = request.getHeader('timeseekrange.dlna.org')
+        if header is not None and request.getHeader('range') is None:
+            if not self.time_seek(request, header):
+                request.setHeader('content-length', '0')
+                return ''
+        return StaticFile.render(self, request)
 
-    def stopProducing(self):
-        #print "stopProducing",self.request
-        self.request.unregisterProducer()
-        self.file.close()
-        self.request.finish()
-        self.request = None
 
 from datetime import datetime, tzinfo, timedelta
 import random
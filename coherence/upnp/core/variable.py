@@ -6,6 +6,8 @@
 
 import time
 from sets import Set
+# not the one of twisted, which removes keys in linear time
+from collections import OrderedDict
 
 from coherence.upnp.core import utils
 try:
@@ -85,35 +87,69 @@ class StateVariable(log.Loggable):
     def set_never_evented(self, value):
         self.never_evented = utils.means_true(value)
 
+    def _get_value(self):
+        if self._update_ids_changed:
+            self._value = ','.join(['%s,%s' % item for item
+                                    in self._update_ids.iteritems()])
+            self._update_ids_changed = False
+        return self._value
+
+    def _set_value(self, value):
+        self._value = value
+        self._update_ids = None
+        self._update_ids_changed = False
+
+    # the ContainerUpdateIDs of a server are kept as
+    # container -> update id until the value is asked for
+    value = property(_get_value, _set_value)
+
+    def _update_container_ids(self, value):
+        """ gather the (container, update id) pairs of ContainerUpdateIDs
+            until they are evented, a container changing again keeps
+            its latest update id only and moves to the end
+        """
+        if isinstance(value, tuple):
+            pairs = [(str(value[0]), str(value[1]))]
+        else:
+            ids = str(value).split(',')
+            pairs = zip(ids[0::2], ids[1::2])
+        update_ids = self._update_ids
+        fresh = self.updated != True or update_ids is None
+        if fresh:
+            update_ids = OrderedDict()
+            if self.updated == True:
+                # not evented yet, set as a whole before
+                ids = self.value.split(',')
+                update_ids.update(zip(ids[0::2], ids[1::2]))
+        changed = False
+        for container, update_id in pairs:
+            if update_ids.get(container) != update_id:
+                update_ids.pop(container, None)
+                update_ids[container] = update_id
+                changed = True
+        if fresh:
+            new_value = ','.join(['%s,%s' % item for item in update_ids.iteritems()])
+            changed = new_value != self.value
+        if not changed:
+            self.info("variable NOT updated, no value change %s %s", self.name, value)
+            return
+        if fresh:
+            self.old_value = self.value
+            self._value = new_value
+        self._update_ids = update_ids
+        self._update_ids_changed = not fresh
+        self.last_time_touched = time.time()
+        self.notify()
+        self.updated = True
+        if self.service.last_change != None:
+            self.service.last_change.updated = True
+
     def update(self, value):
         self.info("variable check for update %s %s %s", self.name, value, self.service)
         if not isinstance(self.service, service.Service):
             if self.name == 'ContainerUpdateIDs':
-                old_value = self.value
-                if self.updated == True:
-                    if isinstance(value, tuple):
-                        v = old_value.split(',')
-                        i = 0
-                        while i < len(v):
-                            if v[i] == str(value[0]):
-                                del v[i:i + 2]
-                                old_value = ','.join(v)
-                                break
-                            i += 2
-                        if len(old_value):
-                            new_value = old_value + ',' + str(value[0]) + ',' + str(value[1])
-                        else:
-                            new_value = str(value[0]) + ',' + str(value[1])
-                    else:
-                        if len(old_value):
-                            new_value = str(old_value) + ',' + str(value)
-                        else:
-                            new_value = str(value)
-                else:
-                    if isinstance(value, tuple):
-                        new_value = str(value[0]) + ',' + str(value[1])
-                    else:
-                        new_value = value
+                self._update_container_ids(value)
+                return
             else:
                 if self.data_type == 'string':
                     if isinstance(value, basestring):
@@ -201,7 +237,11 @@ class StateVariable(log.Loggable):
     def notify(self):
         if self.name.startswith('A_ARG_TYPE_'):
             return
-        self.info("Variable %s sends notify about new value >%r<", self.name, self.value)
+        if self._update_ids_changed:
+            # not rendered for the log
+            self.info("Variable %s sends notify about new container update ids", self.name)
+        else:
+            self.info("Variable %s sends notify about new value >%r<", self.name, self.value)
         #if self.old_value == '':
         #    return
         louie.send(signal='Coherence.UPnP.StateVariable.%s.changed' % self.name, sender=self.service, variable=self)
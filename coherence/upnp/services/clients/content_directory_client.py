@@ -8,7 +8,7 @@ import sys
 import threading
 
 from twisted.internet import reactor, defer
-from twisted.python import log
+from twisted.python import log, failure
 
 from coherence.upnp.core import DIDLLite
 from coherence.upnp.core import utils
@@ -17,6 +17,119 @@ global work, pending
 work = []
 pending = {}
 
+# the number of objects a paged browse or search asks for at first
+PAGE_SIZE = 100
+MIN_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 1000
+# seconds a page should take to arrive, the page size is doubled
+# while pages come in faster and halved when they come in slower
+PAGE_TIME = 1.0
+
+
+class PagedResult(object):
+    """ pages through the result of a Browse or Search action
+
+        The next page is requested as soon as one arrives, while
+        callback handles the DIDL objects of the one before.
+        callback may return a Deferred, no further page is
+        requested until it fired, so at most two pages are
+        held in memory.
+
+        start() returns a Deferred firing with the number of objects
+        handed to callback, cancelling it stops the paging.
+    """
+
+    def __init__(self, action, arguments, callback, page_size=PAGE_SIZE):
+        self.action = action
+        self.arguments = arguments
+        self.callback = callback
+        self.page_size = page_size
+        self.starting_index = 0
+        self.count = 0
+        self.total_matches = None
+        self.update_id = None
+        self.deferred = defer.Deferred(self._cancel)
+        self._call = None
+        self._page = None
+        self._delivering = None
+
+    def start(self):
+        self._request()
+        return self.deferred
+
+    def _request(self):
+        requested = self.page_size
+        d = self.action.call(StartingIndex=str(self.starting_index),
+                             RequestedCount=str(requested),
+                             **self.arguments)
+        if d is None:
+            self._failed(failure.Failure(ValueError(
+                "invalid arguments for %s" % self.action.name)))
+            return
+        self._call = d
+        d.addCallbacks(self._got_page, self._failed,
+                       callbackArgs=(reactor.seconds(), requested))
+
+    def _got_page(self, result, requested_at, requested):
+        self._call = None
+        if self.deferred.called:
+            return
+        self._adapt(int(result['NumberReturned']), requested,
+                    reactor.seconds() - requested_at)
+        self._page = (result, requested)
+        if self._delivering is None:
+            self._next_page()
+
+    def _adapt(self, returned, requested, elapsed):
+        if elapsed > PAGE_TIME:
+            self.page_size = max(self.page_size / 2, MIN_PAGE_SIZE)
+        elif elapsed < PAGE_TIME / 2 and returned == requested:
+            self.page_size = min(self.page_size * 2, MAX_PAGE_SIZE)
+
+    def _next_page(self):
+        result, requested = self._page
+        self._page = None
+        returned = int(result['NumberReturned'])
+        self.total_matches = int(result['TotalMatches'])
+        self.update_id = result.get('UpdateID')
+        self.starting_index += returned
+        # TotalMatches is 0 when the server doesn't know it
+        if self.total_matches:
+            done = returned == 0 or self.starting_index >= self.total_matches
+        else:
+            done = returned < requested
+        items = DIDLLite.DIDLElement.objectsFromString(result['Result'])
+        self.count += len(items)
+        # hold back pages arriving while this one is handled
+        self._delivering = True
+        if not done:
+            self._request()
+        d = self._delivering = defer.maybeDeferred(self.callback, items)
+        d.addCallbacks(self._delivered, self._failed, callbackArgs=(done,))
+
+    def _delivered(self, _, done):
+        self._delivering = None
+        if self.deferred.called:
+            return
+        if done:
+            self.deferred.callback(self.count)
+        elif self._page is not None:
+            self._next_page()
+
+    def _failed(self, error):
+        if not self.deferred.called:
+            self._stop()
+            self.deferred.errback(error)
+
+    def _cancel(self, _):
+        self._stop()
+
+    def _stop(self):
+        self._page = None
+        if self._call is not None:
+            call, self._call = self._call, None
+            call.cancel()
+
 
 class ContentDirectoryClient:
 
@@ -67,8 +180,7 @@ class ContentDirectoryClient:
         def got_result(results):
             items = []
             if results is not None:
-                elt = DIDLLite.DIDLElement.fromString(results['Result'])
-                items = elt.getItems()
+                items = DIDLLite.DIDLElement.objectsFromString(results['Result'])
             return items
 
         def got_process_result(result):
@@ -78,8 +190,7 @@ class ContentDirectoryClient:
             r['total_matches'] = result['TotalMatches']
             r['update_id'] = result['UpdateID']
             r['items'] = {}
-            elt = DIDLLite.DIDLElement.fromString(result['Result'])
-            for item in elt.getItems():
+            for item in DIDLLite.DIDLElement.objectsFromString(result['Result']):
                 #print "process_result", item
                 i = {}
                 i['upnp_class'] = item.upnp_class
@@ -138,13 +249,40 @@ class ContentDirectoryClient:
         def gotResults(results):
             items = []
             if results is not None:
-                elt = DIDLLite.DIDLElement.fromString(results['Result'])
-                items = elt.getItems()
+                items = DIDLLite.DIDLElement.objectsFromString(results['Result'])
             return items
 
         d.addCallback(gotResults)
         return d
 
+    def browse_pages(self, callback, object_id=0, filter='*',
+                     sort_criteria='', page_size=PAGE_SIZE):
+        """ hands the children of object_id to callback page by page,
+            see PagedResult
+        """
+        action = self.service.get_action('Browse')
+        paged = PagedResult(action, {'ObjectID': object_id,
+                                     'BrowseFlag': 'BrowseDirectChildren',
+                                     'Filter': filter,
+                                     'SortCriteria': sort_criteria},
+                            callback, page_size)
+        return paged.start()
+
+    def search_pages(self, callback, container_id, criteria, filter='*',
+                     sort_criteria='', page_size=PAGE_SIZE):
+        """ hands the objects below container_id matching criteria
+            to callback page by page, see PagedResult
+        """
+        action = self.service.get_action('Search')
+        if action == None:
+            return None
+        paged = PagedResult(action, {'ContainerID': container_id,
+                                     'SearchCriteria': criteria,
+                                     'Filter': filter,
+                                     'SortCriteria': sort_criteria},
+                            callback, page_size)
+        return paged.start()
+
     def dict2item(self, elements):
         upnp_class = DIDLLite.upnp_classes.get(elements.get('upnp_class', None), None)
         if upnp_class is None:
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the MIT license
+# http://opensource.org/licenses/mit-license.php
+
+"""
+Test cases for the paged browsing of
+L{upnp.services.clients.content_directory_client}
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from coherence.upnp.core import DIDLLite
+from coherence.upnp.services.clients import content_directory_client
+
+
+def page(start, count, total):
+    didl = DIDLLite.DIDLElement()
+    for i in range(start, start + count):
+        didl.addItem(DIDLLite.MusicTrack(str(i), '0', 'track %d' % i))
+    return {'Result': didl.toString(), 'NumberReturned': str(count),
+            'TotalMatches': str(total), 'UpdateID': '7'}
+
+
+class FakeAction(object):
+    """ answers Browse requests for total objects, with the
+        Deferreds of the requests kept in calls
+    """
+    name = 'Browse'
+
+    def __init__(self, total, server_limit=None):
+        self.total = total
+        self.server_limit = server_limit
+        self.calls = []
+
+    def call(self, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((kwargs, d))
+        return d
+
+    def answer(self, index=0):
+        kwargs, d = self.calls[index]
+        start = int(kwargs['StartingIndex'])
+        count = int(kwargs['RequestedCount'])
+        if self.server_limit is not None:
+            count = min(count, self.server_limit)
+        count = max(min(count, self.total - start), 0)
+        d.callback(page(start, count, self.total))
+
+
+class TestPagedResult(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(content_directory_client, 'reactor', self.clock)
+        self.items = []
+        self.results = []
+
+    def paged(self, action, callback=None, page_size=10):
+        paged = content_directory_client.PagedResult(
+            action, {'ObjectID': '0'}, callback or self.items.extend,
+            page_size)
+        paged.start().addBoth(self.results.append)
+        return paged
+
+    def test_all_pages(self):
+        """ all objects are handed over, in order """
+        action = FakeAction(25, server_limit=10)
+        self.paged(action)
+        while len(self.results) == 0:
+            action.answer(-1)
+        self.assertEqual([item.id for item in self.items],
+                         [str(i) for i in range(25)])
+        self.assertEqual(self.results, [25])
+        self.assertEqual([kwargs['StartingIndex'] for kwargs, d
+                          in action.calls], ['0', '10', '20'])
+
+    def test_prefetch(self):
+        """ the next page is requested while a page is handled,
+            but not a third one
+        """
+        action = FakeAction(100)
+        pending = []
+
+        def callback(items):
+            d = defer.Deferred()
+            pending.append((items, d))
+            return d
+
+        self.paged(action, callback)
+        action.answer(0)
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(len(action.calls), 2)
+        action.answer(1)
+        # page two waits for the first one to be handled
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(len(action.calls), 2)
+        pending[0][1].callback(None)
+        self.assertEqual(len(pending), 2)
+        self.assertEqual(len(action.calls), 3)
+        self.assertEqual(pending[1][0][0].id, '10')
+
+    def test_adaptive_page_size(self):
+        """ pages grow while they arrive fast and shrink when slow """
+        action = FakeAction(10000)
+        paged = self.paged(action)
+        action.answer(0)
+        self.assertEqual(action.calls[1][0]['RequestedCount'], '20')
+        self.clock.advance(content_directory_client.PAGE_TIME * 2)
+        action.answer(1)
+        self.assertEqual(action.calls[2][0]['RequestedCount'], '10')
+        self.assertEqual(paged.page_size, 10)
+
+    def test_unknown_total(self):
+        """ a TotalMatches of 0 ends with a short page """
+        action = FakeAction(15)
+        self.paged(action)
+        action.answer(0)
+        kwargs, d = action.calls[1]
+        d.callback(page(10, 5, 0))
+        self.assertEqual(len(self.items), 15)
+        self.assertEqual(self.results, [15])
+
+    def test_cancel(self):
+        """ cancelling stops the paging """
+        action = FakeAction(100)
+        paged = self.paged(action)
+        action.answer(0)
+        paged.deferred.cancel()
+        self.assertTrue(self.results[0].check(defer.CancelledError))
+        self.assertTrue(action.calls[1][1].called)
+        self.assertEqual(len(action.calls), 2)
+        self.assertEqual(len(self.items), 10)
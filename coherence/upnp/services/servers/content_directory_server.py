@@ -16,10 +16,23 @@ from coherence.upnp.core.soap_service import errorCode
 from coherence.upnp.core.DIDLLite import DIDLElement
 
 from coherence.upnp.core import service
+from coherence.upnp.core import search_criteria
 
 from coherence import log
 
 
+def _didl_version(item):
+    """ the update_ids the DIDL-Lite fragment of a backend item
+        depends on, None if the backend doesn't track them
+    """
+    parent = getattr(item, 'parent', None)
+    version = (getattr(item, 'update_id', None),
+               getattr(parent, 'update_id', None))
+    if version == (None, None):
+        return None
+    return version
+
+
 class ContentDirectoryControl(service.ServiceControl, UPnPPublisher):
 
     def __init__(self, server):
@@ -47,6 +60,16 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
 
         self.set_variable(0, 'SystemUpdateID', 0)
         self.set_variable(0, 'ContainerUpdateIDs', '')
+        self.set_variable(0, 'SortCapabilities',
+                          search_criteria.SORT_CAPABILITIES)
+
+        # sorted children per (container id, SortCriteria),
+        # valid as long as the container's update_id is unchanged
+        self._sorted_children = {}
+
+        if getattr(self.backend, 'search_index', None) is not None:
+            self.set_variable(0, 'SearchCapabilities',
+                              search_criteria.SEARCH_CAPABILITIES)
 
     def listchilds(self, uri):
         cl = ''
@@ -57,6 +80,47 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
     def render(self, request):
         return '<html><p>root of the ContentDirectory</p><p><ul>%s</ul></p></html>' % self.listchilds(request.uri)
 
+    def get_sorted_children(self, container, sort):
+        """ returns a Deferred firing with all children of the container,
+            ordered by the compiled SortCriteria I{sort}
+
+            the result is cached until the update_id of the
+            container changes
+        """
+        update_id = getattr(container, 'update_id', None)
+        key = None
+        if update_id is not None and hasattr(container, 'get_id'):
+            key = (str(container.get_id()), sort.criteria)
+            try:
+                cached_container, cached_update_id, children = self._sorted_children[key]
+                if cached_container is container and cached_update_id == update_id:
+                    return defer.succeed(children)
+            except KeyError:
+                pass
+
+        def got_items(results, children):
+            pairs = [(child, r[1]) for child, r in zip(children, results)
+                     if r[0] == True and r[1] is not None]
+            children = [child for child, _ in
+                        sort.sort(pairs, lambda pair: pair[1])]
+            if key is not None:
+                if len(self._sorted_children) > 100:
+                    self._sorted_children.clear()
+                self._sorted_children[key] = (container, update_id, children)
+            return children
+
+        def got_children(children):
+            if children is None:
+                children = []
+            dl = defer.DeferredList([defer.maybeDeferred(c.get_item)
+                                     for c in children])
+            dl.addCallback(got_items, children)
+            return dl
+
+        d = defer.maybeDeferred(container.get_children, 0, 0)
+        d.addCallback(got_children)
+        return d
+
     def upnp_Search(self, *args, **kwargs):
         ContainerID = kwargs['ContainerID']
         Filter = kwargs['Filter']
@@ -72,9 +136,24 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
 
         parent_container = str(ContainerID)
 
+        search_index = getattr(self.backend, 'search_index', None)
+        if search_index is not None:
+            try:
+                criteria = search_criteria.compile_criteria(SearchCriteria)
+            except search_criteria.SearchCriteriaError, msg:
+                self.info("upnp_Search %s", msg)
+                return failure.Failure(errorCode(708))
+
+        try:
+            sort = search_criteria.compile_sort_criteria(SortCriteria)
+        except search_criteria.SearchCriteriaError, msg:
+            self.info("upnp_Search %s", msg)
+            return failure.Failure(errorCode(709))
+
         didl = DIDLElement(upnp_client=kwargs.get('X_UPnPClient', ''),
                            parent_container=parent_container,
-                           transcoding=self.transcoding)
+                           transcoding=self.transcoding,
+                           filter=Filter)
 
         def build_response(tm):
             r = {'Result': didl.toString(), 'TotalMatches': tm,
@@ -97,13 +176,14 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
                 result = []
 
             l = []
+            children = result
 
             def process_items(result, tm):
                 if result == None:
                     result = []
-                for i in result:
+                for child, i in zip(children, result):
                     if i[0] == True:
-                        didl.addItem(i[1])
+                        didl.addItem(i[1], update_id=_didl_version(child))
 
                 return build_response(tm)
 
@@ -128,10 +208,23 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
             dl.addCallback(process_items, total)
             return dl
 
+        def get_page(children):
+            if RequestedCount == 0:
+                return children[StartingIndex:]
+            return children[StartingIndex:StartingIndex + RequestedCount]
+
         def proceed(result):
+            if search_index is not None:
+                items, total = search_index.search(criteria, result,
+                                                   StartingIndex, RequestedCount,
+                                                   sort=sort)
+                return process_result(items, total=total)
             if(kwargs.get('X_UPnPClient', '') == 'XBox' and
                hasattr(result, 'get_artist_all_tracks')):
                 d = defer.maybeDeferred(result.get_artist_all_tracks, StartingIndex, StartingIndex + RequestedCount)
+            elif sort:
+                d = self.get_sorted_children(result, sort)
+                d.addCallback(get_page)
             else:
                 d = defer.maybeDeferred(result.get_children, StartingIndex, StartingIndex + RequestedCount)
             d.addCallback(process_result, found_item=result)
@@ -216,10 +309,17 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
 
         self.info("upnp_Browse request %r %r %r %r", ObjectID, BrowseFlag, StartingIndex, RequestedCount)
 
+        try:
+            sort = search_criteria.compile_sort_criteria(SortCriteria)
+        except search_criteria.SearchCriteriaError, msg:
+            self.info("upnp_Browse %s", msg)
+            return failure.Failure(errorCode(709))
+
         didl = DIDLElement(upnp_client=kwargs.get('X_UPnPClient', ''),
                            requested_id=requested_id,
                            parent_container=parent_container,
-                           transcoding=self.transcoding)
+                           transcoding=self.transcoding,
+                           filter=Filter)
 
         def got_error(r):
             return r
@@ -229,13 +329,14 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
                 result = []
             if BrowseFlag == 'BrowseDirectChildren':
                 l = []
+                children = result
 
                 def process_items(result, tm):
                     if result == None:
                         result = []
-                    for i in result:
+                    for child, i in zip(children, result):
                         if i[0] == True:
-                            didl.addItem(i[1])
+                            didl.addItem(i[1], update_id=_didl_version(child))
 
                     return build_response(tm)
 
@@ -260,7 +361,7 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
                 dl.addCallback(process_items, total)
                 return dl
             else:
-                didl.addItem(result)
+                didl.addItem(result, update_id=_didl_version(found_item))
                 total = 1
 
             return build_response(total)
@@ -278,8 +379,16 @@ class ContentDirectoryServer(service.ServiceServer, resource.Resource):
 
             return r
 
+        def get_page(children):
+            if RequestedCount == 0:
+                return children[StartingIndex:]
+            return children[StartingIndex:StartingIndex + RequestedCount]
+
         def proceed(result):
-            if BrowseFlag == 'BrowseDirectChildren':
+            if BrowseFlag == 'BrowseDirectChildren' and sort:
+                d = self.get_sorted_children(result, sort)
+                d.addCallback(get_page)
+            elif BrowseFlag == 'BrowseDirectChildren':
                 d = defer.maybeDeferred(result.get_children, StartingIndex, StartingIndex + RequestedCount)
             else:
                 d = defer.maybeDeferred(result.get_item)
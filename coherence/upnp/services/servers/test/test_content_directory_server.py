@@ -102,6 +102,40 @@ class TestContentDirectoryServer(unittest.TestCase):
         return d
 
 
+    def test_Browse_Sorted(self):
+        """ browses an album with a descending SortCriteria
+        """
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.search(container_id='0',
+                              criteria='upnp:class derivedfrom "object.container"'
+                                       ' and dc:title = "album-2"')
+            call.addCallback(got_album, cdc)
+
+        @wrapped(d)
+        def got_album(r, cdc):
+            self.assertEqual(len(r), 1)
+            call = cdc.browse(object_id=r[0].id, sort_criteria='-dc:title',
+                              process_result=False)
+            call.addCallback(got_children)
+
+        @wrapped(d)
+        def got_children(r):
+            self.assertEqual(int(r['TotalMatches']), 2)
+            didl = DIDLLite.DIDLElement.fromString(r['Result'])
+            self.assertEqual([item.title for item in didl.getItems()],
+                             ['track-2.ogg', 'track-1.ogg'])
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid,
+                        the_result, timeout=10, oneshot=True))
+        return d
+
+
     def test_Browse_Non_Existing_Object(self):
 
         d = Deferred()
@@ -246,3 +280,64 @@ class TestContentDirectoryServer(unittest.TestCase):
             DeviceQuery('uuid', self.uuid, the_result,
                         timeout=10, oneshot=True))
         return d
+
+
+    def test_Search(self):
+        """ tries to find the activated FSStore backend
+            and searches for some of its audio files.
+        """
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            self.assertEqual(self.uuid, mediaserver.udn)
+            call = cdc.search(container_id='0',
+                              criteria='upnp:class derivedfrom "object.item.audioItem"'
+                                       ' and dc:title contains "track-1"')
+            call.addCallback(got_first_answer, cdc)
+
+        @wrapped(d)
+        def got_first_answer(r, cdc):
+            """ we expect two audio files here """
+            self.assertEqual(sorted(item.title for item in r),
+                             ['track-1.mp3', 'track-1.ogg'])
+            action = cdc.service.get_action('Search')
+            call = action.call(ContainerID='0',
+                               SearchCriteria='upnp:class derivedfrom "object.item"',
+                               Filter='*', SortCriteria='',
+                               StartingIndex='1', RequestedCount='2')
+            call.addCallback(got_second_answer)
+
+        @wrapped(d)
+        def got_second_answer(r):
+            """ a page of two out of all four audio files """
+            self.assertEqual(int(r['TotalMatches']), 4)
+            self.assertEqual(int(r['NumberReturned']), 2)
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
+
+
+    def test_Search_Invalid_Criteria(self):
+        """ an unparsable SearchCriteria gives no result """
+        d = Deferred()
+
+        @wrapped(d)
+        def the_result(mediaserver):
+            cdc = mediaserver.client.content_directory
+            call = cdc.search(container_id='0', criteria='dc:title contains')
+            call.addCallback(got_first_answer)
+
+        @wrapped(d)
+        def got_first_answer(r):
+            self.assertEqual(r, [])
+            d.callback(None)
+
+        self.coherence.ctrl.add_query(
+            DeviceQuery('uuid', self.uuid, the_result,
+                        timeout=10, oneshot=True))
+        return d
@@ -159,7 +159,7 @@ Kudos go to:
 if setuptools:
     setup_args['install_requires'] = [
         'ConfigObj >= 4.3',
-        'Twisted >= 8.2',
+        'Twisted >= 13.1',
         'zope.interface',
         'louie',
         ]